@@ -0,0 +1,80 @@
+"""
+	RideShare (Cloud Computing Project)
+	compare.py: compares two artifacts of run.py, and fails if the second one regressed
+
+	python3 compare.py results/<base>.json results/<new>.json --threshold 10
+	exits with 1 if an endpoint lost more than `threshold`% of its throughput, saw its p95 or p99 latency
+	(of successful requests, or of all of them, failures included) or its error rate grow by more than `threshold`%,
+	or started failing
+"""
+
+import argparse
+import sys
+from json import load
+from typing import List, Optional
+
+# (stat, whether higher is better)
+stats = [
+	("rps", True), ("p50_ms", False), ("p95_ms", False), ("p99_ms", False), ("p99_all_ms", False),
+	("errors", False), ("error_rate", False),
+]
+# Stats a change of more than `threshold`% in the wrong direction of is a regression
+gated = {"rps", "p95_ms", "p99_ms", "p99_all_ms", "error_rate"}
+
+
+def change(base: float, new: float) -> Optional[float]:
+	"""
+	Returns the change from `base` to `new` in %, None if `base` is 0
+	"""
+	return 100 * (new - base) / base if base else None
+
+
+def compare(base: dict, new: dict, threshold: float) -> List[str]:
+	"""
+	Prints the stats of both artifacts side by side, and returns the regressions of `new`
+	"""
+	regressions = []
+	print(f"{'endpoint':<28} {'stat':<10} {'base':>10} {'new':>10} {'change':>9}")
+	rows = [("overall", base["overall"], new["overall"])] + [
+		(endpoint, base["endpoints"].get(endpoint), new["endpoints"].get(endpoint))
+		for endpoint in sorted(set(base["endpoints"]) | set(new["endpoints"]))
+	]
+	for endpoint, b, n in rows:
+		if b is None or n is None:
+			print(f"{endpoint:<28} only in {'new' if b is None else 'base'}")
+			continue
+		for stat, higher_is_better in stats:
+			# Artifacts of older runs may lack the newer stats
+			if stat not in b or stat not in n:
+				continue
+			delta = change(b[stat], n[stat])
+			shown = f"{delta:+.1f}%" if delta is not None else "-"
+			print(f"{endpoint:<28} {stat:<10} {b[stat]:>10} {n[stat]:>10} {shown:>9}")
+			worse = delta is not None and (-delta if higher_is_better else delta) > threshold
+			if stat in gated and worse:
+				regressions.append(f"{endpoint} {stat} {b[stat]} -> {n[stat]} ({shown})")
+			elif stat == "error_rate" and n[stat] and not b[stat]:
+				regressions.append(f"{endpoint} error_rate 0 -> {n[stat]}")
+	return regressions
+
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+	parser.add_argument("base", help="artifact of the reference version")
+	parser.add_argument("new", help="artifact of the version compared")
+	parser.add_argument("--threshold", type=float, default=10, help="%% change tolerated before a regression")
+	args = parser.parse_args()
+
+	with open(args.base) as f:
+		base = load(f)
+	with open(args.new) as f:
+		new = load(f)
+	print(f"base {base['meta']['version']} {base['meta']['started_at']}")
+	print(f"new  {new['meta']['version']} {new['meta']['started_at']}")
+
+	regressions = compare(base, new, args.threshold)
+	if regressions:
+		print("\nRegressions:")
+		print("\n".join(regressions))
+		sys.exit(1)
+	print("\nNo regression")
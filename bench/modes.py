@@ -0,0 +1,109 @@
+"""
+	RideShare (Cloud Computing Project)
+	modes.py: load generator comparing the orchestrator's serving modes, saving its results as a JSON artifact
+
+	Run it once against each mode on the same stack, e.g.
+		python3 modes.py http://<dbaas_ip> --concurrency 50 --duration 30 --mode gevent
+	with the default gunicorn/gevent container, and again after restarting the orchestrator
+	with ORCHESTRATOR_APP=aio:app ORCHESTRATOR_CONFIG=gunicorn.aio.config.py and --mode aio.
+	The artifacts have the layout of those of run.py, compare them with compare.py
+"""
+
+import argparse
+import asyncio
+import random
+from datetime import datetime, timezone
+from json import dump, dumps
+from os import makedirs, path
+from time import monotonic
+from typing import Dict, List
+
+from aiohttp import ClientSession
+
+from run import results_dir, summary, version
+
+# (method, path, body, weight) of the requests rides and users send to the orchestrator
+workload = [
+	("POST", "/api/v1/db/read", {"collection": "users", "filte": {}}, 5),
+	("POST", "/api/v1/db/read", {"collection": "rides", "filte": {"rideId": 1}}, 3),
+	(
+		"POST",
+		"/api/v1/db/write",
+		{"collection": "rides", "action": 1, "filte": {"rideId": -1}, "update": {"$set": {"bench": 1}}},
+		2,
+	),
+]
+
+
+async def client(
+	session: ClientSession, url: str, deadline: float,
+	latencies: Dict[str, List[float]], failures: Dict[str, List[float]],
+):
+	"""
+	Sends requests from the weighted workload back to back until `deadline`
+	"""
+	weights = [w[3] for w in workload]
+	while monotonic() < deadline:
+		method, path, body, _ = random.choices(workload, weights)[0]
+		endpoint = f"{method} {path}"
+		start = monotonic()
+		try:
+			async with session.request(method, url + path, data=dumps(body), headers={"Content-Type": "application/json"}) as resp:
+				await resp.read()
+				ok = resp.status < 500
+		except Exception:
+			ok = False
+		(latencies if ok else failures).setdefault(endpoint, []).append(monotonic() - start)
+
+
+async def run(args: argparse.Namespace) -> dict:
+	latencies: Dict[str, List[float]] = {}
+	failures: Dict[str, List[float]] = {}
+	started_at = datetime.now(timezone.utc).isoformat()
+	start = monotonic()
+	async with ClientSession() as session:
+		await asyncio.gather(
+			*(client(session, args.url, start + args.duration, latencies, failures) for _ in range(args.concurrency))
+		)
+	elapsed = monotonic() - start
+
+	endpoints = {
+		endpoint: summary(latencies.get(endpoint, []), failures.get(endpoint, []), elapsed)
+		for endpoint in sorted(set(latencies) | set(failures))
+	}
+	overall = summary(
+		[latency for samples in latencies.values() for latency in samples],
+		[latency for samples in failures.values() for latency in samples],
+		elapsed,
+	)
+	return {
+		"meta": {
+			"version": version(),
+			"started_at": started_at,
+			"elapsed_s": round(elapsed, 2),
+			"args": vars(args),
+		},
+		"overall": overall,
+		"endpoints": endpoints,
+	}
+
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+	parser.add_argument("url", help="base URL of the orchestrator")
+	parser.add_argument("--concurrency", type=int, default=50)
+	parser.add_argument("--duration", type=float, default=30)
+	parser.add_argument("--mode", default="gevent", help="serving mode of the orchestrator, named in the artifact")
+	parser.add_argument("--out", help="artifact path, defaults to results/<time>-<version>-<mode>.json")
+	args = parser.parse_args()
+
+	report = asyncio.run(run(args))
+	out = args.out
+	if out is None:
+		makedirs(results_dir, exist_ok=True)
+		stamp = datetime.now().strftime("%Y%m%d-%H%M%S")
+		out = path.join(results_dir, f"{stamp}-{report['meta']['version']}-{args.mode}.json")
+	with open(out, "w") as f:
+		dump(report, f, indent=2)
+	print(dumps({"overall": report["overall"], "endpoints": report["endpoints"]}, indent=2))
+	print(f"Saved {out}")
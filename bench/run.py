@@ -0,0 +1,242 @@
+"""
+	RideShare (Cloud Computing Project)
+	run.py: load test of the whole stack, saving its results as a JSON artifact
+
+	Drives the rides and users APIs (and through them the orchestrator and the DB workers) with the mixed
+	workload of workload.py, while sampling the slaves and queue depths of the DBaaS, e.g.
+		python3 run.py --rides http://<rides_ip> --users http://<users_ip> --dbaas http://<dbaas_ip> \
+			--concurrency 50 --duration 60 --seed 1
+	Compare the artifacts of two versions with compare.py
+"""
+
+import argparse
+import asyncio
+import subprocess
+from datetime import datetime, timezone
+from json import dump, dumps
+from os import makedirs, path
+from time import monotonic, time
+from typing import Dict, List, Optional
+
+from aiohttp import BasicAuth, ClientSession, ClientTimeout
+
+from workload import VirtualUser, routes
+
+results_dir = path.join(path.dirname(path.abspath(__file__)), "results")
+# Queues whose depth is sampled when the RMQ management API is given
+queues = ["readQ", "writeQ", "syncQ"]
+
+
+def percentile(samples: List[float], p: float) -> float:
+	"""
+	Returns the `p`th percentile of sorted `samples`
+	"""
+	if not samples:
+		return 0.0
+	return samples[min(len(samples) - 1, int(p / 100 * len(samples)))]
+
+
+def summary(samples: List[float], failures: List[float], elapsed: float) -> dict:
+	"""
+	Returns the throughput and latency percentiles of the latencies of successful requests `samples`,
+	the error rate, and the p99 latency of all requests, failures (timeouts included) among them
+	"""
+	samples.sort()
+	everything = sorted(samples + failures)
+	return {
+		"requests": len(samples),
+		"errors": len(failures),
+		"error_rate": round(len(failures) / len(everything), 4) if everything else 0.0,
+		"rps": round(len(samples) / elapsed, 2),
+		"p50_ms": round(1000 * percentile(samples, 50), 2),
+		"p95_ms": round(1000 * percentile(samples, 95), 2),
+		"p99_ms": round(1000 * percentile(samples, 99), 2),
+		"p99_all_ms": round(1000 * percentile(everything, 99), 2),
+		"max_ms": round(1000 * everything[-1], 2) if everything else 0.0,
+	}
+
+
+class Recorder:
+	"""
+	Latencies and status codes of the requests sent, per endpoint, once the warm up is over
+	"""
+	def __init__(self):
+		self.recording = False
+		self.latencies: Dict[str, List[float]] = {}
+		# Latencies of the failed requests, up to the timeout for those that never got an answer
+		self.failures: Dict[str, List[float]] = {}
+		self.statuses: Dict[str, Dict[str, int]] = {}
+		self.completed = 0
+
+	def record(self, endpoint: str, status: Optional[int], latency: float):
+		if not self.recording:
+			return
+		self.completed += 1
+		statuses = self.statuses.setdefault(endpoint, {})
+		key = str(status) if status is not None else "failed"
+		statuses[key] = statuses.get(key, 0) + 1
+		# Client errors (an unknown ride, joining one's own ride) are answers like any other
+		if status is None or status >= 500:
+			self.failures.setdefault(endpoint, []).append(latency)
+		else:
+			self.latencies.setdefault(endpoint, []).append(latency)
+
+
+async def virtual_user(session: ClientSession, urls: Dict[str, str], user: VirtualUser, deadline: float, recorder: Recorder):
+	"""
+	Sends the requests of `user` back to back until `deadline`
+	"""
+	while monotonic() < deadline:
+		service, method, url_path, endpoint, body = user.next_request()
+		start = monotonic()
+		status, response = None, None
+		try:
+			async with session.request(
+				method, urls[service] + url_path, data=dumps(body) if body is not None else None,
+				headers={"Content-Type": "application/json"},
+			) as resp:
+				status = resp.status
+				if resp.content_type == "application/json":
+					response = await resp.json()
+				else:
+					await resp.read()
+		except Exception:
+			pass
+		recorder.record(endpoint, status, monotonic() - start)
+		user.learn(endpoint, status, response)
+
+
+async def get_json(session: ClientSession, url: str, **kwargs) -> Optional[dict]:
+	try:
+		async with session.get(url, **kwargs) as resp:
+			return await resp.json() if resp.status == 200 else None
+	except Exception:
+		return None
+
+
+async def sampler(session: ClientSession, args: argparse.Namespace, deadline: float, recorder: Recorder, timeline: List[dict]):
+	"""
+	Records the throughput, the slaves and the queue depths every `sample_interval` seconds until `deadline`
+	"""
+	start, completed = monotonic(), recorder.completed
+	while monotonic() < deadline:
+		await asyncio.sleep(args.sample_interval)
+		now = monotonic()
+		sample = {
+			"t": round(now - start, 2),
+			"rps": round((recorder.completed - completed) / args.sample_interval, 2),
+		}
+		completed = recorder.completed
+		if args.dbaas:
+			workers = await get_json(session, f"{args.dbaas}/api/v1/worker/list")
+			sample["workers"] = len(workers) if workers is not None else None
+			scaling = await get_json(session, f"{args.dbaas}/api/v1/worker/scaling")
+			metrics = (scaling or {}).get("metrics") or {}
+			sample["slaves"] = metrics.get("slaves")
+			sample["standby"] = metrics.get("standby")
+			sample["target"] = (scaling or {}).get("target")
+			sample["read_p95_s"] = metrics.get("p95_latency")
+			if not args.rmq_management and metrics.get("queue"):
+				# The orchestrator's last reading of readQ, as of its last scaling decision
+				sample["queues"] = {"readQ": metrics["queue"]}
+		if args.rmq_management:
+			auth = BasicAuth(*args.rmq_auth.split(":", 1))
+			sample["queues"] = {}
+			for queue in queues:
+				stats = await get_json(session, f"{args.rmq_management}/api/queues/%2F/{queue}", auth=auth)
+				sample["queues"][queue] = {
+					"ready": stats.get("messages_ready", 0),
+					"unacked": stats.get("messages_unacknowledged", 0),
+					"consumers": stats.get("consumers", 0),
+				} if stats is not None else None
+		timeline.append(sample)
+
+
+def version() -> str:
+	"""
+	Returns the commit the benchmark runs from, marked dirty if the tree has changes
+	"""
+	try:
+		return subprocess.run(
+			["git", "describe", "--always", "--dirty"], capture_output=True, text=True, check=True,
+			cwd=path.dirname(path.abspath(__file__)),
+		).stdout.strip()
+	except Exception:
+		return "unknown"
+
+
+async def run(args: argparse.Namespace) -> dict:
+	urls = {"rides": args.rides, "users": args.users}
+	run_id = f"{args.seed}-{int(time())}"
+	popular = routes(args.seed)
+	users = [VirtualUser(run_id, i, args.seed, popular) for i in range(args.concurrency)]
+	recorder = Recorder()
+	timeline: List[dict] = []
+	started_at = datetime.now(timezone.utc).isoformat()
+
+	async with ClientSession(timeout=ClientTimeout(total=args.timeout)) as session:
+		if args.clear and args.dbaas:
+			async with session.post(f"{args.dbaas}/api/v1/db/clear") as resp:
+				resp.raise_for_status()
+		deadline = monotonic() + args.warmup + args.duration
+		tasks = [virtual_user(session, urls, user, deadline, recorder) for user in users]
+		clients = asyncio.gather(*tasks)
+		await asyncio.sleep(args.warmup)
+
+		recorder.recording = True
+		start = monotonic()
+		await asyncio.gather(clients, sampler(session, args, deadline, recorder, timeline))
+		elapsed = monotonic() - start
+
+	endpoints = {
+		endpoint: {
+			**summary(recorder.latencies.get(endpoint, []), recorder.failures.get(endpoint, []), elapsed),
+			"statuses": statuses,
+		}
+		for endpoint, statuses in sorted(recorder.statuses.items())
+	}
+	overall = summary(
+		[latency for samples in recorder.latencies.values() for latency in samples],
+		[latency for samples in recorder.failures.values() for latency in samples],
+		elapsed,
+	)
+	return {
+		"meta": {
+			"version": version(),
+			"started_at": started_at,
+			"elapsed_s": round(elapsed, 2),
+			"args": vars(args),
+		},
+		"overall": overall,
+		"endpoints": endpoints,
+		"timeline": timeline,
+	}
+
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+	parser.add_argument("--rides", required=True, help="base URL of the rides API")
+	parser.add_argument("--users", required=True, help="base URL of the users API")
+	parser.add_argument("--dbaas", help="base URL of the orchestrator, to sample the slaves")
+	parser.add_argument("--rmq-management", help="base URL of the RMQ management API, to sample the queue depths")
+	parser.add_argument("--rmq-auth", default="guest:guest", help="user:password of the RMQ management API")
+	parser.add_argument("--concurrency", type=int, default=50, help="virtual users sending requests back to back")
+	parser.add_argument("--duration", type=float, default=60, help="seconds of recorded load")
+	parser.add_argument("--warmup", type=float, default=10, help="seconds of load before recording starts")
+	parser.add_argument("--sample-interval", type=float, default=5, help="seconds between two timeline samples")
+	parser.add_argument("--timeout", type=float, default=30, help="seconds before a request counts as failed")
+	parser.add_argument("--seed", type=int, default=1, help="runs with the same seed send the same workload")
+	parser.add_argument("--clear", action="store_true", help="clear the DB before the run")
+	parser.add_argument("--out", help="artifact path, defaults to results/<time>-<version>.json")
+	args = parser.parse_args()
+
+	report = asyncio.run(run(args))
+	out = args.out
+	if out is None:
+		makedirs(results_dir, exist_ok=True)
+		stamp = datetime.now().strftime("%Y%m%d-%H%M%S")
+		out = path.join(results_dir, f"{stamp}-{report['meta']['version']}.json")
+	with open(out, "w") as f:
+		dump(report, f, indent=2)
+	print(dumps({"overall": report["overall"], "endpoints": report["endpoints"]}, indent=2))
+	print(f"Saved {out}")
@@ -0,0 +1,132 @@
+"""
+	RideShare (Cloud Computing Project)
+	workload.py: the mixed workload of the benchmark, as the virtual users of bench/run.py send it
+"""
+
+import random
+from datetime import datetime, timedelta
+from hashlib import sha1
+from typing import Any, Dict, List, Optional, Tuple
+
+url_prefix = "/api/v1"
+
+# Location ids of the rides API (rides/AreaNameEnum.csv)
+locations = range(1, 198)
+
+# Searches and new rides mostly go over a few popular routes, like real traffic
+hot_routes = 10
+hot_route_share = 0.8
+# Rides a virtual user remembers, the most recently found
+known_rides = 100
+
+# (action, weight): how often a virtual user takes each action
+actions = [
+	("create_user", 1),
+	("list_users", 1),
+	("create_ride", 2),
+	("search_rides", 5),
+	("get_ride", 3),
+	("join_ride", 2),
+	("count_rides", 1),
+	("delete_ride", 1),
+	("delete_user", 0.5),
+]
+
+# A request: (service, method, path, endpoint the stats are kept under, JSON body or None)
+Request = Tuple[str, str, str, str, Optional[Dict[str, Any]]]
+
+
+def routes(seed: int) -> List[Tuple[int, int]]:
+	"""
+	Returns the popular routes (source, destination) of a run, the same for every run with `seed`
+	"""
+	rng = random.Random(seed)
+	return [tuple(rng.sample(locations, 2)) for _ in range(hot_routes)]
+
+
+class VirtualUser:
+	"""
+	A client of the RideShare API, taking weighted random actions on the users and rides it knows about.
+	It starts knowing nothing: it learns the users it created and the rides its searches returned.
+	Two runs with the same `seed` send the same requests, given the same responses
+	"""
+	def __init__(self, run_id: str, index: int, seed: int, popular: List[Tuple[int, int]]):
+		self.prefix = f"bench-{run_id}-{index}"
+		self.rng = random.Random(seed * 1000003 + index)
+		self.popular = popular
+		self.users: List[str] = []
+		self.rides: List[int] = []
+		self.created = 0
+
+	def route(self) -> Tuple[int, int]:
+		if self.rng.random() < hot_route_share:
+			return self.rng.choice(self.popular)
+		return tuple(self.rng.sample(locations, 2))
+
+	def next_request(self) -> Request:
+		"""
+		Returns the request of the next action; actions needing a user or a ride it doesn't know yet
+		fall back on creating a user or searching rides
+		"""
+		action = self.rng.choices([a for a, _ in actions], [w for _, w in actions])[0]
+		if action in ("create_ride", "join_ride", "delete_user") and not self.users:
+			action = "create_user"
+		if action in ("get_ride", "join_ride", "delete_ride") and not self.rides:
+			action = "search_rides"
+		return getattr(self, action)()
+
+	def create_user(self) -> Request:
+		username = f"{self.prefix}-{self.created}"
+		self.created += 1
+		self.users.append(username)
+		password = sha1(username.encode("utf-8")).hexdigest()
+		body = {"username": username, "password": password}
+		return "users", "PUT", f"{url_prefix}/users", "PUT /users", body
+
+	def list_users(self) -> Request:
+		return "users", "GET", f"{url_prefix}/users", "GET /users", None
+
+	def delete_user(self) -> Request:
+		username = self.users.pop(self.rng.randrange(len(self.users)))
+		return "users", "DELETE", f"{url_prefix}/users/{username}", "DELETE /users/<username>", None
+
+	def create_ride(self) -> Request:
+		source, destination = self.route()
+		timestamp = datetime.now() + timedelta(days=self.rng.randint(1, 30), seconds=self.rng.randint(0, 86400))
+		body = {
+			"created_by": self.rng.choice(self.users),
+			"timestamp": timestamp.strftime("%d-%m-%Y:%S-%M-%H"),
+			"source": source,
+			"destination": destination,
+		}
+		return "rides", "POST", f"{url_prefix}/rides", "POST /rides", body
+
+	def search_rides(self) -> Request:
+		source, destination = self.route()
+		path = f"{url_prefix}/rides?source={source}&destination={destination}"
+		return "rides", "GET", path, "GET /rides", None
+
+	def get_ride(self) -> Request:
+		ride = self.rng.choice(self.rides)
+		return "rides", "GET", f"{url_prefix}/rides/{ride}", "GET /rides/<rideId>", None
+
+	def join_ride(self) -> Request:
+		ride = self.rng.choice(self.rides)
+		body = {"username": self.rng.choice(self.users)}
+		return "rides", "POST", f"{url_prefix}/rides/{ride}", "POST /rides/<rideId>", body
+
+	def count_rides(self) -> Request:
+		return "rides", "GET", f"{url_prefix}/rides/count", "GET /rides/count", None
+
+	def delete_ride(self) -> Request:
+		ride = self.rides.pop(self.rng.randrange(len(self.rides)))
+		return "rides", "DELETE", f"{url_prefix}/rides/{ride}", "DELETE /rides/<rideId>", None
+
+	def learn(self, endpoint: str, status: int, body: Any):
+		"""
+		Remembers the rides a search returned, for the actions on rides that follow
+		"""
+		if endpoint == "GET /rides" and status == 200 and isinstance(body, list):
+			known = set(self.rides)
+			self.rides.extend(r["rideId"] for r in body if r.get("rideId") not in known)
+			self.rides = self.rides[-known_rides:]
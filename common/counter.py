@@ -0,0 +1,91 @@
+"""
+	RideShare (Cloud Computing Project)
+	counter.py: request counts buffered in process and flushed to Redis in the background
+
+	Shared by rides, users and the orchestrator: their images copy it next to their own modules, and it reads their config
+"""
+
+import logging
+import threading
+from time import sleep
+from typing import Dict
+
+import redis
+
+from config import count_flush_interval, redis_host
+
+logger = logging.getLogger()
+
+
+class BufferedCounter:
+	"""
+	Counts requests in process and adds the counts to their Redis keys every `interval` seconds,
+	in one pipelined round trip, so that counting a request never waits on Redis.
+	Totals in Redis lag the requests by about `interval` seconds; counts a failed flush couldn't add are retried.
+	The counts are flushed once start() is called
+	"""
+	def __init__(self, client: redis.Redis, interval: float = count_flush_interval):
+		self.r = client
+		self.interval = interval
+		self.pending: Dict[str, int] = {}
+		self.lock = threading.Lock()
+		# Held while counts are on their way to Redis, so that a reset can't be overtaken by them
+		self.flush_lock = threading.Lock()
+
+	def incr(self, key: str, amount: int = 1):
+		"""
+		Adds `amount` to `key`
+		"""
+		with self.lock:
+			self.pending[key] = self.pending.get(key, 0) + amount
+
+	def start(self):
+		"""
+		Starts the thread flushing the counts, see post_fork in hooks.py
+		"""
+		threading.Thread(target=self.run, daemon=True).start()
+
+	def run(self):
+		while True:
+			sleep(self.interval)
+			self.flush()
+
+	def flush(self):
+		"""
+		Adds the buffered counts to Redis, keeping them for the next flush if Redis can't be reached
+		"""
+		with self.flush_lock:
+			with self.lock:
+				pending, self.pending = self.pending, {}
+			if not pending:
+				return
+			try:
+				pipe = self.r.pipeline(transaction=False)
+				for key, amount in pending.items():
+					pipe.incrby(key, amount)
+				pipe.execute()
+			except Exception as e:
+				logger.error(f"Error flushing request counts to Redis. {e}")
+				with self.lock:
+					for key, amount in pending.items():
+						self.pending[key] = self.pending.get(key, 0) + amount
+
+	def get(self, key: str) -> int:
+		"""
+		Returns the total of `key`: its value in Redis and the counts of this process not flushed yet
+		"""
+		with self.lock:
+			local = self.pending.get(key, 0)
+		return int(self.r.get(key) or 0) + local
+
+	def reset(self, key: str):
+		"""
+		Deletes `key` from Redis along with the counts of this process not flushed yet
+		"""
+		with self.flush_lock:
+			with self.lock:
+				self.pending.pop(key, None)
+			self.r.delete(key)
+
+
+request_counter = BufferedCounter(redis.Redis(host=redis_host))
@@ -0,0 +1,18 @@
+"""
+	RideShare (Cloud Computing Project)
+	hooks.py: gunicorn server hooks shared by rides, users and the orchestrator
+"""
+
+from counter import request_counter
+from logs import start_logging
+from tracing import collector
+
+
+def post_fork(server, worker):
+	"""
+	Starts the threads writing the logs and spans and flushing the request counts, in each worker:
+	gunicorn forks its workers after loading the config, and the threads of the master don't run in them
+	"""
+	start_logging()
+	collector.start()
+	request_counter.start()
@@ -0,0 +1,83 @@
+"""
+	RideShare (Cloud Computing Project)
+	metrics.py: Prometheus metrics of the service, served in text format on /metrics
+
+	Shared by rides, users and the orchestrator: their images copy it next to their own modules
+"""
+
+from contextlib import contextmanager
+from functools import wraps
+from time import monotonic
+
+from flask import Flask, Response, g, request
+from prometheus_client import (CONTENT_TYPE_LATEST, Counter, Histogram,
+                               generate_latest)
+
+# Body sizes, from empty to a large read
+size_buckets = (0, 64, 256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304)
+
+request_latency = Histogram(
+	"http_request_duration_seconds", "Latency of the API endpoints", ["endpoint", "method", "status"]
+)
+hop_latency = Histogram("hop_duration_seconds", "Latency of calls to other services", ["hop"])
+payload_size = Histogram(
+	"payload_size_bytes", "Size of request and response bodies", ["endpoint", "direction"], buckets=size_buckets
+)
+errors = Counter("errors_total", "Failed requests and calls to other services", ["where"])
+log_dropped = Counter("log_records_dropped_total", "Log records dropped as the queue of the log writer was full")
+spans_dropped = Counter("spans_dropped_total", "Spans dropped as the queue of the span collector was full")
+
+
+@contextmanager
+def hop_timer(hop: str):
+	"""
+	Records the latency and the errors of the block it wraps under `hop`
+	"""
+	start = monotonic()
+	try:
+		yield
+	except Exception:
+		errors.labels(hop).inc()
+		raise
+	finally:
+		hop_latency.labels(hop).observe(monotonic() - start)
+
+
+def timed(hop: str):
+	"""
+	Decorator recording the latency and the errors of every call of a function under `hop`
+	"""
+	def decorator(fn):
+		@wraps(fn)
+		def wrapper(*args, **kwargs):
+			with hop_timer(hop):
+				return fn(*args, **kwargs)
+		return wrapper
+	return decorator
+
+
+def instrument(app: Flask):
+	"""
+	Records the latency, body sizes and server errors of every request to `app`, and serves the metrics on /metrics
+	"""
+	@app.before_request
+	def start_timer():
+		g.request_start = monotonic()
+
+	@app.after_request
+	def record(response: Response) -> Response:
+		# The route, not the path, so that /rides/1 and /rides/2 share their metrics
+		endpoint = request.url_rule.rule if request.url_rule else "unmatched"
+		request_latency.labels(endpoint, request.method, response.status_code).observe(
+			monotonic() - g.request_start
+		)
+		payload_size.labels(endpoint, "in").observe(request.content_length or 0)
+		# Streamed responses have no length up front
+		payload_size.labels(endpoint, "out").observe(response.calculate_content_length() or 0)
+		if response.status_code >= 500:
+			errors.labels(endpoint).inc()
+		return response
+
+	@app.route("/metrics")
+	def metrics() -> Response:
+		return Response(generate_latest(), mimetype=CONTENT_TYPE_LATEST)
@@ -0,0 +1,176 @@
+"""
+	RideShare (Cloud Computing Project)
+	tracing.py: request-scoped spans, propagated to other services with the W3C `traceparent` header
+	and written as JSON lines to a local collector file
+
+	Shared by rides, users and the orchestrator: their images copy it next to their own modules, and it reads their config
+"""
+
+import threading
+from contextlib import contextmanager
+from functools import wraps
+from json import dumps
+from os import urandom
+from queue import Full, Queue
+from time import monotonic, time
+from typing import Dict, Optional, Tuple
+
+from flask import Flask, Response, g, request
+
+from config import service_name, span_queue_size, spans_file
+from metrics import spans_dropped
+
+# The span each thread (greenlet under gevent) is in
+_local = threading.local()
+
+
+class Span:
+	"""
+	A timed operation of a trace, child of the span `parent_id` (None for the root of the trace)
+	"""
+	def __init__(self, name: str, trace_id: str = None, parent_id: str = None, **attrs):
+		self.name = name
+		self.trace_id = trace_id or urandom(16).hex()
+		self.span_id = urandom(8).hex()
+		self.parent_id = parent_id
+		self.attrs = attrs
+		self.start = time()
+		self.started = monotonic()
+
+	def traceparent(self) -> str:
+		return f"00-{self.trace_id}-{self.span_id}-01"
+
+	def end(self, error: Exception = None):
+		collector.record({
+			"trace_id": self.trace_id,
+			"span_id": self.span_id,
+			"parent_id": self.parent_id,
+			"service": service_name,
+			"name": self.name,
+			"start": self.start,
+			"duration_ms": round(1000 * (monotonic() - self.started), 3),
+			"attrs": self.attrs,
+			"error": repr(error) if error is not None else None,
+		})
+
+
+class SpanCollector:
+	"""
+	Appends finished spans to `path`, one JSON object per line, from a background thread once started,
+	so that recording a span never waits on the disk. At most `size` spans wait to be written,
+	others are dropped and counted in spans_dropped_total
+	"""
+	def __init__(self, path: str = spans_file, size: int = span_queue_size):
+		self.path = path
+		self.queue = Queue(size)
+
+	def start(self):
+		"""
+		Starts the thread writing the spans, see post_fork in common/hooks.py
+		"""
+		threading.Thread(target=self.run, daemon=True).start()
+
+	def record(self, span: dict):
+		try:
+			self.queue.put_nowait(span)
+		except Full:
+			spans_dropped.inc()
+
+	def run(self):
+		with open(self.path, "a") as f:
+			while True:
+				lines = [dumps(self.queue.get())]
+				while not self.queue.empty():
+					lines.append(dumps(self.queue.get()))
+				f.write("\n".join(lines) + "\n")
+				f.flush()
+
+
+collector = SpanCollector()
+
+
+def parse_traceparent(header: Optional[str]) -> Tuple[Optional[str], Optional[str]]:
+	"""
+	Returns the trace and parent span ids of a `traceparent` header, (None, None) if it's missing or malformed
+	"""
+	parts = (header or "").split("-")
+	if len(parts) != 4 or len(parts[1]) != 32 or len(parts[2]) != 16:
+		return None, None
+	return parts[1], parts[2]
+
+
+def current_span() -> Optional[Span]:
+	return getattr(_local, "span", None)
+
+
+@contextmanager
+def span(name: str, traceparent: str = None, **attrs):
+	"""
+	Runs the block it wraps in a new span: a child of the `traceparent` header if given,
+	else of the current span, else the root of a new trace
+	"""
+	parent = current_span()
+	if traceparent is not None:
+		trace_id, parent_id = parse_traceparent(traceparent)
+	elif parent is not None:
+		trace_id, parent_id = parent.trace_id, parent.span_id
+	else:
+		trace_id, parent_id = None, None
+	s = Span(name, trace_id, parent_id, **attrs)
+	_local.span = s
+	try:
+		yield s
+	except Exception as e:
+		s.end(e)
+		raise
+	else:
+		s.end()
+	finally:
+		_local.span = parent
+
+
+def traced(name: str):
+	"""
+	Decorator running every call of a function in a new span `name`
+	"""
+	def decorator(fn):
+		@wraps(fn)
+		def wrapper(*args, **kwargs):
+			with span(name):
+				return fn(*args, **kwargs)
+		return wrapper
+	return decorator
+
+
+def trace_headers(headers: Dict[str, str] = {}) -> Dict[str, str]:
+	"""
+	Returns `headers` with the `traceparent` of the current span, to continue the trace in the service called
+	"""
+	s = current_span()
+	return {**headers, "traceparent": s.traceparent()} if s is not None else headers
+
+
+def trace_requests(app: Flask):
+	"""
+	Runs every request to `app` in a span, continuing the trace of its `traceparent` header if any
+	"""
+	@app.before_request
+	def start_span():
+		g.span_context = span(f"{request.method} {request.path}", request.headers.get("traceparent"))
+		g.span_context.__enter__()
+
+	@app.after_request
+	def record_status(response: Response) -> Response:
+		s = current_span()
+		if s is not None:
+			s.attrs["status"] = response.status_code
+		return response
+
+	@app.teardown_request
+	def end_span(error: Exception = None):
+		context = g.pop("span_context", None)
+		if context is not None:
+			if error is not None:
+				context.__exit__(type(error), error, error.__traceback__)
+			else:
+				context.__exit__(None, None, None)
@@ -0,0 +1,541 @@
+"""
+	RideShare (Cloud Computing Project)
+	aio.py: asyncio serving mode of the orchestrator API (aiohttp, aio-pika, aioredis)
+	Exposes the same endpoints, request bodies and responses as main.py
+"""
+
+import asyncio
+from contextlib import contextmanager
+from contextvars import ContextVar
+from itertools import count
+from json import dumps, loads
+from time import monotonic, time
+from typing import AsyncIterator, Dict, List, Optional
+
+import aio_pika
+import aioredis
+from aiohttp import web
+from prometheus_client import CONTENT_TYPE_LATEST, generate_latest
+
+from config import (redis_host, rmq_host, rpc_timeout, scale_interval,
+                    standby_key, write_count_key)
+from hooks import post_fork
+from logs import trace_logs
+from metrics import (errors, hop_latency, hop_timer, payload_size,
+                     request_latency)
+from scaling import scale_after, scaler
+from tracing import Span, parse_traceparent
+from utils import (QueryError, ReadRpcClient, incr_redis_count,
+                   index_query, kill_slave, logger, new_uuid, read_cache,
+                   read_latency, read_query, request_logger,
+                   worker_registry, write_query)
+
+# Paths for API endpoints
+url_prefix = "/api/v1"
+db_url_prefix = f"{url_prefix}/db"
+crash_url_prefix = f"{url_prefix}/crash"
+worker_url_prefix = f"{url_prefix}/worker"
+
+# Span each request is in: asyncio runs every request in its own task, with its own copy of the context,
+# where a threading.local would be shared by all the requests of the event loop
+current_span: ContextVar[Optional[Span]] = ContextVar("current_span", default=None)
+# The log records of a request carry the trace id of its span
+trace_logs(current_span.get)
+
+
+@contextmanager
+def span(name: str, **attrs):
+	"""
+	Runs the block it wraps in a new span, child of the current span, see span in tracing.py
+	"""
+	parent = current_span.get()
+	if parent is not None:
+		s = Span(name, parent.trace_id, parent.span_id, **attrs)
+	else:
+		s = Span(name, **attrs)
+	token = current_span.set(s)
+	try:
+		yield s
+	except Exception as e:
+		s.end(e)
+		raise
+	else:
+		s.end()
+	finally:
+		current_span.reset(token)
+
+
+def trace_headers(headers: Dict[str, str]) -> Dict[str, str]:
+	"""
+	Returns `headers` with the `traceparent` of the current span, see trace_headers in tracing.py
+	"""
+	s = current_span.get()
+	return {**headers, "traceparent": s.traceparent()} if s is not None else headers
+
+
+class AsyncRpcClient:
+	"""
+	Sends queries to readQ and resolves the Future of each call when its response arrives
+	on the exclusive callback queue of this process
+	"""
+	def __init__(self, channel: aio_pika.Channel):
+		self.channel = channel
+		self.callback_queue = None
+		self.pending: Dict[str, asyncio.Future] = {}
+		self.streams: Dict[str, asyncio.Queue] = {}
+
+	async def connect(self) -> "AsyncRpcClient":
+		"""
+		Declares the callback queue and the queue of applied writes, and starts consuming them
+		"""
+		self.callback_queue = await self.channel.declare_queue(exclusive=True)
+		await self.callback_queue.consume(self.on_response, no_ack=True)
+		# The writes the master applied invalidate the read cache, see ReadCache in utils.py
+		exchange = await self.channel.declare_exchange(
+			ReadRpcClient.applied_exchange, aio_pika.ExchangeType.FANOUT, durable=True
+		)
+		applied = await self.channel.declare_queue(exclusive=True)
+		await applied.bind(exchange)
+		await applied.consume(self.on_applied, no_ack=True)
+		return self
+
+	def on_applied(self, message: aio_pika.IncomingMessage):
+		"""
+		Triggered when the master flushed writes to the DB, with the collections they touched
+		"""
+		for collection in loads(message.body.decode("utf-8")):
+			read_cache.invalidate(collection)
+
+	def on_response(self, message: aio_pika.IncomingMessage):
+		"""
+		Triggered when a response is received on the callback queue
+		"""
+		if message.correlation_id in self.streams:
+			self.streams[message.correlation_id].put_nowait(message)
+			return
+		future = self.pending.pop(message.correlation_id, None)
+		if future is None:
+			logger.warning(f"Dropping response for unknown call {message.correlation_id}")
+			return
+		if future.done():
+			return
+		if message.headers and "error" in message.headers:
+			future.set_exception(read_error(message))
+			return
+		future.set_result(message.body.decode("utf-8"))
+
+	async def publish(self, corr_id: str, query: str):
+		"""
+		Sends `query` to readQ with `corr_id`, asking for the response on the callback queue
+		"""
+		await self.channel.default_exchange.publish(
+			aio_pika.Message(
+				body=query.encode("utf-8"),
+				correlation_id=corr_id,
+				reply_to=self.callback_queue.name,
+				headers=trace_headers({"sent_at": time()}),
+			),
+			routing_key="readQ",
+		)
+
+	async def call(self, query: str, timeout: float = rpc_timeout) -> str:
+		"""
+		Sends `query` to readQ with a unique correlation_id and waits for the response
+		"""
+		corr_id = new_uuid()
+		future = asyncio.get_event_loop().create_future()
+		self.pending[corr_id] = future
+		start = monotonic()
+		try:
+			with span("read_rpc"):
+				await self.publish(corr_id, query)
+				return await asyncio.wait_for(future, timeout)
+		except Exception:
+			errors.labels("read_rpc").inc()
+			raise
+		finally:
+			read_latency.record(monotonic() - start)
+			hop_latency.labels("read_rpc").observe(monotonic() - start)
+			self.pending.pop(corr_id, None)
+
+	async def stream(self, query: str, timeout: float = rpc_timeout) -> AsyncIterator[str]:
+		"""
+		Sends a streamed read `query` to readQ and yields the chunks of its response in order,
+		returning a credit to the worker for each chunk taken, see ReadRpcClient.stream in utils.py
+		"""
+		corr_id = new_uuid()
+		chunks = asyncio.Queue()
+		self.streams[corr_id] = chunks
+		try:
+			await self.publish(corr_id, query)
+			for seq in count():
+				try:
+					message = await asyncio.wait_for(chunks.get(), timeout)
+				except asyncio.TimeoutError:
+					raise TimeoutError(f"No chunk {seq} of streamed read within {timeout}s")
+				headers = message.headers or {}
+				if "error" in headers:
+					raise read_error(message)
+				if headers.get("seq") != seq:
+					raise QueryError(f"Chunk {headers.get('seq')} received instead of {seq}")
+				yield message.body.decode("utf-8")
+				if headers.get("last"):
+					return
+				await self.channel.default_exchange.publish(
+					aio_pika.Message(body=b"", correlation_id=corr_id), routing_key=message.reply_to
+				)
+		finally:
+			self.streams.pop(corr_id, None)
+
+
+def read_error(message: aio_pika.IncomingMessage) -> QueryError:
+	"""
+	Returns the QueryError for the `error` header of a response
+	"""
+	error = message.headers["error"]
+	return QueryError(error.decode("utf-8") if isinstance(error, bytes) else error)
+
+
+async def push_to_Q(app: web.Application, queue: str, query: str):
+	"""
+	Publishes a `query` in a queue using the default exchange and persistent delivery mode,
+	the channel is in confirm mode so this returns once the broker has the message
+	"""
+	with hop_timer("publish"), span("publish", queue=queue):
+		await app["channel"].default_exchange.publish(
+			aio_pika.Message(
+				body=query.encode("utf-8"),
+				delivery_mode=aio_pika.DeliveryMode.PERSISTENT,
+				headers=trace_headers({"sent_at": time()}),
+			),
+			routing_key=queue,
+		)
+
+
+# ## Docker
+async def list_workers(app: web.Application, role: str = None) -> List[dict]:
+	"""
+	Returns the registry entries of all running workers of `role` (master/slave) if given, except standby slaves
+	"""
+	standby = {name.decode("utf-8") for name in await app["redis"].smembers(standby_key)}
+	return [w for w in app["registry"].list(role) if w["name"] not in standby]
+
+
+# ## Handlers
+async def db_read(request: web.Request) -> web.Response:
+	"""
+	returns the result of read query `op` on `collection`, see DBRead in main.py
+	"""
+	incr_redis_count()
+	try:
+		query = read_query(await request.json())
+		key = read_cache.key(query)
+		generation = read_cache.generation(key[0])
+		resp = read_cache.get(key)
+		if resp is None:
+			resp = await request.app["rpc"].call(dumps(query))
+			read_cache.put(key, resp, generation)
+	except QueryError as e:
+		logger.info(f"Bad read {e}")
+		return web.json_response({}, status=400)
+	# The worker already sent JSON, so pass it through without decoding it
+	return web.Response(text=resp, content_type="application/json")
+
+
+async def db_read_batch(request: web.Request) -> web.Response:
+	"""
+	returns, in order, the documents of each query's `collection` on its `filte`, see DBReadBatch in main.py
+	"""
+	args = await request.json()
+	try:
+		queries = [read_query(q) for q in args.get("queries") or []]
+	except QueryError as e:
+		logger.info(f"Bad read {e}")
+		return web.json_response({}, status=400)
+	incr_redis_count(amount=len(queries))
+
+	keys = [read_cache.key(query) for query in queries]
+	generations = [read_cache.generation(collection) for collection, _ in keys]
+	resps = [read_cache.get(key) for key in keys]
+
+	misses = [i for i, resp in enumerate(resps) if resp is None]
+	if misses:
+		query = dumps({"batch": [queries[i] for i in misses]})
+		try:
+			results = loads(await request.app["rpc"].call(query))
+			# A batch the worker couldn't run has no results to pair with the queries
+			if not isinstance(results, list) or len(results) != len(misses):
+				raise QueryError(f"Batch of {len(misses)} reads answered with {results}")
+		except QueryError as e:
+			logger.info(f"Bad read {e}")
+			return web.json_response({}, status=400)
+		for i, result in zip(misses, results):
+			resps[i] = dumps(result)
+			read_cache.put(keys[i], resps[i], generations[i])
+
+	# Cached responses are JSON already, so join them instead of decoding and re-encoding them
+	return web.Response(text=f"[{','.join(resps)}]", content_type="application/json")
+
+
+async def db_read_stream(request: web.Request) -> web.StreamResponse:
+	"""
+	returns documents from `collection` on query `filte` in chunks, see DBReadStream in main.py
+	"""
+	incr_redis_count()
+	try:
+		query = read_query(await request.json())
+		if "op" in query:
+			raise QueryError("Only find reads can be streamed")
+		chunks = request.app["rpc"].stream(dumps({**query, "stream": True}))
+		# Wait for the first chunk so that errors still get a 400
+		first = await chunks.__anext__()
+	except QueryError as e:
+		logger.info(f"Bad read {e}")
+		return web.json_response({}, status=400)
+
+	ndjson = request.query.get("format") == "ndjson"
+	resp = web.StreamResponse()
+	resp.content_type = "application/x-ndjson" if ndjson else "application/json"
+	resp.enable_chunked_encoding()
+	await resp.prepare(request)
+
+	if not ndjson:
+		await resp.write(b"[")
+	empty = True
+
+	async def write(chunk: str):
+		nonlocal empty
+		if ndjson:
+			await resp.write("".join(f"{dumps(document)}\n" for document in loads(chunk)).encode("utf-8"))
+			return
+		items = chunk.strip()[1:-1]
+		if items:
+			await resp.write((items if empty else f",{items}").encode("utf-8"))
+			empty = False
+
+	await write(first)
+	async for chunk in chunks:
+		await write(chunk)
+	if not ndjson:
+		await resp.write(b"]\n")
+	await resp.write_eof()
+	return resp
+
+
+async def db_write(request: web.Request) -> web.Response:
+	"""
+	performs `action` on `collection`, see DBWrite in main.py
+	"""
+	incr_redis_count(write_count_key)
+	try:
+		query = write_query(await request.json())
+	except QueryError as e:
+		logger.info(f"Bad write {e}")
+		return web.json_response({}, status=400)
+	try:
+		await push_to_Q(request.app, "writeQ", dumps(query))
+	finally:
+		read_cache.invalidate(query["collection"])
+	return web.json_response({}, status=201)
+
+
+async def db_write_batch(request: web.Request) -> web.Response:
+	"""
+	performs each of `writes` in order, see DBWriteBatch in main.py
+	"""
+	args = await request.json()
+	try:
+		writes = [write_query(w) for w in args.get("writes") or []]
+	except QueryError as e:
+		logger.info(f"Bad write {e}")
+		return web.json_response({}, status=400)
+	if not writes:
+		return web.json_response({}, status=201)
+	incr_redis_count(write_count_key, amount=len(writes))
+	try:
+		await push_to_Q(request.app, "writeQ", dumps({"batch": writes}))
+	finally:
+		for collection in {w["collection"] for w in writes}:
+			read_cache.invalidate(collection)
+	return web.json_response({}, status=201)
+
+
+async def db_clear(request: web.Request) -> web.Response:
+	"""
+	clears the users and rides collections from the database
+	"""
+	incr_redis_count(write_count_key)
+	query_rides = {"collection": "rides", "action": 2, "filte": {}}
+	query_users = {"collection": "users", "action": 2, "filte": {}}
+	try:
+		await push_to_Q(request.app, "writeQ", dumps({"batch": [query_rides, query_users]}))
+	finally:
+		read_cache.invalidate("rides")
+		read_cache.invalidate("users")
+	return web.json_response({})
+
+
+async def db_indexes(request: web.Request) -> web.Response:
+	"""
+	returns the indexes of `collection`, see DBIndexes in main.py
+	"""
+	collection = request.query.get("collection")
+	if not collection:
+		return web.json_response({}, status=400)
+	query = read_query({"collection": collection, "op": "indexes"})
+	key = read_cache.key(query)
+	generation = read_cache.generation(collection)
+	resp = read_cache.get(key)
+	if resp is None:
+		resp = await request.app["rpc"].call(dumps(query))
+		read_cache.put(key, resp, generation)
+	return web.Response(text=resp, content_type="application/json")
+
+
+async def db_build_index(request: web.Request) -> web.Response:
+	"""
+	builds an index on `keys` of `collection`, see DBIndexes in main.py
+	"""
+	try:
+		query = index_query(await request.json())
+	except QueryError as e:
+		logger.info(f"Bad index {e}")
+		return web.json_response({}, status=400)
+	incr_redis_count(write_count_key)
+	try:
+		await push_to_Q(request.app, "writeQ", dumps(query))
+	finally:
+		read_cache.invalidate(query["collection"])
+	return web.json_response({}, status=201)
+
+
+async def crash_slave(request: web.Request) -> web.Response:
+	"""
+	returns the PID of the slave killed
+	"""
+	# The lifecycle of the slaves is shared with main.py: it refills the standby pool and keeps the registry
+	# up to date, and runs off the event loop like the scaler
+	return web.json_response([await asyncio.get_event_loop().run_in_executor(None, kill_slave)])
+
+
+async def worker_list(request: web.Request) -> web.Response:
+	"""
+	returns a sorted array of all PIDs of the workers
+	"""
+	workers = await list_workers(request.app)
+	return web.json_response(sorted(w["pid"] for w in workers))
+
+
+async def worker_scaling(request: web.Request) -> web.Response:
+	"""
+	returns the last scaling decision, see Scaling in main.py
+	"""
+	return web.json_response(scaler.decision)
+
+
+@web.middleware
+async def log_request(request: web.Request, handler):
+	"""
+	Logs every request, and starts the autoscaler on the first one (like main.py's before_first_request)
+	"""
+	if not request.app["scaling"]:
+		request.app["scaling"] = True
+		scale_after(interval=scale_interval)
+	request_logger.info("A %s %s %s", request.path, request.method, request.headers)
+	return await handler(request)
+
+
+@web.middleware
+async def record_metrics(request: web.Request, handler):
+	"""
+	Records the latency, body sizes and server errors of every request, see instrument in metrics.py
+	"""
+	start = monotonic()
+	# The route, not the path, like Flask's url_rule
+	resource = request.match_info.route.resource
+	endpoint = resource.canonical if resource is not None else "unmatched"
+	status = 500
+	try:
+		response = await handler(request)
+		status = response.status
+		return response
+	except web.HTTPException as e:
+		status = e.status
+		raise
+	finally:
+		request_latency.labels(endpoint, request.method, status).observe(monotonic() - start)
+		payload_size.labels(endpoint, "in").observe(request.content_length or 0)
+		if status >= 500:
+			errors.labels(endpoint).inc()
+
+
+@web.middleware
+async def trace_request(request: web.Request, handler):
+	"""
+	Runs every request in a span, continuing the trace of its `traceparent` header if any,
+	see trace_requests in tracing.py
+	"""
+	trace_id, parent_id = parse_traceparent(request.headers.get("traceparent"))
+	s = Span(f"{request.method} {request.path}", trace_id, parent_id)
+	token = current_span.set(s)
+	try:
+		response = await handler(request)
+		s.attrs["status"] = response.status
+	except Exception as e:
+		s.end(e)
+		raise
+	else:
+		s.end()
+	finally:
+		current_span.reset(token)
+	return response
+
+
+async def metrics(request: web.Request) -> web.Response:
+	"""
+	returns the metrics in Prometheus text format
+	"""
+	return web.Response(body=generate_latest(), headers={"Content-Type": CONTENT_TYPE_LATEST})
+
+
+async def on_startup(app: web.Application):
+	app["redis"] = await aioredis.create_redis_pool(f"redis://{redis_host}")
+	app["amqp"] = await aio_pika.connect_robust(host=rmq_host)
+	app["channel"] = await app["amqp"].channel()
+	app["rpc"] = await AsyncRpcClient(app["channel"]).connect()
+	# Waits for the first load of the registry, off the event loop
+	app["registry"] = await asyncio.get_event_loop().run_in_executor(None, worker_registry)
+
+
+async def on_cleanup(app: web.Application):
+	await app["amqp"].close()
+	app["redis"].close()
+	await app["redis"].wait_closed()
+
+
+def create_app() -> web.Application:
+	app = web.Application(middlewares=[log_request, record_metrics, trace_request])
+	app["scaling"] = False
+	app.on_startup.append(on_startup)
+	app.on_cleanup.append(on_cleanup)
+	app.router.add_post(f"{db_url_prefix}/read", db_read)
+	app.router.add_post(f"{db_url_prefix}/read/batch", db_read_batch)
+	app.router.add_post(f"{db_url_prefix}/read/stream", db_read_stream)
+	app.router.add_post(f"{db_url_prefix}/write", db_write)
+	app.router.add_post(f"{db_url_prefix}/write/batch", db_write_batch)
+	app.router.add_post(f"{db_url_prefix}/clear", db_clear)
+	app.router.add_get(f"{db_url_prefix}/indexes", db_indexes)
+	app.router.add_post(f"{db_url_prefix}/indexes", db_build_index)
+	app.router.add_post(f"{crash_url_prefix}/slave", crash_slave)
+	app.router.add_get(f"{worker_url_prefix}/list", worker_list)
+	app.router.add_get(f"{worker_url_prefix}/scaling", worker_scaling)
+	app.router.add_get("/metrics", metrics)
+	return app
+
+
+app = create_app()
+
+if __name__ == "__main__":
+	# Outside gunicorn, nothing else starts the background threads
+	post_fork(None, None)
+	web.run_app(app, port=5000)
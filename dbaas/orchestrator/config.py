@@ -1,3 +1,59 @@
 redis_host = "redis"  # hostname of Redis container
 redis_key = "req_count"  # Key in Redis containing request count
+write_count_key = "write_count"  # Key in Redis containing write request count
+count_flush_interval = 0.5  # seconds request counts are buffered in process before being added in Redis
 rmq_host = "rabbitmq"  # hostname of RMQ container
+rmq_management_url = "http://rabbitmq:15672"  # RMQ management API
+rmq_management_auth = ("guest", "guest")  # credentials of the RMQ management API
+rmq_ready_timeout = 60  # seconds to keep retrying to connect to RMQ while it starts
+container_ready_timeout = 30  # seconds to wait for a spawned or killed container to change state
+ready_poll_interval = 0.1  # seconds between two readiness checks
+rpc_timeout = 30  # seconds to wait for a reply to a read query
+publisher_pool_size = 4  # channels kept open by the publisher
+publish_timeout = 30  # seconds to wait for a publisher confirm
+read_cache_size = 1024  # max number of read responses cached
+read_cache_settle = 1  # seconds after a write is published, and again after it is applied, during which reads of its collection are not cached
+read_cache_ttl = 30  # seconds a read response stays cached, bounding the staleness of an entry no invalidation caught
+read_ops = {"find", "count", "distinct", "aggregate", "indexes"}  # operations a read query may run
+# aggregation stages a read query may use; none of them write or read other collections
+aggregate_stages = {
+	"$match", "$project", "$addFields", "$unwind", "$group",
+	"$sort", "$skip", "$limit", "$count", "$sortByCount",
+}
+find_options = ["projection", "sort", "limit", "skip"]  # options a find read query may push down
+slave_read_concurrency = 4  # reads each slave runs in parallel
+slave_read_prefetch = 8  # reads RMQ may push to a slave before they are acked
+standby_slaves = 2  # slaves kept synced but not serving readQ, activated first on scale up
+standby_key = "standby_slaves"  # Key in Redis containing the set of standby slave names
+scale_workers = 8  # slaves spawned, activated or killed in parallel by a scale operation
+member_sync_interval = 60  # seconds between two reconciliations of the ReplSet members with the live slaves
+snapshot_interval = 300  # seconds between two data snapshots, taken by a standby slave, new slaves are seeded from
+snapshot_volume = "dbaas_snapshots"  # Docker volume holding the snapshot, mounted in every slave
+
+# Autoscaler
+scale_interval = 10  # seconds between two scaling decisions
+scaling_policies = ["requests", "queue", "latency"]  # policies the desired slave count is the max of
+min_slaves = 1
+max_slaves = 20
+scale_up_cooldown = 20  # seconds after a scaling action before scaling up again
+scale_down_cooldown = 120  # seconds after a scaling action before scaling down again
+scale_down_hysteresis = 1  # spare slaves tolerated before scaling down
+request_window = 120  # seconds of requests the requests policy sizes slaves for
+# reads per request_window one slave is sized for; scale along with slave_read_concurrency
+requests_per_slave = 20
+write_weight = 0.5  # read load one write causes on slaves (replication)
+backlog_per_slave = 2 * slave_read_prefetch  # readQ backlog per consumer one slave is sized for
+latency_window = 60  # seconds of read latencies kept
+target_p95_latency = 0.5  # seconds of p95 read latency above which slaves are added
+
+# Tracing
+service_name = "orchestrator"  # service spans are recorded under
+spans_file = "spans.jsonl"  # local collector file spans are appended to, one JSON object per line
+span_queue_size = 10000  # finished spans waiting to be written before new ones are dropped
+
+# Logging
+log_file = "orchestrator.log"  # file the logs of the service are written to, as JSON lines
+log_max_chars = 1000  # longest logged value, longer ones are truncated
+log_queue_size = 10000  # log records waiting to be written before new ones are dropped
+# fraction of the records below WARNING written per logger, others are written in full
+log_sample_rates = {"requests": 0.1}
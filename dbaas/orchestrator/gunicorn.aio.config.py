@@ -0,0 +1,20 @@
+from config import log_file
+# Server hook starting the background threads of each worker
+from hooks import post_fork
+from logs import setup_logging
+
+setup_logging(log_file)
+
+bind = "0.0.0.0:5000"
+backlog = 256
+
+workers = 1
+worker_class = "aiohttp.GunicornWebWorker"
+
+timeout = 30
+keepalive = 2
+
+accesslog = "orchestrator-access.log"
+errorlog = "orchestrator-error.log"
+loglevel = "info"
+spew = False
@@ -1,4 +1,6 @@
-from utils import logger
+# Server hook starting the background threads of each worker
+from hooks import post_fork
+from utils import request_logger
 
 bind = "0.0.0.0:5000"
 backlog = 256
@@ -19,4 +21,4 @@ spew = False
 
 def pre_request(worker, req):
 	if req.path != "/":
-		logger.info(f"G {req.path} {req.method} {req.headers}")
+		request_logger.info("G %s %s %s", req.path, req.method, req.headers)
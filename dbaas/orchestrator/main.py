@@ -3,18 +3,26 @@
 	main.py: python file containing the orchestrator API logic
 """
 
+from itertools import chain
 from json import dumps, loads
-from typing import Any, List
+from typing import Any, Iterator, List
 
-from flask import Flask, request
+from flask import Flask, Response, request
 from flask_restful import Api, Resource, reqparse
 
-from utils import (ReadRpcClient, incr_redis_count, kill_slave, logger,
-                   push_to_Q, scale_after, worker_pids)
+from config import scale_interval, write_count_key
+from metrics import instrument
+from scaling import scale_after, scaler
+from tracing import trace_requests
+from utils import (QueryError, incr_redis_count, index_query, kill_slave,
+                   logger, publisher, push_to_Q, read_cache, read_query,
+                   read_rpc_client, worker_pids, write_query)
 
 # Flask RESTful Setup
 app = Flask(__name__)
 api = Api(app)
+instrument(app)
+trace_requests(app)
 
 # Paths for API endpoints
 url_prefix = "/api/v1"
@@ -29,6 +37,51 @@ parser.add_argument("action", type=int)
 parser.add_argument("document", type=dict)
 parser.add_argument("filte", type=dict)
 parser.add_argument("update", type=dict)
+parser.add_argument("op", type=str)
+parser.add_argument("key", type=str)
+parser.add_argument("pipeline", type=dict, action="append")
+parser.add_argument("projection", type=dict)
+# Each [field, direction] pair is an item: a list `type` alone would keep only the first pair
+parser.add_argument("sort", type=list, action="append")
+parser.add_argument("limit", type=int)
+parser.add_argument("skip", type=int)
+
+# Arguments of the index endpoint
+index_parser = reqparse.RequestParser()
+index_parser.add_argument("collection", type=str)
+index_parser.add_argument("keys", type=list, action="append")
+index_parser.add_argument("unique", type=bool)
+index_parser.add_argument("name", type=str)
+
+# Arguments of the batched write endpoint
+write_batch_parser = reqparse.RequestParser()
+write_batch_parser.add_argument("writes", type=dict, action="append", default=[])
+
+# Arguments of the batched read endpoint
+batch_parser = reqparse.RequestParser()
+batch_parser.add_argument("queries", type=dict, action="append", default=[])
+
+
+def json_array(chunks: Iterator[str]) -> Iterator[str]:
+	"""
+	Joins streamed chunks (JSON arrays) into one JSON array, without decoding them
+	"""
+	yield "["
+	first = True
+	for chunk in chunks:
+		items = chunk.strip()[1:-1]
+		if items:
+			yield items if first else f",{items}"
+			first = False
+	yield "]\n"
+
+
+def ndjson(chunks: Iterator[str]) -> Iterator[str]:
+	"""
+	Turns streamed chunks (JSON arrays) into newline delimited JSON, one document per line
+	"""
+	for chunk in chunks:
+		yield "".join(f"{dumps(document)}\n" for document in loads(chunk))
 
 
 @app.before_first_request
@@ -36,15 +89,20 @@ def start_daemon():
 	"""
 	Start autoscale timer right after the first request is received.
 	"""
-	# Autoscale the slave containers based on the requests every 2 minutes.
-	scale_after(interval=120)
+	# Autoscale the slave containers based on the load every `scale_interval` seconds.
+	scale_after(interval=scale_interval)
 
 
 class DBRead(Resource):
 	def post(self) -> Any:
 		"""
 		summary: endpoint for DB read operations
-		description: returns documents from `collection` on query `filte`
+		description:
+			- on `op` = find (default), returns documents from `collection` on query `filte`,
+				with the fields in `projection`, ordered by `sort`, skipping `skip` and returning at most `limit` of them
+			- on `op` = count, returns the number of documents from `collection` on query `filte`
+			- on `op` = distinct, returns the distinct values of `key` in `collection` on query `filte`
+			- on `op` = aggregate, returns the result of `pipeline` on `collection`, run after matching query `filte`
 		path: /api/v1/db/read
 		method: post
 		requestBody:
@@ -55,6 +113,32 @@ class DBRead(Resource):
 					type: string
 				filte:
 					type: object
+				op:
+					type: string
+					enum:
+						- find
+						- count
+						- distinct
+						- aggregate
+				key:
+					type: string
+				pipeline:
+					type: array
+					items:
+						type: object
+						description: aggregation stage, one of $match, $project, $addFields, $unwind, $group, $sort, $skip, $limit, $count, $sortByCount
+				projection:
+					type: object
+					description: fields to include (1) or exclude (0)
+				sort:
+					type: array
+					items:
+						type: array
+						description: field and direction (1 or -1)
+				limit:
+					type: integer
+				skip:
+					type: integer
 			required:
 				- collection
 				- filte
@@ -68,17 +152,137 @@ class DBRead(Resource):
 		"""
 		# Increase Read API request count in Redis
 		incr_redis_count()
-		logger.debug(request.get_json())
+		logger.debug("Body %s", request.get_json())
 		# Fetch request body into a dict-like object
 		args = parser.parse_args()
-		# Build query to be sent to DB Worker
-		query = dumps({"collection": args["collection"], "filte": args["filte"]})
-		# Send query to readQ, and fetch the result sent back to respQ
-		resp = ReadRpcClient().call(query)
+		try:
+			# Build query to be sent to DB Worker
+			query = read_query(args)
+			# Serve from cache, else send query to readQ and fetch the result sent back by the worker
+			resp = read_cache.get_or_load(query, lambda: read_rpc_client().call(dumps(query)))
+		except QueryError as e:
+			logger.info(f"Bad read {e}")
+			return {}, 400
 		# Return response as a python object
 		return loads(resp), 200
 
 
+class DBReadBatch(Resource):
+	def post(self) -> List[Any]:
+		"""
+		summary: endpoint for batched DB read operations
+		description:
+			returns, in order, the documents of each query's `collection` on its `filte`
+			queries not answered by the read cache are sent to a single worker as one message
+		path: /api/v1/db/read/batch
+		method: post
+		requestBody:
+			content: application/json
+			type: object
+			arguments:
+				queries:
+					type: array
+					items:
+						type: object
+						description: body of a /api/v1/db/read request
+			required:
+				- queries
+		responses:
+			200:
+				description: OK
+				content: application/json
+				type: array
+			400:
+				description: Bad Request
+		"""
+		logger.debug("Body %s", request.get_json())
+		# Fetch request body into a dict-like object
+		args = batch_parser.parse_args()
+		try:
+			queries = [read_query(q) for q in args["queries"]]
+		except QueryError as e:
+			logger.info(f"Bad read {e}")
+			return {}, 400
+		# Increase Read API request count in Redis by the number of reads
+		incr_redis_count(amount=len(queries))
+
+		keys = [read_cache.key(query) for query in queries]
+		generations = [read_cache.generation(collection) for collection, _ in keys]
+		resps = [read_cache.get(key) for key in keys]
+
+		# Send the queries the cache couldn't answer to readQ in one message
+		misses = [i for i, resp in enumerate(resps) if resp is None]
+		if misses:
+			query = dumps({"batch": [queries[i] for i in misses]})
+			try:
+				results = loads(read_rpc_client().call(query))
+				# A batch the worker couldn't run has no results to pair with the queries
+				if not isinstance(results, list) or len(results) != len(misses):
+					raise QueryError(f"Batch of {len(misses)} reads answered with {results}")
+			except QueryError as e:
+				logger.info(f"Bad read {e}")
+				return {}, 400
+			for i, result in zip(misses, results):
+				resps[i] = dumps(result)
+				read_cache.put(keys[i], resps[i], generations[i])
+
+		# Return responses as python objects
+		return [loads(resp) for resp in resps], 200
+
+
+class DBReadStream(Resource):
+	def post(self) -> Response:
+		"""
+		summary: endpoint for streamed DB read operations
+		description:
+			returns documents from `collection` on query `filte`, like a find on /api/v1/db/read
+			the worker sends the documents in chunks, which are relayed to the client as they arrive
+			so that the memory used stays bounded whatever the number of documents
+		path: /api/v1/db/read/stream
+		method: post
+		parameters:
+			- format:
+				type: string
+				in: query
+				enum:
+					- json
+					- ndjson
+				description: a JSON array (default), or one JSON document per line
+		requestBody:
+			content: application/json
+			type: object
+			description: body of a find /api/v1/db/read request
+		responses:
+			200:
+				description: OK, chunked
+				content:
+					- application/json
+					- application/x-ndjson
+				type: array
+			400:
+				description: Bad Request
+		"""
+		# Increase Read API request count in Redis
+		incr_redis_count()
+		logger.debug("Body %s", request.get_json())
+		# Fetch request body into a dict-like object
+		args = parser.parse_args()
+		try:
+			query = read_query(args)
+			if "op" in query:
+				raise QueryError("Only find reads can be streamed")
+			# Send query to readQ, and wait for the first chunk so that errors still get a 400
+			chunks = read_rpc_client().stream(dumps({**query, "stream": True}))
+			chunks = chain([next(chunks)], chunks)
+		except QueryError as e:
+			logger.info(f"Bad read {e}")
+			return {}, 400
+
+		if request.args.get("format") == "ndjson":
+			return Response(ndjson(chunks), mimetype="application/x-ndjson")
+		return Response(json_array(chunks), mimetype="application/json")
+
+
 class DBWrite(Resource):
 	def post(self) -> dict:
 		"""
@@ -87,6 +291,7 @@ class DBWrite(Resource):
 			- on `action` = 0, inserts `document` into `collection`
 			- on `action` = 1, performs `update` on all documents from `collection` where query `filte`
 			- on `action` = 2, deletes all documents from `collection` where query `filte`
+			- on `action` = 3, builds the index `document` describes, as the body of POST /api/v1/db/indexes does
 		path: /api/v1/db/write
 		method: post
 		requestBody:
@@ -101,6 +306,7 @@ class DBWrite(Resource):
 						- 0
 						- 1
 						- 2
+						- 3
 				filte:
 					type: object
 				document:
@@ -116,13 +322,67 @@ class DBWrite(Resource):
 			201: Write Performed
 			400: Bad Request
 		"""
-		logger.debug(request.get_json())
+		# Increase Write API request count in Redis
+		incr_redis_count(write_count_key)
+		logger.debug("Body %s", request.get_json())
 		# Fetch request body into a dict-like object
 		args = parser.parse_args()
 		# Build query to be sent to DB Worker
-		query = dumps(args)
-		# Send query to writeQ
-		push_to_Q("writeQ", query)
+		try:
+			query = write_query(args)
+		except QueryError as e:
+			logger.info(f"Bad write {e}")
+			return {}, 400
+		# Send query to writeQ, cached reads of the collection are stale after that (even if it failed midway)
+		try:
+			push_to_Q("writeQ", dumps(query))
+		finally:
+			read_cache.invalidate(query["collection"])
+		return {}, 201
+
+
+class DBWriteBatch(Resource):
+	def post(self) -> dict:
+		"""
+		summary: endpoint for batched DB write operations
+		description:
+			performs each of `writes` in order, as described for /api/v1/db/write
+			the writes are sent to the master as one message
+		path: /api/v1/db/write/batch
+		method: post
+		requestBody:
+			content: application/json
+			type: object
+			arguments:
+				writes:
+					type: array
+					items:
+						type: object
+						description: body of a /api/v1/db/write request
+			required:
+				- writes
+		responses:
+			201: Writes Performed
+			400: Bad Request
+		"""
+		logger.debug("Body %s", request.get_json())
+		# Fetch request body into a dict-like object
+		args = write_batch_parser.parse_args()
+		try:
+			writes = [write_query(w) for w in args["writes"]]
+		except QueryError as e:
+			logger.info(f"Bad write {e}")
+			return {}, 400
+		if not writes:
+			return {}, 201
+		# Increase Write API request count in Redis by the number of writes
+		incr_redis_count(write_count_key, amount=len(writes))
+		# Send all writes to writeQ in one message, cached reads of their collections are stale after that
+		try:
+			push_to_Q("writeQ", dumps({"batch": writes}))
+		finally:
+			for collection in {w["collection"] for w in writes}:
+				read_cache.invalidate(collection)
 		return {}, 201
 
 
@@ -137,15 +397,113 @@ class DBClear(Resource):
 		response:
 			200: OK
 		"""
+		# Increase Write API request count in Redis
+		incr_redis_count(write_count_key)
 		# Build queries to be sent to DB Worker
-		query_rides = dumps({"collection": "rides", "action": 2, "filte": {}})
-		query_users = dumps({"collection": "users", "action": 2, "filte": {}})
-		# Send queries to writeQ
-		push_to_Q("writeQ", query_rides)
-		push_to_Q("writeQ", query_users)
+		query_rides = {"collection": "rides", "action": 2, "filte": {}}
+		query_users = {"collection": "users", "action": 2, "filte": {}}
+		# Send queries to writeQ in one message, cached reads of both collections are stale after that
+		try:
+			push_to_Q("writeQ", dumps({"batch": [query_rides, query_users]}))
+		finally:
+			read_cache.invalidate("rides")
+			read_cache.invalidate("users")
 		return {}, 200
 
 
+class DBIndexes(Resource):
+	def get(self) -> List[dict]:
+		"""
+		summary: endpoint for listing the indexes of a collection
+		description: returns the indexes of `collection`, as listed by a slave
+		path: /api/v1/db/indexes
+		method: get
+		parameters:
+			- collection:
+				type: string
+				in: query
+				required: true
+		responses:
+			200:
+				description: OK
+				content: application/json
+				type: array
+				items:
+					type: object
+			400:
+				description: Bad Request
+		"""
+		collection = request.args.get("collection")
+		if not collection:
+			return {}, 400
+		query = read_query({"collection": collection, "op": "indexes"})
+		resp = read_cache.get_or_load(query, lambda: read_rpc_client().call(dumps(query)))
+		return loads(resp), 200
+
+	def post(self) -> dict:
+		"""
+		summary: endpoint for building an index
+		description:
+			builds an index on `keys` of `collection` on the master, from where it replicates to the slaves
+			the index is built after the writes already queued, and this returns once the build is queued
+		path: /api/v1/db/indexes
+		method: post
+		requestBody:
+			content: application/json
+			type: object
+			arguments:
+				collection:
+					type: string
+				keys:
+					type: array
+					items:
+						type: array
+						description: field and direction (1 or -1)
+				unique:
+					type: boolean
+				name:
+					type: string
+			required:
+				- collection
+				- keys
+		responses:
+			201: Index Build Queued
+			400: Bad Request
+		"""
+		logger.debug("Body %s", request.get_json())
+		# Fetch request body into a dict-like object
+		args = index_parser.parse_args()
+		try:
+			query = index_query(args)
+		except QueryError as e:
+			logger.info(f"Bad index {e}")
+			return {}, 400
+		# Increase Write API request count in Redis
+		incr_redis_count(write_count_key)
+		# Send query to writeQ, cached index listings of the collection are stale after that
+		try:
+			push_to_Q("writeQ", dumps(query))
+		finally:
+			read_cache.invalidate(query["collection"])
+		return {}, 201
+
+
+class DBStats(Resource):
+	def get(self) -> dict:
+		"""
+		summary: endpoint for DB client statistics
+		description: returns counts and latencies of the publisher used for writes, and read cache counters
+		path: /api/v1/db/stats
+		method: get
+		response:
+			200:
+				description: OK
+				content: application/json
+				type: object
+		"""
+		return {"publisher": publisher().stats(), "read_cache": read_cache.stats()}, 200
+
+
 class CrashSlave(Resource):
 	def post(self) -> List[int]:
 		"""
@@ -182,11 +540,35 @@ class Worker(Resource):
 		return worker_pids(), 200
 
 
+class Scaling(Resource):
+	def get(self) -> dict:
+		"""
+		summary: endpoint for the last scaling decision
+		description:
+			returns the load metrics of the last scaling decision, the number of slaves each policy wanted,
+			the target number of slaves and the action taken (up, down, hold or cooldown)
+		path: /api/v1/worker/scaling
+		method: get
+		response:
+			200:
+				description: OK
+				content: application/json
+				type: object
+		"""
+		return scaler.decision, 200
+
+
 api.add_resource(DBRead, f"{db_url_prefix}/read")
+api.add_resource(DBReadBatch, f"{db_url_prefix}/read/batch")
+api.add_resource(DBReadStream, f"{db_url_prefix}/read/stream")
 api.add_resource(DBWrite, f"{db_url_prefix}/write")
+api.add_resource(DBWriteBatch, f"{db_url_prefix}/write/batch")
 api.add_resource(DBClear, f"{db_url_prefix}/clear")
+api.add_resource(DBIndexes, f"{db_url_prefix}/indexes")
+api.add_resource(DBStats, f"{db_url_prefix}/stats")
 api.add_resource(CrashSlave, f"{crash_url_prefix}/slave")
 api.add_resource(Worker, f"{worker_url_prefix}/list")
+api.add_resource(Scaling, f"{worker_url_prefix}/scaling")
 
 
 if __name__ == "__main__":
@@ -0,0 +1,209 @@
+"""
+	RideShare (Cloud Computing Project)
+	scaling.py: autoscaler of the slave containers, a policy engine over load metrics
+"""
+
+import threading
+from abc import ABC, abstractmethod
+from collections import deque
+from math import ceil
+from time import monotonic, time
+from typing import Dict, List, Optional
+
+from config import (backlog_per_slave, max_slaves, member_sync_interval,
+                    min_slaves, redis_key, request_window, requests_per_slave,
+                    scale_down_cooldown, scale_down_hysteresis, scale_interval,
+                    scale_up_cooldown, scaling_policies, snapshot_interval,
+                    target_p95_latency, write_count_key, write_weight)
+from utils import (fill_standby, get_redis_count, list_slaves, list_standby,
+                   logger, queue_stats, read_latency, request_snapshot,
+                   scale_down, scale_up, sync_members)
+
+
+class RequestWindow:
+	"""
+	Samples an ever growing request counter in Redis,
+	to tell how many requests were counted in the last `window` seconds
+	"""
+	def __init__(self, key: str, window: float = request_window):
+		self.key = key
+		self.window = window
+		self.samples = deque()
+
+	def count(self, now: float) -> int:
+		"""
+		Samples the counter and returns its increase over the window
+		"""
+		total = get_redis_count(self.key)
+		# The counter was reset, older samples are meaningless
+		if self.samples and total < self.samples[-1][1]:
+			self.samples.clear()
+		self.samples.append((now, total))
+		# Keep the newest sample taken at or before the start of the window
+		while len(self.samples) > 1 and self.samples[1][0] <= now - self.window:
+			self.samples.popleft()
+		return total - self.samples[0][1]
+
+
+class ScalingPolicy(ABC):
+	"""
+	Base class of scaling policies.
+	desired() returns the number of slaves the policy wants for `metrics`, or None when it has no opinion
+	"""
+	name = ""
+
+	@abstractmethod
+	def desired(self, metrics: dict) -> Optional[int]:
+		pass
+
+
+class RequestsPolicy(ScalingPolicy):
+	"""
+	One slave per `requests_per_slave` requests in the request window, writes weighted by `write_weight`
+	"""
+	name = "requests"
+
+	def desired(self, metrics: dict) -> Optional[int]:
+		load = metrics["reads"] + write_weight * metrics["writes"]
+		return ceil(load / requests_per_slave)
+
+
+class QueuePolicy(ScalingPolicy):
+	"""
+	Sizes the slaves so that each consumer of readQ has `backlog_per_slave` reads waiting in,
+	or consumed but not acked from, readQ: the slaves grow or shrink with the backlog per consumer.
+	Has no opinion while nothing consumes readQ
+	"""
+	name = "queue"
+
+	def desired(self, metrics: dict) -> Optional[int]:
+		queue = metrics["queue"]
+		if queue is None or not queue["consumers"]:
+			return None
+		per_consumer = (queue["ready"] + queue["unacked"]) / queue["consumers"]
+		return ceil(max(metrics["slaves"], 1) * per_consumer / backlog_per_slave)
+
+
+class LatencyPolicy(ScalingPolicy):
+	"""
+	Grows the slaves in proportion to how far the p95 read latency is above `target_p95_latency`,
+	at most doubling them; has no opinion while the latency is on target
+	"""
+	name = "latency"
+
+	def desired(self, metrics: dict) -> Optional[int]:
+		p95 = metrics["p95_latency"]
+		if p95 is None or p95 <= target_p95_latency:
+			return None
+		slaves = max(metrics["slaves"], 1)
+		return min(ceil(slaves * p95 / target_p95_latency), 2 * slaves)
+
+
+# Policies available to scaling_policies in config.py, by name
+policies = {policy.name: policy for policy in [RequestsPolicy, QueuePolicy, LatencyPolicy]}
+
+
+class ScalingEngine:
+	"""
+	Sizes the slaves to the max of what its policies want, within [min_slaves, max_slaves].
+	Scaling up waits `scale_up_cooldown` seconds after the last action; scaling down waits
+	`scale_down_cooldown` seconds, and only happens with more than `scale_down_hysteresis` spare slaves
+	"""
+	def __init__(self, policies: List[ScalingPolicy]):
+		self.policies = policies
+		self.reads = RequestWindow(redis_key)
+		self.writes = RequestWindow(write_count_key)
+		self.last_action = None
+		self.last_sync = None
+		# Time (epoch) and taker of the last snapshot requested
+		self.snapshot: Dict = {}
+		self.decision: Dict = {}
+		self.lock = threading.Lock()
+
+	def metrics(self, now: float) -> dict:
+		"""
+		Gathers the load metrics the policies decide on
+		"""
+		return {
+			"slaves": len(list_slaves()),
+			"standby": len(list_standby()),
+			"reads": self.reads.count(now),
+			"writes": self.writes.count(now),
+			"queue": queue_stats("readQ"),
+			"p95_latency": read_latency.percentile(95),
+		}
+
+	def decide(self, metrics: dict, now: float) -> dict:
+		"""
+		Returns the scaling decision for `metrics`: the slaves each policy wants,
+		the bounded target and the action to take (up, down, hold or cooldown)
+		"""
+		current = metrics["slaves"]
+		wants = {policy.name: policy.desired(metrics) for policy in self.policies}
+		desired = max((want for want in wants.values() if want is not None), default=current)
+		target = min(max(desired, min_slaves), max_slaves)
+
+		since = now - self.last_action if self.last_action is not None else float("inf")
+		if target > current:
+			action = "up" if since >= scale_up_cooldown else "cooldown"
+		elif target < current - scale_down_hysteresis or current > max_slaves:
+			action = "down" if since >= scale_down_cooldown else "cooldown"
+		else:
+			action = "hold"
+
+		return {"current": current, "policies": wants, "desired": desired, "target": target, "action": action}
+
+	def tick(self):
+		"""
+		Takes one scaling decision and acts on it
+		"""
+		with self.lock:
+			now = monotonic()
+			metrics = self.metrics(now)
+			decision = self.decide(metrics, now)
+			logger.info(f"Scaling {decision}")
+
+			if decision["action"] == "up":
+				scale_up(decision["target"] - decision["current"])
+				self.last_action = monotonic()
+			elif decision["action"] == "down":
+				scale_down(decision["current"] - decision["target"])
+				self.last_action = monotonic()
+			else:
+				# Replace standby slaves that died or were activated by a crash
+				fill_standby()
+
+			self.decision = {**decision, "metrics": metrics, "snapshot": self.snapshot, "time": time()}
+
+			# Drop ReplSet members of slaves that died without being destroyed by a scale operation
+			if self.last_sync is None or now - self.last_sync >= member_sync_interval:
+				sync_members()
+				self.last_sync = now
+
+			# Keep the snapshot new slaves are seeded from recent, so they have little oplog to catch up on
+			if time() - self.snapshot.get("requested_at", 0) >= snapshot_interval:
+				taker = request_snapshot()
+				if taker is not None:
+					self.snapshot = {"requested_at": time(), "taker": taker}
+
+
+scaler = ScalingEngine([policies[name]() for name in scaling_policies])
+
+
+def scale_daemon():
+	"""
+	Takes a scaling decision every `scale_interval` seconds
+	"""
+	# call this function after another `scale_interval` seconds
+	scale_after(scale_interval)
+	try:
+		scaler.tick()
+	except Exception as e:
+		logger.error(f"Error while scaling. {e}")
+
+
+def scale_after(interval: int):
+	"""
+	Calls the scaler after `interval` seconds on a separate thread
+	"""
+	threading.Timer(interval, scale_daemon).start()
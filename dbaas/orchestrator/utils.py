@@ -5,25 +5,42 @@
 
 import logging
 import threading
+from collections import OrderedDict, deque
+from concurrent.futures import Future, ThreadPoolExecutor
 from contextlib import contextmanager
-from math import ceil
-from time import sleep
-from typing import List
+from functools import partial
+from itertools import count
+from json import dumps, loads
+from queue import Empty, Queue
+from time import monotonic, sleep, time
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
 from uuid import uuid4
 
 import docker
 import pika
 import redis
+import requests
 
-from config import redis_host, redis_key, rmq_host
+from config import (aggregate_stages, container_ready_timeout,
+                    find_options, latency_window, log_file,
+                    publish_timeout, publisher_pool_size,
+                    read_cache_settle, read_cache_size, read_cache_ttl,
+                    read_ops,
+                    ready_poll_interval, redis_host, redis_key, rmq_host,
+                    rmq_management_auth, rmq_management_url,
+                    rmq_ready_timeout, rpc_timeout, scale_workers,
+                    slave_read_concurrency, slave_read_prefetch,
+                    snapshot_volume, standby_key, standby_slaves)
+from counter import request_counter
+from logs import setup_logging
+from metrics import errors, hop_latency, hop_timer
+from tracing import span, trace_headers
 
 # ## Logger
-logging.basicConfig(
-	level=logging.INFO,
-	format="%(asctime)s %(levelname)-8s %(message)s",
-	filename="orchestrator.log",
-)
+setup_logging(log_file)
 logger = logging.getLogger()
+# Logs every request, sampled (see log_sample_rates)
+request_logger = logging.getLogger("requests")
 
 # ## Redis
 # Connect to Redis
@@ -36,14 +53,9 @@ def get_redis_count(redis_key: str = redis_key) -> int:
 	return int(r.get(redis_key) or 0)
 
 
-def incr_redis_count(redis_key: str = redis_key) -> int:
-	# Increments `redis_key` by 1 if it exists, else sets it to 1
-	return r.incr(redis_key)
-
-
-def reset_redis_count(redis_key: str = redis_key) -> int:
-	# Deletes `redis_key` and returns 1 if it exists, else 0
-	return r.delete(redis_key)
+def incr_redis_count(redis_key: str = redis_key, amount: int = 1):
+	# Increments `redis_key` by `amount`, buffered in process and flushed to Redis in the background
+	request_counter.incr(redis_key, amount)
 
 
 # ## UUID
@@ -54,16 +66,119 @@ def new_uuid() -> str:
 	return str(uuid4())
 
 
+# ## Queries
+class QueryError(Exception):
+	"""
+	Raised when a query is invalid, or the worker could not run it
+	"""
+
+
+def read_query(args: dict) -> dict:
+	"""
+	Returns the read query for the arguments of one read, raises QueryError if they are invalid.
+	Optional arguments are only included when used, so plain reads keep their original shape
+	"""
+	query = {"collection": args.get("collection"), "filte": args.get("filte")}
+
+	op = args.get("op") or "find"
+	if op not in read_ops:
+		raise QueryError(f"Unknown read op {op}")
+	if op != "find":
+		query["op"] = op
+
+	if op == "distinct":
+		if not args.get("key"):
+			raise QueryError("distinct needs a key")
+		query["key"] = args["key"]
+
+	if op == "aggregate":
+		pipeline = args.get("pipeline") or []
+		for stage in pipeline:
+			if len(stage) != 1 or not set(stage) <= aggregate_stages:
+				raise QueryError(f"Aggregation stage not allowed {stage}")
+		query["pipeline"] = pipeline
+
+	# Options pushed down into find
+	projection, sort, limit, skip = (args.get(arg) for arg in find_options)
+	if op != "find" and any(arg is not None for arg in (projection, sort, limit, skip)):
+		raise QueryError(f"{', '.join(find_options)} only apply to find")
+	if projection is not None:
+		if not isinstance(projection, dict) or not set(projection.values()) <= {0, 1}:
+			raise QueryError(f"Bad projection {projection}")
+		# Mongo takes fields to include or fields to exclude, only _id can be excluded from an inclusion
+		if len({value for field, value in projection.items() if field != "_id"}) > 1:
+			raise QueryError(f"Projection mixes inclusion and exclusion {projection}")
+		query["projection"] = projection
+	if sort is not None:
+		if not isinstance(sort, list) or not all(
+			isinstance(s, list) and len(s) == 2 and isinstance(s[0], str) and s[1] in (1, -1) for s in sort
+		):
+			raise QueryError(f"Bad sort {sort}")
+		query["sort"] = sort
+	for arg, value in (("limit", limit), ("skip", skip)):
+		if value is not None:
+			if not isinstance(value, int) or value < 0:
+				raise QueryError(f"Bad {arg} {value}")
+			query[arg] = value
+
+	return query
+
+
+def index_query(args: dict) -> dict:
+	"""
+	Returns the write query building the index described by `args`, raises QueryError if it is invalid
+	"""
+	keys = args.get("keys")
+	if not args.get("collection") or not isinstance(keys, list) or not keys or not all(
+		isinstance(k, list) and len(k) == 2 and isinstance(k[0], str) and k[1] in (1, -1) for k in keys
+	):
+		raise QueryError(f"Bad index {args}")
+	document = {"keys": keys}
+	if args.get("unique"):
+		document["unique"] = True
+	if args.get("name"):
+		document["name"] = args["name"]
+	return {"collection": args["collection"], "action": 3, "document": document}
+
+
+def write_query(args: dict) -> dict:
+	"""
+	Returns the write query for the arguments of one write, shaped like the body DBWrite sends,
+	raises QueryError if it is an invalid index build
+	"""
+	query = {arg: args.get(arg) for arg in ["collection", "action", "document", "filte", "update"]}
+	if query["action"] is not None:
+		query["action"] = int(query["action"])
+	if query["action"] == 3:
+		# Index builds are validated like those of /api/v1/db/indexes, the master would run any
+		document = query["document"] if isinstance(query["document"], dict) else {}
+		return index_query({**document, "collection": query["collection"]})
+	return query
+
+
 # ## RMQ
+def rmq_connection(rmq_host=rmq_host, timeout: float = rmq_ready_timeout) -> pika.BlockingConnection:
+	"""
+	Connects to RMQ, retrying until the broker accepts the connection or `timeout` seconds have passed
+	"""
+	deadline = monotonic() + timeout
+	while True:
+		try:
+			return pika.BlockingConnection(pika.ConnectionParameters(host=rmq_host, heartbeat=0))
+		except pika.exceptions.AMQPConnectionError as e:
+			if monotonic() >= deadline:
+				raise
+			logger.info(f"Waiting for RMQ. {e}")
+			sleep(ready_poll_interval)
+
+
 @contextmanager
 def rabbit_channel(rmq_host=rmq_host):
 	"""
 	Connects to RMQ, generates a channel and closes the connection when processing is done
 	"""
+	connection = rmq_connection(rmq_host)
 	try:
-		connection = pika.BlockingConnection(
-			pika.ConnectionParameters(host=rmq_host, heartbeat=0)
-		)
 		yield connection.channel()
 	except Exception as e:
 		logger.error(f"Error connecting to RMQ. {e}")
@@ -82,185 +197,900 @@ with rabbit_channel() as rmq_channel:
 			logger.error(f"Error while declaring queue {q_name}. {e}")
 
 
+class Publisher:
+	"""
+	Process-wide pooled publisher.
+	Keeps one RMQ connection with a pool of confirm-mode channels open on a background IO loop.
+	Each publish resolves once the broker confirms it, and as the broker acks many deliveries
+	in a single frame, confirms get batched across concurrent requests
+	"""
+	def __init__(self, rmq_host=rmq_host, pool_size=publisher_pool_size):
+		"""
+		Start the IO thread owning the RMQ connection and its channels
+		"""
+		self.parameters = pika.ConnectionParameters(host=rmq_host, heartbeat=0)
+		self.pool_size = pool_size
+		self.connection = None
+		self.channels = []
+		self.turn = 0
+		self.ready = threading.Event()
+		# channel_number -> last delivery tag used on that channel
+		self.delivery_tags: Dict[int, int] = {}
+		# channel_number -> {delivery tag: (Future, publish time)}
+		self.unconfirmed: Dict[int, Dict[int, Tuple[Future, float]]] = {}
+		self.counts = {"published": 0, "confirmed": 0, "nacked": 0, "failed": 0}
+		self.outstanding = 0
+		self.latency_total = 0.0
+		self.latency_max = 0.0
+		threading.Thread(target=self.run, daemon=True).start()
+
+	def run(self):
+		"""
+		Runs the IO loop forever, reconnecting if the connection drops.
+		Only this thread touches the connection, other threads hand work over via add_callback_threadsafe
+		"""
+		while True:
+			self.connection = pika.SelectConnection(
+				self.parameters,
+				on_open_callback=self.on_connection_open,
+				on_open_error_callback=self.on_connection_closed,
+				on_close_callback=self.on_connection_closed,
+			)
+			self.connection.ioloop.start()
+			sleep(1)
+
+	def on_connection_open(self, connection):
+		"""
+		Opens the channel pool
+		"""
+		for _ in range(self.pool_size):
+			connection.channel(on_open_callback=self.on_channel_open)
+
+	def on_connection_closed(self, connection, error):
+		"""
+		Fails everything in flight and stops the IO loop, so that run() reconnects
+		"""
+		logger.error(f"Publisher lost RMQ connection. {error}")
+		self.ready.clear()
+		for channel in self.channels:
+			self.fail_unconfirmed(channel.channel_number, error)
+		self.channels = []
+		connection.ioloop.stop()
+
+	def on_channel_open(self, channel):
+		"""
+		Puts a freshly opened channel in confirm mode
+		"""
+		channel.add_on_close_callback(self.on_channel_closed)
+		channel.confirm_delivery(
+			ack_nack_callback=partial(self.on_confirm, channel.channel_number),
+			callback=lambda frame: self.on_confirm_mode(channel),
+		)
+
+	def on_confirm_mode(self, channel):
+		"""
+		Adds a channel to the pool once the broker has switched it to confirm mode
+		"""
+		self.delivery_tags[channel.channel_number] = 0
+		self.unconfirmed[channel.channel_number] = {}
+		self.channels.append(channel)
+		self.ready.set()
+
+	def on_channel_closed(self, channel, reason):
+		"""
+		Drops a closed channel from the pool and replaces it while the connection is up
+		"""
+		if channel in self.channels:
+			self.channels.remove(channel)
+		self.fail_unconfirmed(channel.channel_number, reason)
+		if self.connection.is_open:
+			self.connection.channel(on_open_callback=self.on_channel_open)
+
+	def fail_unconfirmed(self, channel_number: int, reason):
+		"""
+		Fails all publishes on a channel that can no longer be confirmed
+		"""
+		for future, _ in self.unconfirmed.pop(channel_number, {}).values():
+			self.outstanding -= 1
+			self.counts["failed"] += 1
+			future.set_exception(ConnectionError(f"RMQ channel closed. {reason}"))
+
+	def on_confirm(self, channel_number: int, frame):
+		"""
+		Resolves the publishes acked/nacked by the broker, a single frame may cover many of them
+		"""
+		method = frame.method
+		unconfirmed = self.unconfirmed.get(channel_number, {})
+		if method.multiple:
+			tags = [tag for tag in unconfirmed if tag <= method.delivery_tag]
+		else:
+			tags = [method.delivery_tag]
+		nacked = isinstance(method, pika.spec.Basic.Nack)
+
+		now = monotonic()
+		for tag in tags:
+			if tag not in unconfirmed:
+				continue
+			future, published_at = unconfirmed.pop(tag)
+			latency = now - published_at
+			self.outstanding -= 1
+			self.latency_total += latency
+			self.latency_max = max(self.latency_max, latency)
+			if nacked:
+				self.counts["nacked"] += 1
+				future.set_exception(ConnectionError("Message nacked by RMQ"))
+			else:
+				self.counts["confirmed"] += 1
+				future.set_result(tag)
+
+	def _publish(self, queue: str, body: str, properties, future: Future):
+		"""
+		Publishes `body` on the next channel of the pool; runs on the IO thread
+		"""
+		if not self.channels:
+			self.counts["failed"] += 1
+			future.set_exception(ConnectionError("No open RMQ channel"))
+			return
+
+		channel = self.channels[self.turn % len(self.channels)]
+		self.turn += 1
+		try:
+			channel.basic_publish(
+				exchange="", routing_key=queue, body=body, properties=properties
+			)
+		except Exception as e:
+			self.counts["failed"] += 1
+			future.set_exception(e)
+			return
+
+		self.delivery_tags[channel.channel_number] += 1
+		tag = self.delivery_tags[channel.channel_number]
+		self.unconfirmed[channel.channel_number][tag] = (future, monotonic())
+		self.outstanding += 1
+		self.counts["published"] += 1
+
+	def publish(self, queue: str, body: str, properties=None, timeout: float = publish_timeout):
+		"""
+		Publishes `body` to `queue` and blocks the calling thread/greenlet until the broker confirms it
+		"""
+		if not self.ready.wait(timeout):
+			raise TimeoutError("RMQ connection not ready")
+
+		future = Future()
+		self.connection.ioloop.add_callback_threadsafe(
+			partial(self._publish, queue, body, properties, future)
+		)
+		future.result(timeout)
+
+	def stats(self) -> dict:
+		"""
+		Returns publish counts, confirms still outstanding and publish->confirm latency
+		"""
+		done = self.counts["confirmed"] + self.counts["nacked"]
+		return {
+			**self.counts,
+			"outstanding": self.outstanding,
+			"channels": len(self.channels),
+			"avg_latency_ms": round(1000 * self.latency_total / done, 3) if done else 0,
+			"max_latency_ms": round(1000 * self.latency_max, 3),
+		}
+
+
+_publisher = None
+_publisher_lock = threading.Lock()
+
+
+def publisher() -> Publisher:
+	"""
+	Returns the process-wide Publisher, creating it on first use
+	"""
+	global _publisher
+	with _publisher_lock:
+		if _publisher is None:
+			_publisher = Publisher()
+	return _publisher
+
+
 def push_to_Q(queue: str, query: str):
 	"""
 	Helper function to publish a `query` in a queue
-	Uses the default exchange and persistent delivery mode
-	"""
-	with rabbit_channel() as rmq_channel:
-		rmq_channel.basic_publish(
-			exchange="",
-			routing_key=queue,
-			body=query,
-			properties=pika.BasicProperties(delivery_mode=2),
+	Uses the default exchange and persistent delivery mode, and waits for the publisher confirm
+	"""
+	# Stamped with the publish time, so that consumers can tell how long it waited in the queue,
+	# and with the trace of the request, continued by the consumer
+	with hop_timer("publish"), span("publish", queue=queue):
+		headers = trace_headers({"sent_at": time()})
+		publisher().publish(queue, query, pika.BasicProperties(delivery_mode=2, headers=headers))
+
+
+class LatencyWindow:
+	"""
+	Keeps the latencies recorded in the last `window` seconds
+	"""
+	def __init__(self, window: float = latency_window):
+		self.window = window
+		self.samples = deque()
+		self.lock = threading.Lock()
+
+	def record(self, latency: float):
+		with self.lock:
+			self.samples.append((monotonic(), latency))
+
+	def percentile(self, p: float) -> Optional[float]:
+		"""
+		Returns the `p`th percentile of the latencies in the window, None if there are none
+		"""
+		with self.lock:
+			while self.samples and self.samples[0][0] < monotonic() - self.window:
+				self.samples.popleft()
+			latencies = sorted(latency for _, latency in self.samples)
+		if not latencies:
+			return None
+		return latencies[min(len(latencies) - 1, int(p / 100 * len(latencies)))]
+
+
+# Latency of read RPCs, from publishing the query to receiving the response
+read_latency = LatencyWindow()
+
+
+def queue_stats(queue: str) -> Optional[dict]:
+	"""
+	Returns the depth (ready and unacknowledged messages) and consumer count of `queue`
+	from the RMQ management API, None if it can't be reached
+	"""
+	try:
+		resp = requests.get(
+			f"{rmq_management_url}/api/queues/%2F/{queue}", auth=rmq_management_auth, timeout=2
 		)
+		resp.raise_for_status()
+		stats = resp.json()
+	except Exception as e:
+		logger.error(f"Error reading {queue} stats from RMQ management API. {e}")
+		return None
+	return {
+		"ready": stats.get("messages_ready", 0),
+		"unacked": stats.get("messages_unacknowledged", 0),
+		"consumers": stats.get("consumers", 0),
+	}
 
 
 class ReadRpcClient:
 	"""
-	Sends `query` to readQ via call() and returns response sent by worker to respQ
+	Process-wide RPC client for readQ.
+	Holds one persistent RMQ connection on a background thread, receives replies through
+	RMQ direct reply-to, and maps each correlation_id to a Future (or to a Queue of chunks,
+	for streamed reads), so any number of in-flight reads share a single channel.
+	It also listens to the writes the master applied, to invalidate the read cache once they reach the DB
 	"""
+	reply_queue = "amq.rabbitmq.reply-to"
+	applied_exchange = "writesApplied"
+
 	def __init__(self, rmq_host=rmq_host):
 		"""
-		Setup RMQ connection and response queue consumption
+		Start the IO thread owning the RMQ connection
+		"""
+		self.rmq_host = rmq_host
+		self.connection = None
+		self.channel = None
+		self.ready = threading.Event()
+		self.lock = threading.Lock()
+		self.pending: Dict[str, Future] = {}
+		self.streams: Dict[str, Queue] = {}
+		threading.Thread(target=self.run, daemon=True).start()
+
+	def connect(self):
+		"""
+		Setup RMQ connection and consumption of the direct reply-to pseudo-queue
 		"""
 		self.connection = pika.BlockingConnection(
-			pika.ConnectionParameters(host=rmq_host, heartbeat=0)
+			pika.ConnectionParameters(host=self.rmq_host, heartbeat=0)
 		)
 		self.channel = self.connection.channel()
-		self.callback_queue = "respQ"
 		self.channel.basic_consume(
-			queue=self.callback_queue,
+			queue=self.reply_queue,
 			on_message_callback=self.on_response,
 			auto_ack=True,
 		)
+		# Each process gets every notification, on a queue of its own
+		self.channel.exchange_declare(exchange=self.applied_exchange, exchange_type="fanout", durable=True)
+		applied = self.channel.queue_declare(queue="", exclusive=True).method.queue
+		self.channel.queue_bind(queue=applied, exchange=self.applied_exchange)
+		self.channel.basic_consume(queue=applied, on_message_callback=self.on_applied, auto_ack=True)
+
+	def run(self):
+		"""
+		Services the connection forever, reconnecting if it drops.
+		Only this thread touches the connection, other threads hand work over via add_callback_threadsafe
+		"""
+		while True:
+			try:
+				self.connect()
+				self.ready.set()
+				while True:
+					self.connection.process_data_events(time_limit=1)
+			except Exception as e:
+				logger.error(f"RPC client lost RMQ connection. {e}")
+				self.ready.clear()
+				self.fail_pending(e)
+				sleep(1)
+
+	def fail_pending(self, e: Exception):
+		"""
+		Fails all in-flight calls, as their replies can never arrive on a new channel
+		"""
+		with self.lock:
+			corr_ids = list(self.pending) + list(self.streams)
+		for corr_id in corr_ids:
+			self.fail(corr_id, ConnectionError(f"RMQ connection lost. {e}"))
+
+	def fail(self, corr_id: str, e: Exception):
+		"""
+		Fails the call or stream waiting on `corr_id`
+		"""
+		with self.lock:
+			future = self.pending.pop(corr_id, None)
+			stream = self.streams.get(corr_id)
+		if future is not None:
+			future.set_exception(e)
+		if stream is not None:
+			stream.put(e)
 
 	def on_response(self, ch, method, props, body):
 		"""
-		Triggered when a response is received in respQ.
-		Checks if correlation_id of response is same as the one sent with the request
+		Triggered when a response is received on the reply-to queue.
+		Resolves the Future waiting on the correlation_id of the response,
+		or hands the chunk over to the stream reading it
+		"""
+		with self.lock:
+			future = self.pending.pop(props.correlation_id, None)
+			stream = self.streams.get(props.correlation_id)
+		if stream is not None:
+			stream.put((props.headers or {}, body.decode("utf-8"), props.reply_to))
+			return
+		if future is None:
+			logger.warning(f"Dropping response for unknown call {props.correlation_id}")
+			return
+		if props.headers and "error" in props.headers:
+			future.set_exception(QueryError(props.headers["error"]))
+			return
+		future.set_result(body.decode("utf-8"))
+
+	def on_applied(self, ch, method, props, body):
+		"""
+		Triggered when the master flushed writes to the DB, with the collections they touched
+		"""
+		for collection in loads(body.decode("utf-8")):
+			read_cache.invalidate(collection)
+
+	def publish(self, corr_id: str, query: str, headers: Dict[str, str]):
+		"""
+		Publishes `query` to readQ with `headers`; runs on the IO thread
 		"""
-		if self.corr_id == props.correlation_id:
-			self.response = body.decode("utf-8")
+		try:
+			self.channel.basic_publish(
+				body=query,
+				exchange="",
+				routing_key="readQ",
+				properties=pika.BasicProperties(
+					correlation_id=corr_id, reply_to=self.reply_queue, headers={**headers, "sent_at": time()}
+				),
+			)
+		except Exception as e:
+			self.fail(corr_id, e)
+
+	def credit(self, reply_to: str, corr_id: str):
+		"""
+		Returns a credit to the slave streaming `corr_id`, for a chunk consumed; runs on the IO thread
+		"""
+		try:
+			self.channel.basic_publish(
+				body="", exchange="", routing_key=reply_to, properties=pika.BasicProperties(correlation_id=corr_id)
+			)
+		except Exception as e:
+			self.fail(corr_id, e)
 
-	def call(self, query) -> str:
+	def call(self, query: str, timeout: float = rpc_timeout) -> str:
 		"""
 		Sends the actual `query` to readQ with a unique correlation_id using default exchange
-		Informs the readQ listener to send back response to respQ
-		"""
-		self.response = None
-		self.corr_id = new_uuid()
-		self.channel.basic_publish(
-			body=query,
-			exchange="",
-			routing_key="readQ",
-			properties=pika.BasicProperties(
-				correlation_id=self.corr_id, reply_to=self.callback_queue
-			),
-		)
+		and blocks the calling thread/greenlet until the response arrives
+		"""
+		if not self.ready.wait(timeout):
+			raise TimeoutError("RMQ connection not ready")
 
-		# Close the connection, once the response is received
-		while self.response is None:
-			self.connection.process_data_events()
-		else:
-			self.connection.close()
+		corr_id = new_uuid()
+		future = Future()
+		with self.lock:
+			self.pending[corr_id] = future
+
+		start = monotonic()
+		try:
+			with span("read_rpc"):
+				# The trace is read here, as the IO thread publishing the query isn't in the caller's span
+				self.connection.add_callback_threadsafe(partial(self.publish, corr_id, query, trace_headers()))
+				return future.result(timeout)
+		except Exception:
+			errors.labels("read_rpc").inc()
+			raise
+		finally:
+			read_latency.record(monotonic() - start)
+			hop_latency.labels("read_rpc").observe(monotonic() - start)
+			with self.lock:
+				self.pending.pop(corr_id, None)
+
+	def stream(self, query: str, timeout: float = rpc_timeout) -> Iterator[str]:
+		"""
+		Sends a streamed read `query` to readQ and yields the chunks of its response in order.
+		Each chunk is a JSON array, the worker marks the last one with the `last` header.
+		The worker sends a few chunks ahead, then one per credit returned once the caller took a chunk,
+		so at most its window of chunks is buffered here, however slow the caller is
+		"""
+		if not self.ready.wait(timeout):
+			raise TimeoutError("RMQ connection not ready")
+
+		corr_id = new_uuid()
+		chunks = Queue()
+		with self.lock:
+			self.streams[corr_id] = chunks
+
+		try:
+			self.connection.add_callback_threadsafe(partial(self.publish, corr_id, query, trace_headers()))
+			for seq in count():
+				try:
+					chunk = chunks.get(timeout=timeout)
+				except Empty:
+					raise TimeoutError(f"No chunk {seq} of streamed read within {timeout}s")
+				if isinstance(chunk, Exception):
+					raise chunk
+				headers, body, reply_to = chunk
+				if "error" in headers:
+					raise QueryError(headers["error"])
+				if headers.get("seq") != seq:
+					raise QueryError(f"Chunk {headers.get('seq')} received instead of {seq}")
+				yield body
+				if headers.get("last"):
+					return
+				self.connection.add_callback_threadsafe(partial(self.credit, reply_to, corr_id))
+		finally:
+			with self.lock:
+				self.streams.pop(corr_id, None)
+
+
+_rpc_client = None
+_rpc_client_lock = threading.Lock()
+
+
+def read_rpc_client() -> ReadRpcClient:
+	"""
+	Returns the process-wide ReadRpcClient, creating it on first use
+	(lazily, so that it is created after gunicorn forks and gevent patches threading)
+	"""
+	global _rpc_client
+	with _rpc_client_lock:
+		if _rpc_client is None:
+			_rpc_client = ReadRpcClient()
+	return _rpc_client
+
+
+# ## Read cache
+class ReadCache:
+	"""
+	LRU cache of read responses, keyed by collection and the normalised rest of the read query.
+	A write invalidates every entry of the collection it touches twice: when it is published,
+	and when the master reports it applied, as it may wait in writeQ and in the master's batch in between.
+	Each invalidation bumps the collection's generation and starts a settle window, during which reads aren't cached,
+	so neither a read that was in flight during the write nor one served by a slave that
+	hasn't replicated it yet can put a pre-write result back in the cache.
+	A slave lagging more than the settle window behind the master, or a lost notification, can still get
+	a pre-write result cached: entries expire after `ttl` seconds, which bounds how stale they can get
+	"""
+	def __init__(self, size: int = read_cache_size, settle: float = read_cache_settle, ttl: float = read_cache_ttl):
+		self.size = size
+		self.settle = settle
+		self.ttl = ttl
+		# key -> (response, expiry time)
+		self.entries: OrderedDict = OrderedDict()
+		self.generations: Dict[str, int] = {}
+		self.dirty_until: Dict[str, float] = {}
+		self.lock = threading.Lock()
+		self.counts = {"hits": 0, "misses": 0, "evictions": 0, "invalidations": 0, "expirations": 0}
+
+	@staticmethod
+	def key(query: dict) -> Tuple[str, str]:
+		"""
+		Returns the cache key of a read `query`: its collection and its other arguments in canonical JSON
+		"""
+		rest = {k: v for k, v in query.items() if k != "collection"}
+		return query["collection"], dumps(rest, sort_keys=True, separators=(",", ":"))
+
+	def get(self, key: Tuple[str, str]) -> Optional[str]:
+		"""
+		Returns the cached response for `key` if any, and counts the hit/miss
+		"""
+		with self.lock:
+			if key in self.entries:
+				value, expires_at = self.entries[key]
+				if monotonic() < expires_at:
+					self.entries.move_to_end(key)
+					self.counts["hits"] += 1
+					return value
+				del self.entries[key]
+				self.counts["expirations"] += 1
+			self.counts["misses"] += 1
+			return None
+
+	def generation(self, collection: str) -> int:
+		"""
+		Returns the number of writes seen for `collection`, to be passed to put()
+		"""
+		with self.lock:
+			return self.generations.get(collection, 0)
+
+	def put(self, key: Tuple[str, str], value: str, generation: int):
+		"""
+		Caches `value`, unless the collection was written since `generation` was read or is still settling.
+		A null response is never a result (reads answer a list or a count), so it isn't cached
+		"""
+		collection = key[0]
+		if value is None or value.strip() == "null":
+			return
+		with self.lock:
+			if self.generations.get(collection, 0) != generation \
+				or monotonic() < self.dirty_until.get(collection, 0):
+				return
+			self.entries[key] = (value, monotonic() + self.ttl)
+			self.entries.move_to_end(key)
+			while len(self.entries) > self.size:
+				self.entries.popitem(last=False)
+				self.counts["evictions"] += 1
+
+	def get_or_load(self, query: dict, load: Callable[[], str]) -> str:
+		"""
+		Returns the cached response of `query`, or calls `load` and caches what it returns
+		"""
+		key = self.key(query)
+		generation = self.generation(key[0])
+		value = self.get(key)
+		if value is None:
+			value = load()
+			self.put(key, value, generation)
+		return value
+
+	def invalidate(self, collection: str):
+		"""
+		Drops all cached responses of `collection`
+		"""
+		with self.lock:
+			self.generations[collection] = self.generations.get(collection, 0) + 1
+			self.dirty_until[collection] = monotonic() + self.settle
+			for key in [k for k in self.entries if k[0] == collection]:
+				del self.entries[key]
+				self.counts["invalidations"] += 1
+
+	def stats(self) -> dict:
+		"""
+		Returns hit/miss/eviction/invalidation/expiration counts and the current number of entries
+		"""
+		with self.lock:
+			return {**self.counts, "entries": len(self.entries), "size": self.size}
 
-		return self.response
+
+read_cache = ReadCache()
 
 
 # ## Docker
 docker_client = docker.from_env()
 
 
-# Docker SDK helper function
-def list_containers() -> List[docker.models.containers.Container]:
+class WorkerRegistry:
 	"""
-	Returns a list of Container objects of all running containers
+	In-memory inventory of the worker containers, by name: {id, name, pid, role, state}.
+	Loaded from the running containers, then kept current from the Docker events stream on a background thread,
+	and reloaded whenever the stream has to be reopened, so lookups never call the Docker API
 	"""
-	return docker_client.containers.list()
+	def __init__(self, client: docker.DockerClient = docker_client):
+		self.client = client
+		self.workers: Dict[str, dict] = {}
+		self.lock = threading.Lock()
+		self.ready = threading.Event()
+		threading.Thread(target=self.run, daemon=True).start()
+
+	def run(self):
+		while True:
+			try:
+				# Events from before the reload get replayed, so none is missed in between
+				since = int(time())
+				self.reload()
+				self.ready.set()
+				for event in self.client.events(decode=True, since=since, filters={"type": "container"}):
+					self.on_event(event)
+			except Exception as e:
+				logger.error(f"Error in Docker events stream. {e}")
+			sleep(1)
 
+	def reload(self):
+		"""
+		Replaces the inventory with the running worker containers
+		"""
+		workers = {c.name: self.entry(c) for c in self.client.containers.list() if "worker" in c.name}
+		with self.lock:
+			self.workers = workers
 
-def list_slaves() -> List[docker.models.containers.Container]:
+	def entry(self, c: docker.models.containers.Container) -> dict:
+		return {
+			"id": c.id,
+			"name": c.name,
+			"pid": int(c.attrs["State"]["Pid"]),
+			"role": "master" if "worker-master" in c.name else "slave",
+			"state": c.status,
+		}
+
+	def update(self, c: docker.models.containers.Container) -> dict:
+		"""
+		Records the state of `c`, and returns its entry
+		"""
+		worker = self.entry(c)
+		with self.lock:
+			self.workers[c.name] = worker
+		return worker
+
+	def remove(self, name: str):
+		with self.lock:
+			self.workers.pop(name, None)
+
+	def on_event(self, event: dict):
+		"""
+		Triggered on every container event, keeps the entry of worker containers current
+		"""
+		name = event.get("Actor", {}).get("Attributes", {}).get("name", "")
+		if "worker" not in name:
+			return
+		action = event.get("Action") or event.get("status")
+		if action in ("start", "restart", "pause", "unpause"):
+			try:
+				self.update(self.client.containers.get(event["id"]))
+			except docker.errors.NotFound:
+				self.remove(name)
+		elif action in ("die", "destroy"):
+			self.remove(name)
+
+	def list(self, role: str = None) -> List[dict]:
+		"""
+		Returns the entries of the running workers, of `role` (master/slave) if given
+		"""
+		with self.lock:
+			return [
+				w for w in self.workers.values()
+				if w["state"] == "running" and (role is None or w["role"] == role)
+			]
+
+
+_worker_registry = None
+_worker_registry_lock = threading.Lock()
+
+
+def worker_registry(timeout: float = container_ready_timeout) -> WorkerRegistry:
+	"""
+	Returns the process-wide WorkerRegistry, creating it on first use and waiting for its first load
+	"""
+	global _worker_registry
+	with _worker_registry_lock:
+		if _worker_registry is None:
+			_worker_registry = WorkerRegistry()
+	if not _worker_registry.ready.wait(timeout):
+		logger.error(f"Worker registry not loaded after {timeout}s")
+	return _worker_registry
+
+
+def list_slaves() -> List[dict]:
+	"""
+	Returns the registry entries of all running active slave containers
+	"""
+	standby = standby_names()
+	return [w for w in worker_registry().list("slave") if w["name"] not in standby]
+
+
+def list_standby() -> List[dict]:
 	"""
-	Returns a list of Container objects of all running slave containers
+	Returns the registry entries of all running standby slave containers
 	"""
-	return [c for c in list_containers() if "worker-slave" in c.name]
+	standby = standby_names()
+	return [w for w in worker_registry().list("slave") if w["name"] in standby]
 
 
-def list_workers() -> List[docker.models.containers.Container]:
+def list_workers() -> List[dict]:
 	"""
-	Returns a list of Container objects of all running worker containers (master/slave)
+	Returns the registry entries of all running worker containers (master/active slaves)
 	"""
-	return [c for c in list_containers() if "worker" in c.name]
+	standby = standby_names()
+	return [w for w in worker_registry().list() if w["name"] not in standby]
 
 
-def container_pid(c: docker.models.containers.Container) -> int:
+def standby_names() -> set:
 	"""
-	returns PID of `c` according in the host namespace
+	Returns the names of the standby slave containers, kept in a Redis set
 	"""
-	return int(c.top()["Processes"][0][1])
+	return {name.decode("utf-8") for name in r.smembers(standby_key)}
+
+
+def control_queue(name: str) -> str:
+	"""
+	Returns the queue the slave container `name` takes activate/deactivate commands from
+	"""
+	return f"control-{name}"
+
+
+def container_pid(w: dict) -> int:
+	"""
+	returns PID of the worker `w` in the host namespace
+	"""
+	return w["pid"]
+
+
+def wait_for_container(
+	c: docker.models.containers.Container, running: bool = True, timeout: float = container_ready_timeout
+) -> docker.models.containers.Container:
+	"""
+	Polls the state of `c` until it is running (or not running), and returns it
+	Raises RuntimeError if `c` exits while it should be starting, or on timeout
+	"""
+	deadline = monotonic() + timeout
+	while True:
+		c.reload()
+		if (c.status == "running") == running:
+			return c
+		if running and c.status in ("exited", "dead"):
+			raise RuntimeError(f"{c.name} is {c.status}")
+		if monotonic() >= deadline:
+			raise RuntimeError(f"{c.name} still {c.status} after {timeout}s")
+		sleep(ready_poll_interval)
 
 
 def worker_pids() -> List[int]:
 	"""
-	Returns a list of PIDs of all running worker containers (master/slave)
+	Returns a list of PIDs of all running worker containers (master/active slaves)
 	"""
 	return sorted(map(container_pid, list_workers()))
 
 
-def spawn_slave() -> int:
+def spawn_slave(standby: bool = False) -> int:
 	"""
 	Spawn a new slave container on the dbaas_default network and returns its PID
+	A standby slave joins the ReplSet and syncs, but only serves readQ once activated
 	"""
 	n = r.incr("slave-count") + 1
-	logger.info(f"Spawning Slave {n}")
+	name = f"worker-slave-{n}"
+	logger.info(f"Spawning {'standby ' if standby else ''}Slave {n}")
+	# Declare the control queue before the slave runs, so no command sent to it is dropped
+	with rabbit_channel() as channel:
+		channel.queue_declare(queue=control_queue(name), durable=True)
+	if standby:
+		r.sadd(standby_key, name)
 	c = docker_client.containers.run(
 		image="worker-slave",
 		command=f"python3 main.py {n}",
-		name=f"worker-slave-{n}",
-		hostname=f"worker-slave-{n}",
+		name=name,
+		hostname=name,
 		network="dbaas_default",
 		restart_policy={"Name": "on-failure"},
+		# The slave seeds its data files from the latest snapshot, and may be asked to take the next one
+		volumes={snapshot_volume: {"bind": "/snapshots", "mode": "rw"}},
+		environment={
+			"READ_CONCURRENCY": slave_read_concurrency,
+			"READ_PREFETCH": slave_read_prefetch,
+			"SLAVE_MODE": "standby" if standby else "active",
+		},
 		detach=True,
 	)
-	sleep(0.5)
-	return container_pid(c)
+	# The slave serves reads on its own once its DB is synced, the container only has to be up to have a PID
+	return container_pid(worker_registry().update(wait_for_container(c)))
 
 
-def kill_slave(scaling: bool = False) -> int:
+def activate_slave(w: dict) -> int:
 	"""
-	Kills the slave with max PID and returns the PID
+	Makes the standby slave `w` consume readQ and returns its PID
+	"""
+	logger.info(f"Activating {w['name']}")
+	push_to_Q(control_queue(w["name"]), "activate")
+	r.srem(standby_key, w["name"])
+	return container_pid(w)
+
+
+def deactivate_slave(w: dict) -> int:
+	"""
+	Makes the active slave `w` stop consuming readQ, returning it to the standby pool, and returns its PID
+	"""
+	logger.info(f"Deactivating {w['name']}")
+	r.sadd(standby_key, w["name"])
+	push_to_Q(control_queue(w["name"]), "deactivate")
+	return container_pid(w)
+
+
+def destroy_slave(w: dict) -> int:
+	"""
+	Kills the slave `w`, forgets about it and returns its PID
+	"""
+	c = docker_client.containers.get(w["id"])
+	c.kill()
+	worker_registry().remove(w["name"])
+	r.srem(standby_key, w["name"])
+	with rabbit_channel() as channel:
+		channel.queue_delete(queue=control_queue(w["name"]))
+	# Have the master drop it from the ReplSet
+	push_to_Q("syncQ", dumps({"op": "remove", "host": w["name"]}))
+	wait_for_container(c, running=False)
+	return container_pid(w)
+
+
+def request_snapshot() -> Optional[str]:
+	"""
+	Asks the longest running standby slave to snapshot its data for new slaves to be seeded from,
+	and returns its name, None if there is no standby slave
+	"""
+	standby = sorted(list_standby(), key=container_pid)
+	if not standby:
+		return None
+	push_to_Q(control_queue(standby[0]["name"]), "snapshot")
+	return standby[0]["name"]
+
+
+def sync_members():
+	"""
+	Sends the live slaves (active and standby) to the master, which drops the other ReplSet members
+	"""
+	push_to_Q("syncQ", dumps({"op": "sync", "hosts": [w["name"] for w in worker_registry().list("slave")]}))
+
+
+def kill_slave() -> int:
+	"""
+	Kills the active slave with max PID, replaces it (with a standby slave if there is one) and returns the PID
 	"""
 	# Find slave
-	c = max(list_slaves(), key=container_pid)
-	# Find PID
-	p = container_pid(c)
+	w = max(list_slaves(), key=container_pid)
 	# Kill slave
-	c.kill()
-	sleep(0.5)
-	if not scaling: spawn_slave()
+	p = destroy_slave(w)
+	scale_up(1)
 	return p
 
 
-def scale_down(n: int) -> List[int]:
+# Runs the container operations of a scale operation in parallel
+scale_executor = ThreadPoolExecutor(max_workers=scale_workers)
+
+
+def in_parallel(fn: Callable, items: List) -> List:
 	"""
-	Kills `n` slave containers and returns their PIDs
+	Calls `fn` on each of `items` on the scale executor, and returns the results in order
 	"""
-	logger.info(f"Scaling Down by {n} nodes")
-	return [kill_slave(scaling=True) for i in range(n)]
+	return list(scale_executor.map(fn, items))
 
 
-def scale_up(n: int) -> List[int]:
+def fill_standby(size: int = standby_slaves) -> List[int]:
 	"""
-	Spawns `n` new slave containers and returns their PIDs
+	Spawns or kills standby slaves so that `size` of them are kept warm, and returns the PIDs of those spawned
 	"""
-	logger.info(f"Scaling Up by {n} nodes")
-	return [spawn_slave() for i in range(n)]
+	standby = list_standby()
+	# The most recently spawned standby slaves are the least synced, drop them first
+	in_parallel(destroy_slave, sorted(standby, key=container_pid)[size:])
+	return in_parallel(lambda i: spawn_slave(standby=True), range(size - len(standby)))
 
 
-def scale_daemon():
+def scale_down(n: int) -> List[int]:
 	"""
-	Spawns or kills slave containers based on number of requests received in the last 120 seconds
+	Returns `n` active slaves with max PIDs to the standby pool, destroying the ones it can't hold,
+	and returns their PIDs
 	"""
-	# call this function after another 120 seconds
-	scale_after(120)
-	logger.info("Scaler Daemon")
-	# Check number of requests received
-	req_count = get_redis_count()
-	# Reset request count to 0
-	reset_redis_count()
-	# Check number of running slave containers
-	slave_count = len(list_slaves())
-	# Calculate delta
-	additional_slaves_req = max(ceil(req_count / 20), 1) - slave_count
-	# Need more
-	if additional_slaves_req > 0: scale_up(additional_slaves_req)
-	# Have more
-	elif additional_slaves_req < 0: scale_down(-additional_slaves_req)
+	logger.info(f"Scaling Down by {n} nodes")
+	pids = in_parallel(deactivate_slave, sorted(list_slaves(), key=container_pid, reverse=True)[:n])
+	fill_standby()
+	return pids
 
 
-def scale_after(interval: int):
+def scale_up(n: int) -> List[int]:
 	"""
-	Calls the scaler after `interval` seconds on a separate thread
+	Activates up to `n` standby slaves, spawns new slave containers for the rest, refills the standby pool
+	and returns the PIDs of the new active slaves
 	"""
-	threading.Timer(interval, scale_daemon).start()
+	logger.info(f"Scaling Up by {n} nodes")
+	pids = in_parallel(activate_slave, sorted(list_standby(), key=container_pid)[:n])
+	pids += in_parallel(lambda i: spawn_slave(), range(n - len(pids)))
+	fill_standby()
+	return pids
@@ -1,3 +1,7 @@
+from hooks import post_fork
 from main import app
 
-if __name__ == "__main__": app.run(port=5000, host="0.0.0.0", use_reloader=False)
+if __name__ == "__main__":
+	# Outside gunicorn, nothing else starts the background threads
+	post_fork(None, None)
+	app.run(port=5000, host="0.0.0.0", use_reloader=False)
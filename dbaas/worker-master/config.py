@@ -1,5 +1,39 @@
 from os import popen
 
 rmq_host = "rabbitmq"  # hostname of RMQ container
+rmq_ready_timeout = 60  # seconds to keep retrying to connect to RMQ while it starts
+mongo_ready_timeout = 60  # seconds to wait for mongod to answer pings once started
+primary_ready_timeout = 60  # seconds to wait for this node to become primary
+ready_poll_interval = 0.5  # seconds between two readiness checks
+write_batch_size = 100  # max writes flushed to the DB in one go
+write_linger = 0.05  # seconds a write may wait for more writes to batch with
+sync_batch_size = 50  # max membership changes applied to the ReplSet in one reconfig
+sync_linger = 0.5  # seconds a membership change may wait for more changes to be applied with
+# Indexes the master builds on startup, per collection: the keys as [field, direction] pairs, and create_index options
+indexes = {
+	"users": [
+		{"keys": [["username", 1]], "unique": True},
+	],
+	"rides": [
+		{"keys": [["rideId", 1]], "unique": True},
+		{"keys": [["source", 1], ["destination", 1], ["timestamp", 1]]},
+		{"keys": [["created_by", 1]]},
+		{"keys": [["users", 1]]},
+	],
+}
+mongo_pool_size = 50  # max connections in the MongoClient pool
+mongo_connect_timeout_ms = 5000  # timeout to open a connection to mongod
+mongo_server_selection_timeout_ms = 10000  # timeout to find mongod able to serve an operation
+mongo_socket_timeout_ms = 30000  # timeout of a single operation on a connection
+stats_interval = 60  # seconds between two stats log lines
+metrics_port = 8000  # port the Prometheus metrics are served on
+service_name = "worker-master"  # service spans are recorded under
+spans_file = "spans.jsonl"  # local collector file spans are appended to, one JSON object per line
+span_queue_size = 10000  # finished spans waiting to be written before new ones are dropped
+log_file = "worker-master.log"  # file the logs of the service are written to, as JSON lines
+log_max_chars = 1000  # longest logged value, longer ones are truncated
+log_queue_size = 10000  # log records waiting to be written before new ones are dropped
+# fraction of the records below WARNING written per logger, others are written in full
+log_sample_rates = {"writes": 0.1}
 mongodb_host: str = popen("hostname").read().strip()  # find your hostname
 # mongodb_host = "worker-master"
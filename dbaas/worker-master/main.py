@@ -3,14 +3,29 @@
 	main.py: python file containing the DB Master-worker logic
 """
 
-from json import loads
+import logging
+from itertools import count, groupby
+from json import dumps, loads
 from threading import Thread
+from typing import Dict, List, Set, Tuple
 
-from utils import (logger, mongo_collection, mongo_connection, rabbit_channel,
-				   start_mongo)
+import pika
+from pymongo import DeleteMany, InsertOne, UpdateMany
+from pymongo.database import Database
+from pymongo.errors import BulkWriteError, OperationFailure
 
+from config import (indexes, sync_batch_size, sync_linger, write_batch_size,
+                    write_linger)
+from metrics import errors, hop_timer, record_consume, serve_metrics
+from tracing import Span, parse_traceparent, span
+from utils import (log_stats, logger, mongo_connection, rabbit_channel,
+                   start_mongo, wait_for_primary)
 
-def write_db(
+# Logs every write, sampled (see log_sample_rates)
+write_logger = logging.getLogger("writes")
+
+
+def write_op(
 	collection: dict = {},
 	action: dict = {},
 	document: dict = {},
@@ -19,55 +34,299 @@ def write_db(
 	**kwargs,
 ):
 	"""
-	Performs the actual write operations onto the database
+	Returns the bulk write operation performing `action`, or None for an unknown action
+	(index builds, action 3, aren't bulk write operations)
 	"""
-	logger.info(f"Write to DB {collection} {action} {document} {filte} {update}")
-	with mongo_collection(collection) as collection:
-		if action == 0:
-			collection.insert_one(document)
-		elif action == 1:
-			collection.update_many(filte, update)
-		elif action == 2:
-			collection.delete_many(filte)
+	if action == 0:
+		return InsertOne(document)
+	elif action == 1:
+		return UpdateMany(filte, update)
+	elif action == 2:
+		return DeleteMany(filte)
 
 
-def write_db_callback(ch, method, props, body):
+def create_index(db: Database, collection: str, keys: List[list] = [], **options):
 	"""
-	Acknowledge message after writing to DB
+	Builds the index on `keys` ([field, direction] pairs) of `collection`, passing `options` (unique, name) on.
+	Index builds on the primary replicate to the slaves through the oplog
 	"""
-	args = loads(body.decode("utf-8"))
-	logger.info(f"Write {body}")
+	name = db[collection].create_index([tuple(key) for key in keys], **options)
+	logger.info(f"Index {name} on {collection}")
 
-	write_db(**args)
 
-	ch.basic_ack(delivery_tag=method.delivery_tag)
+def ensure_indexes(indexes: Dict[str, List[dict]] = indexes):
+	"""
+	Builds the indexes declared in `indexes` that don't exist yet
+	"""
+	with mongo_connection() as client:
+		for collection, specs in indexes.items():
+			for spec in specs:
+				try:
+					create_index(client["cc"], collection, **spec)
+				except Exception as e:
+					logger.error(f"Error building index {spec} on {collection}. {e}")
 
 
-def mongo_sync_callback(ch, method, props, body):
+def bulk_write(db: Database, collection: str, ops: list, writes: List[dict]) -> List[Tuple[dict, str]]:
 	"""
-	Add new slave worker to Mongo ReplSet
+	Sends `ops`, performing `writes`, to `collection` as one bulk_write, which is unordered when it only has inserts;
+	updates and deletes stay ordered as they may depend on earlier writes.
+	A failed op doesn't take the ones after it down: an ordered bulk_write stopped by it resumes past it.
+	Returns the writes that failed, with the reason
 	"""
-	body = body.decode("utf-8")
-	logger.info(f"syncQ {body}")
-	n = int(body.rsplit("-", maxsplit=1)[-1])
-	with mongo_connection() as conn:
-		conf = conn.admin.command({"replSetGetConfig": 1})
-		conf["config"]["members"].append(
-			{"_id": n, "host": f"{body}:27017", "hidden": True, "priority": 0}
+	failed = []
+	while ops:
+		ordered = not all(isinstance(op, InsertOne) for op in ops)
+		try:
+			db[collection].bulk_write(ops, ordered=ordered)
+			break
+		except BulkWriteError as e:
+			write_errors = e.details.get("writeErrors", [])
+			failed += [(writes[error["index"]], error.get("errmsg", str(e))) for error in write_errors]
+			if not ordered or not write_errors:
+				break
+			resume = write_errors[-1]["index"] + 1
+			ops, writes = ops[resume:], writes[resume:]
+		except Exception as e:
+			failed += [(write, str(e)) for write in writes]
+			break
+	for write, reason in failed:
+		logger.error(f"Error writing {write} to {collection}. {reason}")
+	return failed
+
+
+def write_db(writes: List[dict]) -> List[Tuple[dict, str]]:
+	"""
+	Performs the actual write operations onto the database.
+	Consecutive writes to the same collection are sent as one bulk_write,
+	index builds (action 3) are run between them, in order.
+	Returns the writes that failed, with the reason
+	"""
+	write_logger.info("Write to DB %d writes", len(writes))
+	failed = []
+	with mongo_connection() as client:
+		db = client["cc"]
+		for collection, group in groupby(writes, key=lambda w: w.get("collection")):
+			ops, op_writes = [], []
+			for write in group:
+				if write.get("action") == 3:
+					failed += bulk_write(db, collection, ops, op_writes)
+					ops, op_writes = [], []
+					try:
+						create_index(db, collection, **(write.get("document") or {}))
+					except Exception as e:
+						logger.error(f"Error building index {write} on {collection}. {e}")
+						failed.append((write, str(e)))
+					continue
+				op = write_op(**write)
+				if op is not None:
+					ops.append(op)
+					op_writes.append(write)
+			failed += bulk_write(db, collection, ops, op_writes)
+	return failed
+
+
+class WriteBatcher:
+	"""
+	Buffers the writes consumed from writeQ and flushes them to the DB together,
+	once `batch_size` writes are buffered or `linger` seconds after the first one arrived.
+	Messages are acknowledged, all at once, only after their writes are flushed; writes that failed are dead-lettered to deadQ
+	"""
+	def __init__(self, connection, channel, batch_size=write_batch_size, linger=write_linger):
+		self.connection = connection
+		self.channel = channel
+		self.batch_size = batch_size
+		self.linger = linger
+		self.writes: List[dict] = []
+		# One span per buffered message, continuing the trace of its request, from consume to flush
+		self.spans: List[Span] = []
+		self.last_tag = None
+		self.timer = None
+
+	def callback(self, ch, method, props, body):
+		"""
+		Buffers the write(s) of a writeQ message, a message either has one write or a `batch` of them
+		"""
+		record_consume("writeQ", props, body)
+		args = loads(body.decode("utf-8"))
+		write_logger.info("Write %s", body)
+
+		writes = args["batch"] if "batch" in args else [args]
+		self.writes.extend(writes)
+		trace_id, parent_id = parse_traceparent((props.headers or {}).get("traceparent"))
+		self.spans.append(Span("write", trace_id, parent_id, writes=len(writes)))
+		self.last_tag = method.delivery_tag
+
+		if len(self.writes) >= self.batch_size:
+			self.flush()
+		elif self.timer is None:
+			self.timer = self.connection.call_later(self.linger, self.flush)
+
+	def flush(self):
+		"""
+		Writes the buffered writes to the DB and acknowledges their messages
+		"""
+		if self.timer is not None:
+			self.connection.remove_timeout(self.timer)
+			self.timer = None
+		if not self.writes:
+			return
+
+		# The flush serves the writes of many requests, so it's a trace of its own that their spans point to
+		with hop_timer("write_flush"), span("write_db", writes=len(self.writes), messages=len(self.spans)) as flush:
+			failed = write_db(self.writes)
+			flush.attrs["failed"] = len(failed)
+		for write, reason in failed:
+			self.dead_letter(write, reason)
+		# The orchestrators invalidate their cached reads of the collections written, now that the writes are in the DB
+		collections = sorted({w["collection"] for w in self.writes if w.get("collection")})
+		self.channel.basic_publish(exchange="writesApplied", routing_key="", body=dumps(collections))
+		self.channel.basic_ack(delivery_tag=self.last_tag, multiple=True)
+		for s in self.spans:
+			s.attrs["flush_span"] = flush.span_id
+			s.end()
+		self.writes = []
+		self.spans = []
+
+	def dead_letter(self, write: dict, reason: str):
+		"""
+		Publishes a write that failed to deadQ, with the reason in the `error` header,
+		so that it isn't lost when its message is acknowledged along with the writes that succeeded
+		"""
+		errors.labels("write").inc()
+		self.channel.basic_publish(
+			exchange="",
+			routing_key="deadQ",
+			body=dumps(write),
+			properties=pika.BasicProperties(delivery_mode=2, headers={"error": reason}),
 		)
-		conf["config"]["version"] += 1
-		res = conn.admin.command({"replSetReconfig": conf["config"]})
+
+
+def sync_op(body: str) -> dict:
+	"""
+	Returns the membership change of a syncQ message:
+		- {"op": "add", "host": slave} when a slave has started
+		- {"op": "remove", "host": slave} when a slave was destroyed
+		- {"op": "sync", "hosts": [slaves]} with every live slave, to drop members that died unnoticed
+	A bare slave name, as sent by older slaves, is an add
+	"""
+	try:
+		op = loads(body)
+	except ValueError:
+		op = None
+	return op if isinstance(op, dict) else {"op": "add", "host": body}
+
+
+def reconcile_members(members: List[dict], ops: List[dict], healthy: Set[str]) -> List[dict]:
+	"""
+	Returns the ReplSet `members` after applying the membership `ops` in order.
+	A sync only drops members missing from its live slaves that `healthy` (hosts seen up by the primary)
+	doesn't have either, so that a slave added while the sync was on its way is kept.
+	An added slave takes the lowest _id not used by a current member, nor by one dropped in this reconfig
+	"""
+	master = members[0]["host"]
+	members = {m["host"]: m for m in members}
+	dropped = set()
+
+	def drop(host: str):
+		if host != master and host in members:
+			dropped.add(members.pop(host)["_id"])
+
+	for op in ops:
+		if op["op"] == "add":
+			host = f"{op['host']}:27017"
+			if host in members:
+				continue
+			used = {m["_id"] for m in members.values()} | dropped
+			_id = next(i for i in count() if i not in used)
+			# Slaves never vote: a ReplSet has at most 7 voting members
+			members[host] = {"_id": _id, "host": host, "hidden": True, "priority": 0, "votes": 0}
+		elif op["op"] == "remove":
+			drop(f"{op['host']}:27017")
+		elif op["op"] == "sync":
+			live = {f"{host}:27017" for host in op["hosts"]}
+			for host in [h for h in members if h not in live and h not in healthy]:
+				drop(host)
+		else:
+			logger.error(f"Unknown sync op {op}")
+	return list(members.values())
+
+
+def apply_member_ops(ops: List[dict]):
+	"""
+	Applies the membership `ops` to the Mongo ReplSet in a single reconfig, if they change it
+	"""
+	with mongo_connection() as conn:
+		conf = conn.admin.command({"replSetGetConfig": 1})["config"]
+		status = conn.admin.command({"replSetGetStatus": 1})
+		healthy = {m["name"] for m in status["members"] if m.get("health")}
+		members = reconcile_members(conf["members"], ops, healthy)
+		if members == conf["members"]:
+			return
+		conf["members"] = members
+		conf["version"] += 1
+		res = conn.admin.command({"replSetReconfig": conf})
 		logger.info(res)
-	ch.basic_ack(delivery_tag=method.delivery_tag)
+
+
+class SyncBatcher:
+	"""
+	Buffers the membership changes consumed from syncQ and applies them to the Mongo ReplSet together,
+	once `batch_size` are buffered or `linger` seconds after the first one arrived,
+	so that a large scale operation costs one reconfig instead of one per slave
+	"""
+	def __init__(self, connection, channel, batch_size=sync_batch_size, linger=sync_linger):
+		self.connection = connection
+		self.channel = channel
+		self.batch_size = batch_size
+		self.linger = linger
+		self.ops: List[dict] = []
+		self.last_tag = None
+		self.timer = None
+
+	def callback(self, ch, method, props, body):
+		"""
+		Buffers the membership change of a syncQ message
+		"""
+		body = body.decode("utf-8")
+		logger.info(f"syncQ {body}")
+
+		self.ops.append(sync_op(body))
+		self.last_tag = method.delivery_tag
+
+		if len(self.ops) >= self.batch_size:
+			self.flush()
+		elif self.timer is None:
+			self.timer = self.connection.call_later(self.linger, self.flush)
+
+	def flush(self):
+		"""
+		Applies the buffered membership changes to the ReplSet and acknowledges their messages
+		"""
+		if self.timer is not None:
+			self.connection.remove_timeout(self.timer)
+			self.timer = None
+		if not self.ops:
+			return
+
+		try:
+			with hop_timer("replset_reconfig"):
+				apply_member_ops(self.ops)
+		except Exception as e:
+			logger.error(f"Error reconfiguring the ReplSet with {self.ops}. {e}")
+		self.channel.basic_ack(delivery_tag=self.last_tag, multiple=True)
+		self.ops = []
 
 
 def consume_sync():
 	"""
-	Listens for new slave workers
+	Listens for slave workers joining and leaving
 	"""
 	logger.info("Consuming Sync")
 	with rabbit_channel() as channel:
-		channel.basic_consume(queue="syncQ", on_message_callback=mongo_sync_callback)
+		batcher = SyncBatcher(channel.connection, channel)
+		channel.basic_qos(prefetch_count=sync_batch_size)
+		channel.basic_consume(queue="syncQ", on_message_callback=batcher.callback)
 		channel.start_consuming()
 
 
@@ -75,16 +334,30 @@ if __name__ == "__main__":
 	# Starts the Mongo daemon on the worker host
 	start_mongo()
 
+	# Log MongoClient pool and operation latency stats periodically, and serve the metrics
+	log_stats()
+	serve_metrics()
+
 	# Establish yourself as master of Mongo ReplSet
-	with mongo_connection() as conn:
-		config = {"_id": "rs0", "members": [{"_id": 0, "host": "worker-master:27017"}]}
-		conn.admin.command("replSetInitiate", config)
+	try:
+		with mongo_connection() as conn:
+			config = {"_id": "rs0", "members": [{"_id": 0, "host": "worker-master:27017"}]}
+			conn.admin.command("replSetInitiate", config)
+	except OperationFailure as e:
+		# Already initiated, by the run before a restart
+		logger.info(f"ReplSet not initiated. {e}")
+
+	# Build the declared indexes, once this node is primary and can take writes
+	wait_for_primary()
+	ensure_indexes()
 
 	# Listen to new workers on a separate thread
 	t = Thread(target=consume_sync).start()
 
 	# Listen to write requests on writeQ
 	with rabbit_channel() as channel:
-		channel.basic_consume(queue="writeQ", on_message_callback=write_db_callback)
+		batcher = WriteBatcher(channel.connection, channel)
+		channel.basic_qos(prefetch_count=write_batch_size)
+		channel.basic_consume(queue="writeQ", on_message_callback=batcher.callback)
 		logger.info("Listening for requests...")
 		channel.start_consuming()
@@ -0,0 +1,60 @@
+"""
+	RideShare (Cloud Computing Project)
+	metrics.py: Prometheus metrics of the worker, served in text format on `metrics_port`
+"""
+
+from contextlib import contextmanager
+from time import monotonic, time
+
+from prometheus_client import Counter, Histogram, start_http_server
+
+from config import metrics_port
+
+# Message sizes, from empty to a large read
+size_buckets = (0, 64, 256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304)
+
+queue_wait = Histogram(
+	"queue_wait_seconds", "Time messages waited in their queue, from publish to consume", ["queue"]
+)
+hop_latency = Histogram("hop_duration_seconds", "Latency of the processing steps of messages", ["hop"])
+mongo_latency = Histogram("mongo_operation_duration_seconds", "Latency of MongoDB operations", ["command"])
+payload_size = Histogram(
+	"payload_size_bytes", "Size of consumed messages and published replies", ["queue", "direction"],
+	buckets=size_buckets,
+)
+errors = Counter("errors_total", "Failed messages and MongoDB operations", ["where"])
+log_dropped = Counter("log_records_dropped_total", "Log records dropped as the queue of the log writer was full")
+spans_dropped = Counter("spans_dropped_total", "Spans dropped as the queue of the span collector was full")
+
+
+def record_consume(queue: str, props, body: bytes):
+	"""
+	Records the size of a message consumed from `queue`, and how long it waited there
+	when its publisher stamped the `sent_at` header
+	"""
+	sent_at = (props.headers or {}).get("sent_at")
+	if sent_at is not None:
+		queue_wait.labels(queue).observe(max(0.0, time() - sent_at))
+	payload_size.labels(queue, "in").observe(len(body))
+
+
+@contextmanager
+def hop_timer(hop: str):
+	"""
+	Records the latency and the errors of the block it wraps under `hop`
+	"""
+	start = monotonic()
+	try:
+		yield
+	except Exception:
+		errors.labels(hop).inc()
+		raise
+	finally:
+		hop_latency.labels(hop).observe(monotonic() - start)
+
+
+def serve_metrics(port: int = metrics_port):
+	"""
+	Serves the metrics on `port` from a background thread
+	"""
+	start_http_server(port)
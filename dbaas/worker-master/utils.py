@@ -4,34 +4,52 @@
 """
 
 import logging
+import threading
 from contextlib import contextmanager
+from json import dumps
 from os import system
-from time import sleep
+from time import monotonic, sleep
+from typing import Dict
 
 import pika
-from pymongo import MongoClient
+from pymongo import MongoClient, monitoring
 
-from config import mongodb_host, rmq_host
+from config import (log_file, mongo_connect_timeout_ms, mongo_pool_size,
+                    mongo_ready_timeout, mongo_server_selection_timeout_ms,
+                    mongo_socket_timeout_ms, mongodb_host,
+                    primary_ready_timeout, ready_poll_interval, rmq_host,
+                    rmq_ready_timeout, stats_interval)
+from logs import setup_logging
+from metrics import errors, mongo_latency
 
 # ## Logger
-logging.basicConfig(
-	level=logging.INFO,
-	format="%(asctime)s %(levelname)-8s %(message)s",
-	filename="worker-master.log",
-)
+setup_logging(log_file)
 logger = logging.getLogger()
 
 
 # ## RMQ
+def rmq_connection(rmq_host=rmq_host, timeout: float = rmq_ready_timeout) -> pika.BlockingConnection:
+	"""
+	Connects to RMQ, retrying until the broker accepts the connection or `timeout` seconds have passed
+	"""
+	deadline = monotonic() + timeout
+	while True:
+		try:
+			return pika.BlockingConnection(pika.ConnectionParameters(host=rmq_host, heartbeat=0))
+		except pika.exceptions.AMQPConnectionError as e:
+			if monotonic() >= deadline:
+				raise
+			logger.info(f"Waiting for RMQ. {e}")
+			sleep(ready_poll_interval)
+
+
 @contextmanager
 def rabbit_channel(rmq_host=rmq_host):
 	"""
 	Connects to RMQ, generates a channel and closes the connection when processing is done
 	"""
+	connection = rmq_connection(rmq_host)
 	try:
-		connection = pika.BlockingConnection(
-			pika.ConnectionParameters(host=rmq_host, heartbeat=0)
-		)
 		yield connection.channel()
 	except Exception as e:
 		logger.error(f"Error connecting to RMQ. {e}")
@@ -39,7 +57,7 @@ def rabbit_channel(rmq_host=rmq_host):
 		connection.close()
 
 
-q_names = ["writeQ", "syncQ"]
+q_names = ["writeQ", "syncQ", "deadQ"]
 
 # Declare required queues
 with rabbit_channel(rmq_host) as rmq_channel:
@@ -48,42 +66,200 @@ with rabbit_channel(rmq_host) as rmq_channel:
 			rmq_channel.queue_declare(queue=q_name, durable=True)
 		except Exception as e:
 			logger.error(f"Error while declaring queue {q_name}. {e}")
+	# Flushed writes are announced to every orchestrator process, each binding a queue of its own
+	rmq_channel.exchange_declare(exchange="writesApplied", exchange_type="fanout", durable=True)
 
 
 # ## Mongo
 def start_mongo(mongo_host=mongodb_host):
 	"""
-	Starts the mongo daemon with the ReplSet option in the background
+	Starts the mongo daemon with the ReplSet option in the background, and waits until it answers
 	"""
 	system(f"mongod --replSet rs0 --bind_ip {mongo_host} --port 27017 &")
-	sleep(30)
+	wait_for_mongo(mongo_host)
+
+
+class MongoStats(monitoring.CommandListener, monitoring.ConnectionPoolListener):
+	"""
+	Records the latency of every operation, and the activity of the connection pool, of the MongoClient
+	"""
+	def __init__(self):
+		self.lock = threading.Lock()
+		# command name -> {count, failed, total_ms, max_ms}
+		self.ops: Dict[str, Dict[str, float]] = {}
+		self.pool = {
+			"created": 0, "closed": 0, "checked_out": 0,
+			"checkouts": 0, "checkout_failed": 0, "cleared": 0,
+		}
+
+	def record(self, event, failed: bool):
+		ms = event.duration_micros / 1000
+		mongo_latency.labels(event.command_name).observe(ms / 1000)
+		if failed:
+			errors.labels("mongo").inc()
+		with self.lock:
+			op = self.ops.setdefault(
+				event.command_name, {"count": 0, "failed": 0, "total_ms": 0.0, "max_ms": 0.0}
+			)
+			op["count"] += 1
+			op["failed"] += failed
+			op["total_ms"] += ms
+			op["max_ms"] = max(op["max_ms"], ms)
+
+	def count(self, key: str, n: int = 1):
+		with self.lock:
+			self.pool[key] += n
+
+	# CommandListener
+	def started(self, event):
+		pass
+
+	def succeeded(self, event):
+		self.record(event, False)
+
+	def failed(self, event):
+		self.record(event, True)
+
+	# ConnectionPoolListener
+	def pool_created(self, event):
+		pass
+
+	def pool_cleared(self, event):
+		self.count("cleared")
+
+	def pool_closed(self, event):
+		pass
+
+	def connection_created(self, event):
+		self.count("created")
+
+	def connection_ready(self, event):
+		pass
+
+	def connection_closed(self, event):
+		self.count("closed")
+
+	def connection_check_out_started(self, event):
+		pass
+
+	def connection_check_out_failed(self, event):
+		self.count("checkout_failed")
+
+	def connection_checked_out(self, event):
+		self.count("checkouts")
+		self.count("checked_out")
+
+	def connection_checked_in(self, event):
+		self.count("checked_out", -1)
+
+	def stats(self) -> dict:
+		"""
+		Returns the pool counters (with the number of open connections) and per operation latencies
+		"""
+		with self.lock:
+			return {
+				"pool": {**self.pool, "open": self.pool["created"] - self.pool["closed"]},
+				"ops": {
+					name: {
+						"count": op["count"],
+						"failed": op["failed"],
+						"avg_ms": round(op["total_ms"] / op["count"], 3),
+						"max_ms": round(op["max_ms"], 3),
+					}
+					for name, op in self.ops.items()
+				},
+			}
+
+
+mongo_stats = MongoStats()
+_mongo_clients: Dict[str, MongoClient] = {}
+_mongo_clients_lock = threading.Lock()
+
+
+def mongo_client(mongo_host=mongodb_host) -> MongoClient:
+	"""
+	Returns the process-wide MongoClient of `mongo_host`, creating it on first use.
+	The client is never closed: its connection pool serves every read/write of the process
+	"""
+	with _mongo_clients_lock:
+		if mongo_host not in _mongo_clients:
+			_mongo_clients[mongo_host] = MongoClient(
+				mongo_host,
+				27017,
+				readPreference="secondaryPreferred",
+				maxPoolSize=mongo_pool_size,
+				connectTimeoutMS=mongo_connect_timeout_ms,
+				serverSelectionTimeoutMS=mongo_server_selection_timeout_ms,
+				socketTimeoutMS=mongo_socket_timeout_ms,
+				event_listeners=[mongo_stats],
+			)
+		return _mongo_clients[mongo_host]
 
 
 @contextmanager
 def mongo_collection(collection, mongo_host=mongodb_host):
 	"""
-	Connects to mongo,
-	returns the collection object of `collection`,
-	and closes the connection after processing is done
+	Returns the collection object of `collection`, on the pooled client. Errors are logged and raised
 	"""
 	try:
-		client = MongoClient(mongo_host, 27017, readPreference="secondaryPreferred")
-		yield client["cc"][collection]
+		yield mongo_client(mongo_host)["cc"][collection]
 	except Exception as e:
-		logger.error(f"Error connecting to MongoDB. {e}")
-	finally:
-		client.close()
+		logger.error(f"Error in MongoDB operation. {e}")
+		raise
 
 
 @contextmanager
 def mongo_connection(mongo_host=mongodb_host):
 	"""
-	Connects to mongo, returns the connection object and closes the connection after processing is done
+	Returns the pooled client. Errors are logged and raised
 	"""
 	try:
-		client = MongoClient(mongo_host, 27017, readPreference="secondaryPreferred")
-		yield client
+		yield mongo_client(mongo_host)
 	except Exception as e:
-		logger.error(f"Error connecting to MongoDB. {e}")
-	finally:
-		client.close()
+		logger.error(f"Error in MongoDB operation. {e}")
+		raise
+
+
+def log_stats(interval: int = stats_interval):
+	"""
+	Logs the MongoClient stats every `interval` seconds on a separate thread
+	"""
+	def log():
+		while True:
+			sleep(interval)
+			logger.info(f"Mongo stats {dumps(mongo_stats.stats())}")
+
+	threading.Thread(target=log, daemon=True).start()
+
+
+def wait_until(check, timeout: float) -> bool:
+	"""
+	Polls `check` every `ready_poll_interval` seconds until it returns True, or `timeout` seconds have passed
+	Errors raised by `check` count as not ready. Returns whether `check` passed
+	"""
+	deadline = monotonic() + timeout
+	while True:
+		try:
+			if check():
+				return True
+		except Exception as e:
+			logger.debug(f"Not ready. {e}")
+		if monotonic() >= deadline:
+			return False
+		sleep(ready_poll_interval)
+
+
+def wait_for_mongo(mongo_host=mongodb_host, timeout: float = mongo_ready_timeout):
+	"""
+	Waits until the mongo daemon answers pings, or `timeout` seconds have passed
+	"""
+	if not wait_until(lambda: mongo_client(mongo_host).admin.command("ping").get("ok"), timeout):
+		logger.error(f"mongod not answering after {timeout}s")
+
+
+def wait_for_primary(timeout: float = primary_ready_timeout):
+	"""
+	Waits until the mongo daemon is the primary of the ReplSet, or `timeout` seconds have passed
+	"""
+	if not wait_until(lambda: mongo_client().admin.command("isMaster").get("ismaster"), timeout):
+		logger.error(f"Not primary after {timeout}s")
@@ -1,5 +1,46 @@
-from os import popen
+from os import environ, popen
 
 rmq_host = "rabbitmq"  # hostname of RMQ container
+rmq_ready_timeout = 60  # seconds to keep retrying to connect to RMQ while it starts
+mongo_ready_timeout = 60  # seconds to wait for mongod to answer pings once started
+secondary_ready_timeout = 600  # seconds to wait for the initial sync, after which this node is secondary
+ready_poll_interval = 0.5  # seconds between two readiness checks
+publisher_pool_size = 1  # channels kept open by the publisher
+publish_timeout = 30  # seconds to wait for a publisher confirm
+read_ops = {"find", "count", "distinct", "aggregate", "indexes"}  # operations a read query may run
+# aggregation stages a read query may use; none of them write or read other collections
+aggregate_stages = {
+	"$match", "$project", "$addFields", "$unwind", "$group",
+	"$sort", "$skip", "$limit", "$count", "$sortByCount",
+}
+find_options = ["projection", "sort", "limit", "skip"]  # options a find read query may push down
+# reads run in parallel, set by the orchestrator through the environment of spawned slaves
+read_concurrency = int(environ.get("READ_CONCURRENCY", 4))
+# reads RMQ may push to this slave before they are acked
+read_prefetch = int(environ.get("READ_PREFETCH", 2 * read_concurrency))
+# "standby" slaves join the ReplSet and sync, but only consume readQ once activated through their control queue
+slave_mode = environ.get("SLAVE_MODE", "active")
+# file keeping the mode this slave was last switched to, across restarts of its container; it overrides SLAVE_MODE
+mode_file = "/data/slave-mode"
+stream_chunk_size = 500  # documents per chunk of a streamed read
+stream_window = 2  # chunks of a streamed read sent ahead of the credits the orchestrator returns for consumed ones
+stream_credit_timeout = 30  # seconds to wait for a credit before a streamed read is abandoned
+mongo_pool_size = 50  # max connections in the MongoClient pool
+mongo_connect_timeout_ms = 5000  # timeout to open a connection to mongod
+mongo_server_selection_timeout_ms = 10000  # timeout to find mongod able to serve an operation
+mongo_socket_timeout_ms = 30000  # timeout of a single operation on a connection
+stats_interval = 60  # seconds between two stats log lines
+metrics_port = 8000  # port the Prometheus metrics are served on
+service_name = "worker-slave"  # service spans are recorded under
+spans_file = "spans.jsonl"  # local collector file spans are appended to, one JSON object per line
+span_queue_size = 10000  # finished spans waiting to be written before new ones are dropped
+log_file = "worker-slave.log"  # file the logs of the service are written to, as JSON lines
+log_max_chars = 1000  # longest logged value, longer ones are truncated
+log_queue_size = 10000  # log records waiting to be written before new ones are dropped
+# fraction of the records below WARNING written per logger, others are written in full
+log_sample_rates = {"reads": 0.1}
+mongo_dbpath = "/data/db"  # data files of mongod
+snapshot_dir = "/snapshots"  # shared volume holding the data snapshots new slaves are seeded from
+snapshot_keep = 2  # snapshots kept on the volume, older ones may still be copied by a slave seeding from them
 mongodb_host: str = popen("hostname").read().strip()  # find your hostname
 # mongodb_host = "worker-master"
@@ -0,0 +1,141 @@
+"""
+	RideShare (Cloud Computing Project)
+	logs.py: logging off the request thread: records are queued, sampled, and written as JSON lines by a background thread
+"""
+
+import atexit
+import logging
+from json import dumps
+from logging.handlers import QueueListener
+from queue import Full, Queue
+from random import random
+from reprlib import Repr
+from typing import Any, Dict
+
+from config import log_max_chars, log_queue_size, log_sample_rates
+from metrics import log_dropped
+from tracing import current_span
+
+# Bounded representation of logged values: a large result set costs a few elements, not its whole size
+_repr = Repr()
+_repr.maxlist = _repr.maxdict = _repr.maxset = _repr.maxtuple = 20
+_repr.maxlevel = 4
+_repr.maxstring = _repr.maxother = log_max_chars
+
+
+def truncate(value: Any) -> str:
+	"""
+	Returns `value` as text of at most about `log_max_chars` characters
+	"""
+	text = value if isinstance(value, str) else _repr.repr(value)
+	if len(text) > log_max_chars:
+		return f"{text[:log_max_chars]}...(+{len(text) - log_max_chars} chars)"
+	return text
+
+
+def frozen(value: Any) -> Any:
+	"""
+	Returns `value` if it can't change, so that it still fits its %d or %f, else its truncated text
+	"""
+	return value if isinstance(value, (int, float, type(None))) else truncate(value)
+
+
+class JsonFormatter(logging.Formatter):
+	"""
+	Formats a record as one JSON object
+	"""
+	def format(self, record: logging.LogRecord) -> str:
+		msg, args = record.msg, record.args
+		try:
+			message = msg % args if args else msg
+		except (TypeError, ValueError):
+			message = f"{msg} {args}"
+		entry = {
+			"time": record.created,
+			"level": record.levelname,
+			"logger": record.name,
+			"message": truncate(message),
+		}
+		for field in ("trace_id", "exc_text"):
+			if getattr(record, field, None):
+				entry[field] = record.__dict__[field]
+		return dumps(entry)
+
+
+class SampleFilter(logging.Filter):
+	"""
+	Keeps a fraction `rates[logger]` of the records of each logger below WARNING; warnings and errors are always kept
+	"""
+	def __init__(self, rates: Dict[str, float] = log_sample_rates):
+		super().__init__()
+		self.rates = rates
+
+	def filter(self, record: logging.LogRecord) -> bool:
+		if record.levelno >= logging.WARNING:
+			return True
+		rate = self.rates.get(record.name, 1)
+		return rate >= 1 or random() < rate
+
+
+class QueuedFileHandler(logging.Handler):
+	"""
+	Hands records over to a bounded queue, drained into `filename` by a background thread,
+	so that logging never waits on formatting or on the disk. Records are dropped, and counted
+	in log_records_dropped_total, when the queue is full
+	"""
+	def __init__(self, filename: str, size: int = log_queue_size):
+		super().__init__()
+		self.queue = Queue(size)
+		# logging closes every handler created at exit, this one too if opening the file fails
+		self.listener = None
+		handler = logging.FileHandler(filename)
+		handler.setFormatter(JsonFormatter())
+		self.listener = QueueListener(self.queue, handler)
+		self.listener.start()
+		# Writes the records still queued on a clean exit
+		atexit.register(self.close)
+
+	def close(self):
+		"""
+		Stops the thread writing the records, once it has written those queued, and closes the file
+		"""
+		if self.listener is not None:
+			self.listener.stop()
+			for handler in self.listener.handlers:
+				handler.close()
+			self.listener = None
+		super().close()
+
+	def emit(self, record: logging.LogRecord):
+		# Read here, as the writer thread isn't in the span of the message
+		s = current_span()
+		if s is not None:
+			record.trace_id = s.trace_id
+		# Arguments are cut down to a bounded text now, as the objects logged may change before the record is written;
+		# putting them in the message, encoding and writing it are left to the writer thread
+		record.msg = truncate(record.msg)
+		if isinstance(record.args, tuple):
+			record.args = tuple(frozen(arg) for arg in record.args)
+		elif record.args:
+			record.args = frozen(record.args)
+		# A traceback can't wait to be formatted, its frames would be gone
+		if record.exc_info:
+			record.exc_text = logging.Formatter().formatException(record.exc_info)
+			record.exc_info = None
+		try:
+			self.queue.put_nowait(record)
+		except Full:
+			log_dropped.inc()
+
+
+def setup_logging(filename: str, level: int = logging.INFO):
+	"""
+	Sends the records of every logger, at `level` and above, through a QueuedFileHandler writing to `filename`.
+	Calling it again, from another module of the same process, does nothing
+	"""
+	root = logging.getLogger()
+	root.setLevel(level)
+	if not any(isinstance(h, QueuedFileHandler) for h in root.handlers):
+		handler = QueuedFileHandler(filename)
+		handler.addFilter(SampleFilter())
+		root.addHandler(handler)
@@ -3,56 +3,376 @@
 	main.py: python file containing the DB Slave-worker logic
 """
 
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 from json import dumps, loads
 from sys import argv
-from time import sleep
-from typing import Any
+from threading import Lock, Semaphore, Thread
+from time import monotonic
+from typing import Any, Dict, Iterator, List, Tuple
 
 import pika
+from pymongo.collection import Collection
+from pymongo.cursor import Cursor
+from pymongo.errors import OperationFailure
 
-from utils import (logger, mongo_collection, push_to_Q, rabbit_channel,
-                   start_mongo)
+from config import (aggregate_stages, find_options, mode_file,
+                    read_concurrency, read_ops, read_prefetch, slave_mode,
+                    stream_chunk_size, stream_credit_timeout, stream_window)
+from metrics import (errors, hop_latency, hop_timer, payload_size,
+                     record_consume, serve_metrics)
+from tracing import span, traced
+from utils import (log_stats, logger, mongo_collection, mongo_connection,
+                   push_to_Q, rabbit_channel, start_mongo, take_snapshot,
+                   wait_for_secondary)
 
+# Logs every read, sampled (see log_sample_rates)
+read_logger = logging.getLogger("reads")
 
-def read_db(collection: str, filte: dict = {}) -> Any:
+
+def check_query(op: str = "find", key: str = None, pipeline: List[dict] = None, **kwargs):
+	"""
+	Raises ValueError if a read query asks for an operation the DBaaS doesn't allow
+	"""
+	if op != "find" and set(kwargs) & set(find_options):
+		raise ValueError(f"{', '.join(find_options)} only apply to find")
+	if op != "find" and kwargs.get("stream"):
+		raise ValueError("Only find reads can be streamed")
+	if op not in read_ops:
+		raise ValueError(f"Unknown read op {op}")
+	if op == "distinct" and not key:
+		raise ValueError("distinct needs a key")
+	if op == "aggregate":
+		for stage in pipeline or []:
+			if len(stage) != 1 or not set(stage) <= aggregate_stages:
+				raise ValueError(f"Aggregation stage not allowed {stage}")
+
+
+def find(
+	collection: Collection,
+	filte: dict = {},
+	projection: dict = None,
+	sort: List[list] = None,
+	limit: int = 0,
+	skip: int = 0,
+	**kwargs,
+) -> Cursor:
 	"""
-	Returns list of documents from `collection` on query `filte`
+	Returns the cursor over documents of the Collection object `collection` on query `filte`,
+	with the fields in `projection`, ordered by `sort`, skipping `skip` and returning at most `limit` (0 for all) of them
 	"""
-	logger.info(f"Read DB {collection} {filte}")
+	return collection.find(
+		filte or {},
+		{"_id": 0, **(projection or {})},
+		sort=[tuple(s) for s in sort] if sort else None,
+		limit=limit or 0,
+		skip=skip or 0,
+	)
+
+
+def run_query(
+	collection: Collection,
+	filte: dict = {},
+	op: str = "find",
+	key: str = None,
+	pipeline: List[dict] = None,
+	**options,
+) -> Any:
+	"""
+	Runs read query `op` on the Collection object `collection`:
+	- find returns the list of documents found by find()
+	- count returns the number of documents on query `filte`
+	- distinct returns the list of distinct values of `key` on query `filte`
+	- aggregate returns the list of documents output by `pipeline`, run on the documents matching `filte`
+	- indexes returns the list of indexes of the collection
+	"""
+	filte = filte or {}
+	if op == "indexes":
+		return list(collection.list_indexes())
+	elif op == "count":
+		return collection.count_documents(filte)
+	elif op == "distinct":
+		return collection.distinct(key, filte)
+	elif op == "aggregate":
+		return list(collection.aggregate([{"$match": filte}, *(pipeline or [])]))
+	return list(find(collection, filte, **options))
+
+
+@traced("read_db")
+def read_db(collection: str, filte: dict = {}, **options) -> Any:
+	"""
+	Returns the result of read query `options["op"]` (default find) from `collection` on query `filte`
+	"""
+	read_logger.info("Read DB %s %s %s", collection, filte, options)
 	with mongo_collection(collection) as collection:
-		return list(collection.find(filte, {"_id": 0}))
+		return run_query(collection, filte, **options)
 
 
-def read_db_callback(ch, method, props, body):
+@traced("read_db_batch")
+def read_db_batch(queries: List[dict]) -> List[Any]:
 	"""
-	Returns the data from DB to the respQ with the correlation_id received with query
+	Returns, in order, the result of each read query, running all of them over one Mongo connection
 	"""
-	args = loads(body.decode("utf-8"))
-	logger.info(f"Read {body}")
-	# Reads from the DB
-	response = read_db(args["collection"], args["filte"])
+	read_logger.info("Read DB batch of %d", len(queries))
+	with mongo_connection() as client:
+		return [
+			run_query(client["cc"][query["collection"]], **{k: v for k, v in query.items() if k != "collection"})
+			for query in queries
+		]
 
-	# Publish the data back to the callback queue and acknowledge message
-	ch.basic_publish(
-		exchange="",
-		routing_key=props.reply_to,
-		properties=pika.BasicProperties(correlation_id=props.correlation_id),
-		body=dumps(response),
-	)
-	ch.basic_ack(delivery_tag=method.delivery_tag)
+
+def stream_db(
+	collection: str, filte: dict = {}, chunk_size: int = stream_chunk_size, **options
+) -> Iterator[Tuple[List[dict], bool]]:
+	"""
+	Yields the documents of a find read query on `collection` in chunks of `chunk_size`,
+	along with whether the chunk is the last one. The cursor is iterated lazily,
+	so only one chunk is held in memory whatever the number of documents
+	"""
+	read_logger.info("Stream DB %s %s %s", collection, filte, options)
+	with mongo_collection(collection) as collection:
+		chunk = []
+		for document in find(collection, filte, **options).batch_size(chunk_size):
+			chunk.append(document)
+			if len(chunk) == chunk_size:
+				yield chunk, False
+				chunk = []
+		yield chunk, True
+
+
+class ReadWorkers:
+	"""
+	Runs the read queries consumed from readQ on a pool of `concurrency` threads.
+	pika channels aren't thread safe, so replies and acks are handed back to the connection thread,
+	which runs them in the order they were handed over. A message is acked on its own,
+	only after its reply is published, so reads left unanswered by a crash get redelivered.
+	Streamed reads are flow controlled: `window` chunks are sent ahead, then one more per credit the orchestrator
+	returns, through direct reply-to, for each chunk it consumed, so a slow client holds the stream back
+	"""
+	reply_queue = "amq.rabbitmq.reply-to"
+
+	def __init__(self, connection, channel, concurrency=read_concurrency, window=stream_window):
+		self.connection = connection
+		self.channel = channel
+		self.executor = ThreadPoolExecutor(max_workers=concurrency)
+		self.window = window
+		# correlation_id -> credits of the stream
+		self.credits: Dict[str, Semaphore] = {}
+		self.credits_lock = Lock()
+		self.channel.basic_consume(queue=self.reply_queue, on_message_callback=self.on_credit, auto_ack=True)
+
+	def threadsafe(self, callback, *args, **kwargs):
+		"""
+		Runs `callback` on the connection thread
+		"""
+		self.connection.add_callback_threadsafe(partial(callback, *args, **kwargs))
+
+	def reply(self, props, response: Any, headers: dict = None, credited: bool = False):
+		"""
+		Publishes `response` back to the callback queue with the correlation_id received with the query
+		Values that aren't JSON (like the ObjectIds an aggregation may return) are sent as strings.
+		Chunks of streamed reads ask for their credit back through direct reply-to
+		"""
+		body = dumps(response, default=str)
+		payload_size.labels("readQ", "out").observe(len(body))
+		self.threadsafe(
+			self.channel.basic_publish,
+			exchange="",
+			routing_key=props.reply_to,
+			properties=pika.BasicProperties(
+				correlation_id=props.correlation_id,
+				headers=headers,
+				reply_to=self.reply_queue if credited else None,
+			),
+			body=body,
+		)
+
+	def on_credit(self, ch, method, props, body):
+		"""
+		Triggered when the orchestrator consumed a chunk of a stream, lets the stream send one more
+		"""
+		with self.credits_lock:
+			credits = self.credits.get(props.correlation_id)
+		if credits is not None:
+			credits.release()
+
+	def stream(self, props, args: dict):
+		"""
+		Replies to a streamed read in chunks, numbered by the `seq` header, the final one with the `last` header,
+		waiting for a credit before each chunk past the window
+		"""
+		credits = Semaphore(self.window)
+		with self.credits_lock:
+			self.credits[props.correlation_id] = credits
+		sent, last, error = -1, False, "Read failed"
+		try:
+			with span("stream_db"):
+				for seq, (chunk, last) in enumerate(stream_db(**args)):
+					if not credits.acquire(timeout=stream_credit_timeout):
+						logger.error(f"No credit for chunk {seq} of stream {props.correlation_id}, abandoning it")
+						errors.labels("stream_credit").inc()
+						last = False
+						break
+					self.reply(props, chunk, {"seq": seq, "last": last}, credited=True)
+					sent = seq
+		except Exception as e:
+			logger.error(f"Stream failed {e}")
+			last = False
+			if isinstance(e, OperationFailure):
+				errors.labels("bad_read").inc()
+				error = f"Read failed. {e}"
+		finally:
+			with self.credits_lock:
+				self.credits.pop(props.correlation_id, None)
+		# The stream was cut short by a DB error, or abandoned
+		if not last:
+			self.reply(props, None, {"error": error, "seq": sent + 1, "last": True})
+
+	def callback(self, ch, method, props, body):
+		"""
+		Hands a message consumed from readQ over to the pool
+		"""
+		record_consume("readQ", props, body)
+		self.executor.submit(self.read, method.delivery_tag, props, body, monotonic())
+
+	def read(self, delivery_tag, props, body, consumed_at: float):
+		"""
+		Runs a read query on a thread of the pool, and acknowledges its message
+		"""
+		# Time spent lined up for a thread of the pool, after the time spent in readQ
+		pool_wait = monotonic() - consumed_at
+		hop_latency.labels("read_pool_wait").observe(pool_wait)
+		traceparent = (props.headers or {}).get("traceparent")
+		try:
+			with hop_timer("read"), span("read", traceparent, pool_wait_s=pool_wait):
+				self.run(props, body)
+		except Exception as e:
+			logger.error(f"Read failed {e}")
+		finally:
+			# Acknowledge message
+			self.threadsafe(self.channel.basic_ack, delivery_tag=delivery_tag)
+
+	def run(self, props, body):
+		"""
+		Returns the data from DB to the respQ with the correlation_id received with query
+		Invalid queries, and queries Mongo rejects, get an empty response with the reason in the `error` header
+		Streamed queries get their response in chunks, numbered by the `seq` header, the final one with the `last` header
+		"""
+		try:
+			args = loads(body.decode("utf-8"))
+			read_logger.info("Read %s", body)
+			for query in args.get("batch", [args]):
+				check_query(**query)
+		except ValueError as e:
+			logger.error(f"Bad read {e}")
+			errors.labels("bad_read").inc()
+			self.reply(props, None, {"error": str(e)})
+		else:
+			# Reads from the DB
+			if args.get("stream"):
+				self.stream(props, args)
+				return
+			try:
+				result = read_db_batch(args["batch"]) if "batch" in args else read_db(**args)
+			except OperationFailure as e:
+				logger.error(f"Bad read {e}")
+				errors.labels("bad_read").inc()
+				self.reply(props, None, {"error": f"Read failed. {e}"})
+			else:
+				self.reply(props, result)
+
+
+class ReadSwitch:
+	"""
+	Starts and stops consuming readQ on activate/deactivate commands from the control queue of this slave.
+	A standby slave keeps mongod running and in the ReplSet, so activating it is just a basic_consume.
+	Standby slaves are also asked to take the snapshots new slaves are seeded from.
+	The mode is saved before the command is acked, so that a slave restarted after a failure comes back in it,
+	rather than in the mode it was spawned with
+	"""
+	def __init__(self, channel, workers: ReadWorkers, mode_file: str = mode_file):
+		self.channel = channel
+		self.workers = workers
+		self.mode_file = mode_file
+		self.consumer_tag = None
+
+	def saved_mode(self) -> str:
+		"""
+		Returns the mode this slave was last switched to, else the one it was spawned with
+		"""
+		try:
+			with open(self.mode_file) as f:
+				return f.read().strip() or slave_mode
+		except FileNotFoundError:
+			return slave_mode
+
+	def save_mode(self, mode: str):
+		with open(self.mode_file, "w") as f:
+			f.write(mode)
+
+	def activate(self):
+		self.save_mode("active")
+		if self.consumer_tag is None:
+			self.consumer_tag = self.channel.basic_consume(queue="readQ", on_message_callback=self.workers.callback)
+			logger.info("Listening for requests...")
+
+	def deactivate(self):
+		self.save_mode("standby")
+		# Reads already delivered still get their reply and ack from the pool
+		if self.consumer_tag is not None:
+			self.channel.basic_cancel(self.consumer_tag)
+			self.consumer_tag = None
+			logger.info("Standing by...")
+
+	def snapshot(self):
+		try:
+			take_snapshot()
+		except Exception as e:
+			logger.error(f"Error taking snapshot. {e}")
+
+	def callback(self, ch, method, props, body):
+		"""
+		Triggered when a command is received on the control queue
+		"""
+		command = body.decode("utf-8")
+		if command == "activate":
+			self.activate()
+		elif command == "deactivate":
+			self.deactivate()
+		elif command == "snapshot":
+			# Copying the data files takes a while, don't hold up the connection thread
+			Thread(target=self.snapshot, daemon=True).start()
+		else:
+			logger.error(f"Unknown command {command}")
+		ch.basic_ack(delivery_tag=method.delivery_tag)
 
 
 if __name__ == "__main__":
 	# Starts the Mongo daemon on the worker host
 	start_mongo()
 
+	# Log MongoClient pool and operation latency stats periodically, and serve the metrics
+	log_stats()
+	serve_metrics()
+
 	# Notifying master to add you as a worker in the Mongo ReplSet
-	push_to_Q("syncQ", f"worker-slave-{argv[1]}")
+	push_to_Q("syncQ", dumps({"op": "add", "host": f"worker-slave-{argv[1]}"}))
 
-	sleep(3)
+	# Serve reads only once synced, so that they don't see a partial copy of the DB
+	wait_for_secondary()
 
-	# Listen to read requests on readQ
+	# Listen to read requests on readQ, unless standing by, and to commands on the control queue
 	with rabbit_channel() as channel:
-		channel.basic_consume(queue="readQ", on_message_callback=read_db_callback)
-		logger.info("Listening for requests...")
+		workers = ReadWorkers(channel.connection, channel)
+		switch = ReadSwitch(channel, workers)
+		# Have at most read_prefetch reads in this slave at once: some running, the rest lined up for the pool
+		channel.basic_qos(prefetch_count=read_prefetch)
+		control_queue = f"control-worker-slave-{argv[1]}"
+		channel.queue_declare(queue=control_queue, durable=True)
+		channel.basic_consume(queue=control_queue, on_message_callback=switch.callback)
+		if switch.saved_mode() == "active":
+			switch.activate()
+		else:
+			logger.info("Standing by...")
 		channel.start_consuming()
@@ -0,0 +1,133 @@
+"""
+	RideShare (Cloud Computing Project)
+	tracing.py: spans of the messages processed by the worker, continuing the trace of the request
+	from the W3C `traceparent` header of the message, written as JSON lines to a local collector file
+"""
+
+import threading
+from contextlib import contextmanager
+from functools import wraps
+from json import dumps
+from os import urandom
+from queue import Full, Queue
+from time import monotonic, time
+from typing import Optional, Tuple
+
+from config import service_name, span_queue_size, spans_file
+from metrics import spans_dropped
+
+# The span each thread is in
+_local = threading.local()
+
+
+class Span:
+	"""
+	A timed operation of a trace, child of the span `parent_id` (None for the root of the trace)
+	"""
+	def __init__(self, name: str, trace_id: str = None, parent_id: str = None, **attrs):
+		self.name = name
+		self.trace_id = trace_id or urandom(16).hex()
+		self.span_id = urandom(8).hex()
+		self.parent_id = parent_id
+		self.attrs = attrs
+		self.start = time()
+		self.started = monotonic()
+
+	def traceparent(self) -> str:
+		return f"00-{self.trace_id}-{self.span_id}-01"
+
+	def end(self, error: Exception = None):
+		collector.record({
+			"trace_id": self.trace_id,
+			"span_id": self.span_id,
+			"parent_id": self.parent_id,
+			"service": service_name,
+			"name": self.name,
+			"start": self.start,
+			"duration_ms": round(1000 * (monotonic() - self.started), 3),
+			"attrs": self.attrs,
+			"error": repr(error) if error is not None else None,
+		})
+
+
+class SpanCollector:
+	"""
+	Appends finished spans to `path`, one JSON object per line, from a background thread
+	so that recording a span never waits on the disk. At most `size` spans wait to be written,
+	others are dropped and counted in spans_dropped_total
+	"""
+	def __init__(self, path: str = spans_file, size: int = span_queue_size):
+		self.path = path
+		self.queue = Queue(size)
+		threading.Thread(target=self.run, daemon=True).start()
+
+	def record(self, span: dict):
+		try:
+			self.queue.put_nowait(span)
+		except Full:
+			spans_dropped.inc()
+
+	def run(self):
+		with open(self.path, "a") as f:
+			while True:
+				lines = [dumps(self.queue.get())]
+				while not self.queue.empty():
+					lines.append(dumps(self.queue.get()))
+				f.write("\n".join(lines) + "\n")
+				f.flush()
+
+
+collector = SpanCollector()
+
+
+def parse_traceparent(header: Optional[str]) -> Tuple[Optional[str], Optional[str]]:
+	"""
+	Returns the trace and parent span ids of a `traceparent` header, (None, None) if it's missing or malformed
+	"""
+	parts = (header or "").split("-")
+	if len(parts) != 4 or len(parts[1]) != 32 or len(parts[2]) != 16:
+		return None, None
+	return parts[1], parts[2]
+
+
+def current_span() -> Optional[Span]:
+	return getattr(_local, "span", None)
+
+
+@contextmanager
+def span(name: str, traceparent: str = None, **attrs):
+	"""
+	Runs the block it wraps in a new span: a child of the `traceparent` header if given,
+	else of the current span, else the root of a new trace
+	"""
+	parent = current_span()
+	if traceparent is not None:
+		trace_id, parent_id = parse_traceparent(traceparent)
+	elif parent is not None:
+		trace_id, parent_id = parent.trace_id, parent.span_id
+	else:
+		trace_id, parent_id = None, None
+	s = Span(name, trace_id, parent_id, **attrs)
+	_local.span = s
+	try:
+		yield s
+	except Exception as e:
+		s.end(e)
+		raise
+	else:
+		s.end()
+	finally:
+		_local.span = parent
+
+
+def traced(name: str):
+	"""
+	Decorator running every call of a function in a new span `name`
+	"""
+	def decorator(fn):
+		@wraps(fn)
+		def wrapper(*args, **kwargs):
+			with span(name):
+				return fn(*args, **kwargs)
+		return wrapper
+	return decorator
@@ -4,34 +4,57 @@
 """
 
 import logging
+import shutil
+import threading
+from concurrent.futures import Future
 from contextlib import contextmanager
-from os import system
-from time import sleep
+from functools import partial
+from json import dump, dumps, load
+from os import listdir, path, remove, rename, replace, system
+from time import monotonic, sleep, time
+from typing import Dict, Optional, Tuple
 
 import pika
-from pymongo import MongoClient
+from pymongo import MongoClient, monitoring
 
-from config import mongodb_host, rmq_host
+from config import (log_file, mongo_connect_timeout_ms, mongo_dbpath,
+                    mongo_pool_size,
+                    mongo_ready_timeout, mongo_server_selection_timeout_ms,
+                    mongo_socket_timeout_ms, mongodb_host, publish_timeout,
+                    publisher_pool_size, ready_poll_interval, rmq_host,
+                    rmq_ready_timeout, secondary_ready_timeout, snapshot_dir,
+                    snapshot_keep, stats_interval)
+from logs import setup_logging
+from metrics import errors, mongo_latency
 
 # ## Logger
-logging.basicConfig(
-	level=logging.INFO,
-	format="%(asctime)s %(levelname)-8s %(message)s",
-	filename="worker-slave.log",
-)
+setup_logging(log_file)
 logger = logging.getLogger()
 
 
 # ## RMQ
+def rmq_connection(rmq_host=rmq_host, timeout: float = rmq_ready_timeout) -> pika.BlockingConnection:
+	"""
+	Connects to RMQ, retrying until the broker accepts the connection or `timeout` seconds have passed
+	"""
+	deadline = monotonic() + timeout
+	while True:
+		try:
+			return pika.BlockingConnection(pika.ConnectionParameters(host=rmq_host, heartbeat=0))
+		except pika.exceptions.AMQPConnectionError as e:
+			if monotonic() >= deadline:
+				raise
+			logger.info(f"Waiting for RMQ. {e}")
+			sleep(ready_poll_interval)
+
+
 @contextmanager
 def rabbit_channel(rmq_host=rmq_host):
 	"""
 	Connects to RMQ, generates a channel and closes the connection when processing is done
 	"""
+	connection = rmq_connection(rmq_host)
 	try:
-		connection = pika.BlockingConnection(
-			pika.ConnectionParameters(host=rmq_host, heartbeat=0)
-		)
 		yield connection.channel()
 	except Exception as e:
 		logger.error(f"Error connecting to RMQ. {e}")
@@ -50,40 +73,514 @@ with rabbit_channel(rmq_host) as rmq_channel:
 			logger.error(f"Error while declaring queue {q_name}. {e}")
 
 
+class Publisher:
+	"""
+	Process-wide pooled publisher.
+	Keeps one RMQ connection with a pool of confirm-mode channels open on a background IO loop.
+	Each publish resolves once the broker confirms it, and as the broker acks many deliveries
+	in a single frame, confirms get batched across concurrent requests
+	"""
+	def __init__(self, rmq_host=rmq_host, pool_size=publisher_pool_size):
+		"""
+		Start the IO thread owning the RMQ connection and its channels
+		"""
+		self.parameters = pika.ConnectionParameters(host=rmq_host, heartbeat=0)
+		self.pool_size = pool_size
+		self.connection = None
+		self.channels = []
+		self.turn = 0
+		self.ready = threading.Event()
+		# channel_number -> last delivery tag used on that channel
+		self.delivery_tags: Dict[int, int] = {}
+		# channel_number -> {delivery tag: (Future, publish time)}
+		self.unconfirmed: Dict[int, Dict[int, Tuple[Future, float]]] = {}
+		self.counts = {"published": 0, "confirmed": 0, "nacked": 0, "failed": 0}
+		self.outstanding = 0
+		self.latency_total = 0.0
+		self.latency_max = 0.0
+		threading.Thread(target=self.run, daemon=True).start()
+
+	def run(self):
+		"""
+		Runs the IO loop forever, reconnecting if the connection drops.
+		Only this thread touches the connection, other threads hand work over via add_callback_threadsafe
+		"""
+		while True:
+			self.connection = pika.SelectConnection(
+				self.parameters,
+				on_open_callback=self.on_connection_open,
+				on_open_error_callback=self.on_connection_closed,
+				on_close_callback=self.on_connection_closed,
+			)
+			self.connection.ioloop.start()
+			sleep(1)
+
+	def on_connection_open(self, connection):
+		"""
+		Opens the channel pool
+		"""
+		for _ in range(self.pool_size):
+			connection.channel(on_open_callback=self.on_channel_open)
+
+	def on_connection_closed(self, connection, error):
+		"""
+		Fails everything in flight and stops the IO loop, so that run() reconnects
+		"""
+		logger.error(f"Publisher lost RMQ connection. {error}")
+		self.ready.clear()
+		for channel in self.channels:
+			self.fail_unconfirmed(channel.channel_number, error)
+		self.channels = []
+		connection.ioloop.stop()
+
+	def on_channel_open(self, channel):
+		"""
+		Puts a freshly opened channel in confirm mode
+		"""
+		channel.add_on_close_callback(self.on_channel_closed)
+		channel.confirm_delivery(
+			ack_nack_callback=partial(self.on_confirm, channel.channel_number),
+			callback=lambda frame: self.on_confirm_mode(channel),
+		)
+
+	def on_confirm_mode(self, channel):
+		"""
+		Adds a channel to the pool once the broker has switched it to confirm mode
+		"""
+		self.delivery_tags[channel.channel_number] = 0
+		self.unconfirmed[channel.channel_number] = {}
+		self.channels.append(channel)
+		self.ready.set()
+
+	def on_channel_closed(self, channel, reason):
+		"""
+		Drops a closed channel from the pool and replaces it while the connection is up
+		"""
+		if channel in self.channels:
+			self.channels.remove(channel)
+		self.fail_unconfirmed(channel.channel_number, reason)
+		if self.connection.is_open:
+			self.connection.channel(on_open_callback=self.on_channel_open)
+
+	def fail_unconfirmed(self, channel_number: int, reason):
+		"""
+		Fails all publishes on a channel that can no longer be confirmed
+		"""
+		for future, _ in self.unconfirmed.pop(channel_number, {}).values():
+			self.outstanding -= 1
+			self.counts["failed"] += 1
+			future.set_exception(ConnectionError(f"RMQ channel closed. {reason}"))
+
+	def on_confirm(self, channel_number: int, frame):
+		"""
+		Resolves the publishes acked/nacked by the broker, a single frame may cover many of them
+		"""
+		method = frame.method
+		unconfirmed = self.unconfirmed.get(channel_number, {})
+		if method.multiple:
+			tags = [tag for tag in unconfirmed if tag <= method.delivery_tag]
+		else:
+			tags = [method.delivery_tag]
+		nacked = isinstance(method, pika.spec.Basic.Nack)
+
+		now = monotonic()
+		for tag in tags:
+			if tag not in unconfirmed:
+				continue
+			future, published_at = unconfirmed.pop(tag)
+			latency = now - published_at
+			self.outstanding -= 1
+			self.latency_total += latency
+			self.latency_max = max(self.latency_max, latency)
+			if nacked:
+				self.counts["nacked"] += 1
+				future.set_exception(ConnectionError("Message nacked by RMQ"))
+			else:
+				self.counts["confirmed"] += 1
+				future.set_result(tag)
+
+	def _publish(self, queue: str, body: str, properties, future: Future):
+		"""
+		Publishes `body` on the next channel of the pool; runs on the IO thread
+		"""
+		if not self.channels:
+			self.counts["failed"] += 1
+			future.set_exception(ConnectionError("No open RMQ channel"))
+			return
+
+		channel = self.channels[self.turn % len(self.channels)]
+		self.turn += 1
+		try:
+			channel.basic_publish(
+				exchange="", routing_key=queue, body=body, properties=properties
+			)
+		except Exception as e:
+			self.counts["failed"] += 1
+			future.set_exception(e)
+			return
+
+		self.delivery_tags[channel.channel_number] += 1
+		tag = self.delivery_tags[channel.channel_number]
+		self.unconfirmed[channel.channel_number][tag] = (future, monotonic())
+		self.outstanding += 1
+		self.counts["published"] += 1
+
+	def publish(self, queue: str, body: str, properties=None, timeout: float = publish_timeout):
+		"""
+		Publishes `body` to `queue` and blocks the calling thread/greenlet until the broker confirms it
+		"""
+		if not self.ready.wait(timeout):
+			raise TimeoutError("RMQ connection not ready")
+
+		future = Future()
+		self.connection.ioloop.add_callback_threadsafe(
+			partial(self._publish, queue, body, properties, future)
+		)
+		future.result(timeout)
+
+	def stats(self) -> dict:
+		"""
+		Returns publish counts, confirms still outstanding and publish->confirm latency
+		"""
+		done = self.counts["confirmed"] + self.counts["nacked"]
+		return {
+			**self.counts,
+			"outstanding": self.outstanding,
+			"channels": len(self.channels),
+			"avg_latency_ms": round(1000 * self.latency_total / done, 3) if done else 0,
+			"max_latency_ms": round(1000 * self.latency_max, 3),
+		}
+
+
+_publisher = None
+_publisher_lock = threading.Lock()
+
+
+def publisher() -> Publisher:
+	"""
+	Returns the process-wide Publisher, creating it on first use
+	"""
+	global _publisher
+	with _publisher_lock:
+		if _publisher is None:
+			_publisher = Publisher()
+	return _publisher
+
+
 def push_to_Q(queue: str, query: str):
 	"""
 	Helper function to publish a `query` in a queue
-	Uses the default exchange and persistent delivery mode
-	"""
-	with rabbit_channel() as rmq_channel:
-		rmq_channel.basic_publish(
-			exchange="",
-			routing_key=queue,
-			body=query,
-			properties=pika.BasicProperties(delivery_mode=2),
-		)
+	Uses the default exchange and persistent delivery mode, and waits for the publisher confirm
+	"""
+	publisher().publish(queue, query, pika.BasicProperties(delivery_mode=2))
 
 
 # ## Mongo
 def start_mongo(mongo_host=mongodb_host):
 	"""
-	Starts the mongo daemon with the ReplSet option in the background
+	Seeds the data files from the latest snapshot, if any, then starts the mongo daemon
+	with the ReplSet option in the background, and waits until it answers
 	"""
-	system(f"mongod --replSet rs0 --bind_ip {mongo_host} --port 27017 &")
-	sleep(30)
+	seed_from_snapshot()
+	bootstrap["started_at"] = monotonic()
+	system(f"mongod --replSet rs0 --bind_ip {mongo_host} --dbpath {mongo_dbpath} --port 27017 &")
+	wait_for_mongo(mongo_host)
+
+
+class MongoStats(monitoring.CommandListener, monitoring.ConnectionPoolListener):
+	"""
+	Records the latency of every operation, and the activity of the connection pool, of the MongoClient
+	"""
+	def __init__(self):
+		self.lock = threading.Lock()
+		# command name -> {count, failed, total_ms, max_ms}
+		self.ops: Dict[str, Dict[str, float]] = {}
+		self.pool = {
+			"created": 0, "closed": 0, "checked_out": 0,
+			"checkouts": 0, "checkout_failed": 0, "cleared": 0,
+		}
+
+	def record(self, event, failed: bool):
+		ms = event.duration_micros / 1000
+		mongo_latency.labels(event.command_name).observe(ms / 1000)
+		if failed:
+			errors.labels("mongo").inc()
+		with self.lock:
+			op = self.ops.setdefault(
+				event.command_name, {"count": 0, "failed": 0, "total_ms": 0.0, "max_ms": 0.0}
+			)
+			op["count"] += 1
+			op["failed"] += failed
+			op["total_ms"] += ms
+			op["max_ms"] = max(op["max_ms"], ms)
+
+	def count(self, key: str, n: int = 1):
+		with self.lock:
+			self.pool[key] += n
+
+	# CommandListener
+	def started(self, event):
+		pass
+
+	def succeeded(self, event):
+		self.record(event, False)
+
+	def failed(self, event):
+		self.record(event, True)
+
+	# ConnectionPoolListener
+	def pool_created(self, event):
+		pass
+
+	def pool_cleared(self, event):
+		self.count("cleared")
+
+	def pool_closed(self, event):
+		pass
+
+	def connection_created(self, event):
+		self.count("created")
+
+	def connection_ready(self, event):
+		pass
+
+	def connection_closed(self, event):
+		self.count("closed")
+
+	def connection_check_out_started(self, event):
+		pass
+
+	def connection_check_out_failed(self, event):
+		self.count("checkout_failed")
+
+	def connection_checked_out(self, event):
+		self.count("checkouts")
+		self.count("checked_out")
+
+	def connection_checked_in(self, event):
+		self.count("checked_out", -1)
+
+	def stats(self) -> dict:
+		"""
+		Returns the pool counters (with the number of open connections) and per operation latencies
+		"""
+		with self.lock:
+			return {
+				"pool": {**self.pool, "open": self.pool["created"] - self.pool["closed"]},
+				"ops": {
+					name: {
+						"count": op["count"],
+						"failed": op["failed"],
+						"avg_ms": round(op["total_ms"] / op["count"], 3),
+						"max_ms": round(op["max_ms"], 3),
+					}
+					for name, op in self.ops.items()
+				},
+			}
+
+
+mongo_stats = MongoStats()
+_mongo_clients: Dict[str, MongoClient] = {}
+_mongo_clients_lock = threading.Lock()
+
+
+def mongo_client(mongo_host=mongodb_host) -> MongoClient:
+	"""
+	Returns the process-wide MongoClient of `mongo_host`, creating it on first use.
+	The client is never closed: its connection pool serves every read/write of the process
+	"""
+	with _mongo_clients_lock:
+		if mongo_host not in _mongo_clients:
+			_mongo_clients[mongo_host] = MongoClient(
+				mongo_host,
+				27017,
+				readPreference="secondaryPreferred",
+				maxPoolSize=mongo_pool_size,
+				connectTimeoutMS=mongo_connect_timeout_ms,
+				serverSelectionTimeoutMS=mongo_server_selection_timeout_ms,
+				socketTimeoutMS=mongo_socket_timeout_ms,
+				event_listeners=[mongo_stats],
+			)
+		return _mongo_clients[mongo_host]
 
 
 @contextmanager
 def mongo_collection(collection, mongo_host=mongodb_host):
 	"""
-	Connects to mongo,
-	returns the collection object of `collection`,
-	and closes the connection after processing is done
+	Returns the collection object of `collection`, on the pooled client. Errors are logged and raised
 	"""
 	try:
-		client = MongoClient(mongo_host, 27017, readPreference="secondaryPreferred")
-		yield client["cc"][collection]
+		yield mongo_client(mongo_host)["cc"][collection]
 	except Exception as e:
-		logger.error(f"Error connecting to MongoDB. {e}")
-	finally:
-		client.close()
+		logger.error(f"Error in MongoDB operation. {e}")
+		raise
+
+
+@contextmanager
+def mongo_connection(mongo_host=mongodb_host):
+	"""
+	Returns the pooled client. Errors are logged and raised
+	"""
+	try:
+		yield mongo_client(mongo_host)
+	except Exception as e:
+		logger.error(f"Error in MongoDB operation. {e}")
+		raise
+
+
+def log_stats(interval: int = stats_interval):
+	"""
+	Logs the MongoClient stats every `interval` seconds on a separate thread
+	"""
+	def log():
+		while True:
+			sleep(interval)
+			logger.info(f"Mongo stats {dumps(mongo_stats.stats())}")
+			logger.info(f"Bootstrap stats {dumps(bootstrap_stats())}")
+
+	threading.Thread(target=log, daemon=True).start()
+
+
+def wait_until(check, timeout: float) -> bool:
+	"""
+	Polls `check` every `ready_poll_interval` seconds until it returns True, or `timeout` seconds have passed
+	Errors raised by `check` count as not ready. Returns whether `check` passed
+	"""
+	deadline = monotonic() + timeout
+	while True:
+		try:
+			if check():
+				return True
+		except Exception as e:
+			logger.debug(f"Not ready. {e}")
+		if monotonic() >= deadline:
+			return False
+		sleep(ready_poll_interval)
+
+
+def wait_for_mongo(mongo_host=mongodb_host, timeout: float = mongo_ready_timeout):
+	"""
+	Waits until the mongo daemon answers pings, or `timeout` seconds have passed
+	"""
+	if not wait_until(lambda: mongo_client(mongo_host).admin.command("ping").get("ok"), timeout):
+		logger.error(f"mongod not answering after {timeout}s")
+
+
+def wait_for_secondary(timeout: float = secondary_ready_timeout):
+	"""
+	Waits until the mongo daemon is a SECONDARY of the ReplSet, which it becomes once its initial sync is done,
+	or `timeout` seconds have passed
+	"""
+	if not wait_until(lambda: mongo_client().admin.command("isMaster").get("secondary"), timeout):
+		logger.error(f"Not secondary after {timeout}s")
+	bootstrap["caught_up_s"] = round(monotonic() - bootstrap["started_at"], 3)
+	logger.info(f"Bootstrap stats {dumps(bootstrap_stats())}")
+
+
+# ## Snapshots
+# How this slave was bootstrapped: age of the snapshot it was seeded from (None when it did a full initial sync),
+# and seconds from starting mongod to being SECONDARY
+bootstrap = {"seeded": False, "snapshot_age_s": None, "started_at": None, "caught_up_s": None}
+
+
+def bootstrap_stats() -> dict:
+	return {k: v for k, v in bootstrap.items() if k != "started_at"}
+
+
+def snapshot_meta(snapshot: str) -> Optional[dict]:
+	"""
+	Returns the metadata of the snapshot in directory `snapshot`, None if there is no complete snapshot there
+	"""
+	try:
+		with open(path.join(snapshot, "snapshot.json")) as f:
+			return load(f)
+	except (OSError, ValueError):
+		return None
+
+
+def snapshot_versions(snapshot_dir: str = snapshot_dir) -> list:
+	"""
+	Returns the directories of the complete snapshots in `snapshot_dir`, oldest first
+	"""
+	names = [name for name in listdir(snapshot_dir) if name.startswith("snapshot-")]
+	return sorted(names, key=lambda name: int(name.split("-", 2)[1]))
+
+
+def seed_from_snapshot(snapshot_dir: str = snapshot_dir, dbpath: str = mongo_dbpath) -> bool:
+	"""
+	Copies the latest snapshot into the empty data directory of a new slave, so that once added
+	to the ReplSet it only has to catch up on the oplog written since, instead of a full initial sync.
+	Returns whether it did, a slave with data of its own (a restarted one) keeps it
+	"""
+	# The pointer is resolved once: a snapshot taken meanwhile goes to another directory, never this one
+	try:
+		with open(path.join(snapshot_dir, "current")) as f:
+			snapshot = path.join(snapshot_dir, f.read().strip())
+	except OSError:
+		return False
+	meta = snapshot_meta(snapshot)
+	if meta is None or listdir(dbpath):
+		return False
+	try:
+		for name in listdir(snapshot):
+			src = path.join(snapshot, name)
+			if name == "snapshot.json":
+				continue
+			if path.isdir(src):
+				shutil.copytree(src, path.join(dbpath, name))
+			else:
+				shutil.copy2(src, dbpath)
+	except OSError as e:
+		# A snapshot pruned while being copied: fall back to a full initial sync
+		logger.error(f"Error seeding from snapshot, starting empty. {e}")
+		for name in listdir(dbpath):
+			target = path.join(dbpath, name)
+			shutil.rmtree(target) if path.isdir(target) else remove(target)
+		return False
+	bootstrap["seeded"] = True
+	bootstrap["snapshot_age_s"] = round(time() - meta["taken_at"], 3)
+	logger.info(f"Seeded from snapshot of {meta['host']} taken at {meta['taken_at']}")
+	return True
+
+
+def take_snapshot(snapshot_dir: str = snapshot_dir, dbpath: str = mongo_dbpath):
+	"""
+	Copies the data files of this node to the shared volume, with writes locked so that they are consistent.
+	Each snapshot gets its own directory, made in a temporary one and renamed once complete, then the
+	`current` pointer is swapped to it: a slave seeding meanwhile keeps copying the one it resolved
+	"""
+	tmp = path.join(snapshot_dir, f"tmp-{mongodb_host}")
+	current = path.join(snapshot_dir, "current")
+	shutil.rmtree(tmp, ignore_errors=True)
+
+	start = monotonic()
+	conn = mongo_client()
+	try:
+		conn.admin.command("fsync", lock=True)
+		try:
+			taken_at = time()
+			shutil.copytree(dbpath, tmp, ignore=shutil.ignore_patterns("mongod.lock", "diagnostic.data"))
+		finally:
+			conn.admin.command("fsyncUnlock")
+		locked_s = round(monotonic() - start, 3)
+
+		with open(path.join(tmp, "snapshot.json"), "w") as f:
+			dump({"host": mongodb_host, "taken_at": taken_at}, f)
+		version = f"snapshot-{int(taken_at * 1000)}-{mongodb_host}"
+		rename(tmp, path.join(snapshot_dir, version))
+	except Exception:
+		# A partial copy is never swapped in, nor left on the volume, and the previous snapshot stays current
+		shutil.rmtree(tmp, ignore_errors=True)
+		raise
+	# Volumes of older versions held the snapshot itself as `current`
+	if path.isdir(current):
+		shutil.rmtree(current)
+	with open(f"{current}-{mongodb_host}", "w") as f:
+		f.write(version)
+	replace(f"{current}-{mongodb_host}", current)
+
+	for name in snapshot_versions(snapshot_dir)[:-snapshot_keep]:
+		if name != version:
+			shutil.rmtree(path.join(snapshot_dir, name), ignore_errors=True)
+	logger.info(f"Snapshot taken, writes locked for {locked_s}s")
+
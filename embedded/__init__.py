@@ -0,0 +1,6 @@
+"""
+	RideShare (Cloud Computing Project)
+	embedded: the whole stack in one process, for profiling and micro-benchmarks without Docker, RMQ, Redis or Mongo
+"""
+
+from .stack import Stack
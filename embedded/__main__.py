@@ -0,0 +1,42 @@
+"""
+	RideShare (Cloud Computing Project)
+	__main__.py: serves the embedded stack on local ports, e.g. to run bench/run.py against it
+
+	python3 -m embedded --slaves 2 --port 8000
+	serves rides on port 8000, users on 8001, the orchestrator on 8002 and the RMQ management API of the bus on 8003
+"""
+
+import argparse
+import threading
+
+from werkzeug.serving import make_server
+
+from .stack import Stack
+
+# Services served, in port order from --port
+served = ["rides", "users", "orchestrator", "rabbitmq"]
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+	parser.add_argument("--slaves", type=int, default=2, help="slaves consuming readQ")
+	parser.add_argument("--host", default="127.0.0.1", help="address the services are served on")
+	parser.add_argument("--port", type=int, default=8000, help="port of rides, the next ones serve the other services")
+	parser.add_argument("--workdir", help="folder of the logs and spans, defaults to a new temporary folder")
+	args = parser.parse_args()
+
+	stack = Stack(slaves=args.slaves, workdir=args.workdir).start()
+	urls = {}
+	for i, service in enumerate(served):
+		server = make_server(args.host, args.port + i, stack.apps[service], threaded=True)
+		threading.Thread(target=server.serve_forever, name=service, daemon=True).start()
+		urls[service] = f"http://{args.host}:{args.port + i}"
+		print(f"{service:<13} {urls[service]}")
+	print(f"logs and spans in {stack.workdir}")
+	print(
+		f"python3 bench/run.py --rides {urls['rides']} --users {urls['users']} --dbaas {urls['orchestrator']} "
+		f"--rmq-management {urls['rabbitmq']}"
+	)
+	try:
+		threading.Event().wait()
+	except KeyboardInterrupt:
+		stack.stop()
@@ -0,0 +1,438 @@
+"""
+	RideShare (Cloud Computing Project)
+	bus.py: in-memory queue bus standing in for RabbitMQ, and the `pika` module the services import in embedded mode
+
+	Queues are fed through the default exchange or the fanout exchanges they're bound to, and drained round robin
+	by their consumers, within their prefetch.
+	Like pika, a BlockingConnection runs its consumer callbacks, timers and threadsafe callbacks on the thread
+	servicing it (process_data_events/start_consuming), and direct reply-to gets a private queue per channel
+"""
+
+import threading
+from collections import deque
+from itertools import count
+from queue import Empty, Queue
+from time import monotonic
+from types import ModuleType, SimpleNamespace
+from typing import Callable, Deque, Dict, List, Optional, Set
+
+reply_to = "amq.rabbitmq.reply-to"
+
+
+class AMQPConnectionError(Exception):
+	pass
+
+
+class ChannelClosed(Exception):
+	pass
+
+
+class BasicProperties:
+	fields = [
+		"content_type", "content_encoding", "headers", "delivery_mode", "priority", "correlation_id",
+		"reply_to", "expiration", "message_id", "timestamp", "type", "user_id", "app_id",
+	]
+
+	def __init__(self, **kwargs):
+		for field in self.fields:
+			setattr(self, field, kwargs.get(field))
+
+
+class ConnectionParameters:
+	def __init__(self, host: str = "localhost", **kwargs):
+		self.host = host
+
+
+class Ack:
+	pass
+
+
+class Nack:
+	pass
+
+
+class Consumer:
+	"""
+	A consumer of a queue: the channel delivering to it, and the messages delivered to it not acked yet
+	"""
+	def __init__(self, channel: "Channel", queue: str, callback: Callable, auto_ack: bool, tag: str):
+		self.channel = channel
+		self.queue = queue
+		self.callback = callback
+		self.auto_ack = auto_ack
+		self.tag = tag
+
+	def has_room(self) -> bool:
+		return self.auto_ack or not self.channel.prefetch or len(self.channel.unacked) < self.channel.prefetch
+
+
+class Bus:
+	"""
+	The queues of the broker, with their ready messages and their consumers
+	"""
+	def __init__(self):
+		self.queues: Dict[str, Deque[tuple]] = {}
+		# exchange -> the queues bound to it, every exchange is a fanout
+		self.exchanges: Dict[str, Set[str]] = {}
+		self.consumers: Dict[str, List[Consumer]] = {}
+		self.turns: Dict[str, int] = {}
+		self.counts = {"published": 0, "delivered": 0, "acked": 0, "dropped": 0}
+		self.lock = threading.RLock()
+
+	def declare(self, queue: str):
+		with self.lock:
+			self.queues.setdefault(queue, deque())
+			self.consumers.setdefault(queue, [])
+
+	def declare_exchange(self, exchange: str):
+		with self.lock:
+			self.exchanges.setdefault(exchange, set())
+
+	def bind(self, queue: str, exchange: str):
+		with self.lock:
+			self.exchanges.setdefault(exchange, set()).add(queue)
+
+	def delete(self, queue: str):
+		with self.lock:
+			self.queues.pop(queue, None)
+			for bound in self.exchanges.values():
+				bound.discard(queue)
+			for consumer in self.consumers.pop(queue, []):
+				consumer.channel.consumers.pop(consumer.tag, None)
+
+	def publish(self, queue: str, body: bytes, properties: BasicProperties):
+		"""
+		Adds a message to `queue`, dropped if there is no such queue, as the default exchange does
+		"""
+		with self.lock:
+			if queue not in self.queues:
+				self.counts["dropped"] += 1
+				return
+			self.queues[queue].append((body, properties, False))
+			self.counts["published"] += 1
+			self.dispatch(queue)
+
+	def route(self, exchange: str, routing_key: str, body: bytes, properties: BasicProperties):
+		"""
+		Publishes a message to `routing_key` through the default exchange, else to every queue bound to `exchange`
+		"""
+		with self.lock:
+			if not exchange:
+				self.publish(routing_key, body, properties)
+				return
+			queues = self.exchanges.get(exchange, set())
+			if not queues:
+				self.counts["dropped"] += 1
+			for queue in queues:
+				self.publish(queue, body, properties)
+
+	def requeue(self, queue: str, messages: List[tuple]):
+		with self.lock:
+			if queue in self.queues:
+				self.queues[queue].extendleft((body, properties, True) for body, properties, _ in reversed(messages))
+				self.dispatch(queue)
+
+	def consume(self, consumer: Consumer):
+		with self.lock:
+			self.declare(consumer.queue)
+			self.consumers[consumer.queue].append(consumer)
+			self.dispatch(consumer.queue)
+
+	def cancel(self, consumer: Consumer):
+		with self.lock:
+			if consumer in self.consumers.get(consumer.queue, []):
+				self.consumers[consumer.queue].remove(consumer)
+
+	def dispatch(self, queue: str):
+		"""
+		Delivers the ready messages of `queue`, round robin over the consumers with room for them
+		"""
+		with self.lock:
+			messages = self.queues.get(queue)
+			consumers = self.consumers.get(queue)
+			while messages and consumers:
+				turn = self.turns.get(queue, 0)
+				for i in range(len(consumers)):
+					consumer = consumers[(turn + i) % len(consumers)]
+					if consumer.has_room():
+						break
+				else:
+					return
+				self.turns[queue] = turn + i + 1
+				consumer.channel.deliver(consumer, *messages.popleft())
+				self.counts["delivered"] += 1
+
+	def dispatch_all(self):
+		with self.lock:
+			for queue in list(self.queues):
+				self.dispatch(queue)
+
+	def stats(self, queue: str) -> Optional[dict]:
+		"""
+		Returns the depth and consumers of `queue`, shaped like the RMQ management API, None if there is no such queue
+		"""
+		with self.lock:
+			if queue not in self.queues:
+				return None
+			consumers = self.consumers[queue]
+			unacked = sum(
+				1 for channel in {c.channel for c in consumers}
+				for q, _, _ in channel.unacked.values() if q == queue
+			)
+			return {
+				"name": queue,
+				"messages_ready": len(self.queues[queue]),
+				"messages_unacknowledged": unacked,
+				"consumers": len(consumers),
+			}
+
+
+class Channel:
+	"""
+	A channel of a BlockingConnection. Its deliveries are run by the thread servicing the connection
+	"""
+	def __init__(self, connection: "BlockingConnection", number: int):
+		self.connection = connection
+		self.bus = connection.bus
+		self.channel_number = number
+		self.prefetch = 0
+		self.consumers: Dict[str, Consumer] = {}
+		# delivery tag -> (queue, body, properties) of the messages delivered and not acked yet
+		self.unacked: Dict[int, tuple] = {}
+		self.delivery_tags = count(1)
+		self.consumer_tags = count(1)
+		self.queue_names = count(1)
+		self.reply_queue = f"{reply_to}.{id(connection)}.{number}"
+		# Queues declared exclusive, deleted with the channel
+		self.exclusive: List[str] = []
+		self.is_open = True
+
+	def queue_declare(self, queue: str = "", exclusive: bool = False, **kwargs):
+		if not queue:
+			queue = f"amq.gen-{id(self.connection)}.{self.channel_number}.{next(self.queue_names)}"
+		if exclusive:
+			self.exclusive.append(queue)
+		self.bus.declare(queue)
+		stats = self.bus.stats(queue)
+		return SimpleNamespace(method=SimpleNamespace(
+			queue=queue, message_count=stats["messages_ready"], consumer_count=stats["consumers"]
+		))
+
+	def queue_delete(self, queue: str, **kwargs):
+		self.bus.delete(queue)
+
+	def exchange_declare(self, exchange: str, exchange_type: str = "direct", **kwargs):
+		self.bus.declare_exchange(exchange)
+
+	def queue_bind(self, queue: str, exchange: str, routing_key: str = None, **kwargs):
+		self.bus.bind(queue, exchange)
+
+	def basic_qos(self, prefetch_count: int = 0, **kwargs):
+		self.prefetch = prefetch_count
+
+	def confirm_delivery(self, *args, **kwargs):
+		# Publishes are synchronous: a publish that returns has reached its queue
+		pass
+
+	def basic_consume(self, queue: str, on_message_callback: Callable, auto_ack: bool = False, **kwargs) -> str:
+		tag = f"ctag{self.channel_number}.{next(self.consumer_tags)}"
+		if queue == reply_to:
+			queue, auto_ack = self.reply_queue, True
+		consumer = Consumer(self, queue, on_message_callback, auto_ack, tag)
+		self.consumers[tag] = consumer
+		self.bus.consume(consumer)
+		return tag
+
+	def basic_cancel(self, consumer_tag: str):
+		consumer = self.consumers.pop(consumer_tag, None)
+		if consumer is not None:
+			self.bus.cancel(consumer)
+
+	def basic_publish(self, exchange: str, routing_key: str, body, properties: BasicProperties = None, **kwargs):
+		if not self.is_open:
+			raise ChannelClosed("Channel is closed")
+		properties = BasicProperties(**vars(properties)) if properties is not None else BasicProperties()
+		if properties.reply_to == reply_to:
+			properties.reply_to = self.reply_queue
+		if isinstance(body, str):
+			body = body.encode("utf-8")
+		self.bus.route(exchange, routing_key, body, properties)
+
+	def deliver(self, consumer: Consumer, body: bytes, properties: BasicProperties, redelivered: bool):
+		"""
+		Hands a message over to the thread of the connection, called by the bus holding its lock
+		"""
+		tag = next(self.delivery_tags)
+		if not consumer.auto_ack:
+			self.unacked[tag] = (consumer.queue, body, properties)
+		method = SimpleNamespace(
+			delivery_tag=tag, consumer_tag=consumer.tag, routing_key=consumer.queue,
+			exchange="", redelivered=redelivered,
+		)
+		self.connection.add_callback_threadsafe(lambda: consumer.callback(self, method, properties, body))
+
+	def settle(self, delivery_tag: int, multiple: bool) -> List[tuple]:
+		"""
+		Forgets the unacked messages `delivery_tag` stands for, and returns them
+		"""
+		with self.bus.lock:
+			tags = [t for t in self.unacked if t <= delivery_tag] if multiple else [delivery_tag]
+			settled = [self.unacked.pop(t) for t in tags if t in self.unacked]
+			self.bus.counts["acked"] += len(settled)
+			return settled
+
+	def basic_ack(self, delivery_tag: int = 0, multiple: bool = False):
+		with self.bus.lock:
+			self.settle(delivery_tag, multiple)
+			self.bus.dispatch_all()
+
+	def basic_nack(self, delivery_tag: int = 0, multiple: bool = False, requeue: bool = True):
+		with self.bus.lock:
+			settled = self.settle(delivery_tag, multiple)
+			for queue, body, properties in settled if requeue else []:
+				self.bus.requeue(queue, [(body, properties, True)])
+			self.bus.dispatch_all()
+
+	def basic_reject(self, delivery_tag: int, requeue: bool = True):
+		self.basic_nack(delivery_tag, requeue=requeue)
+
+	def start_consuming(self):
+		self.connection.consuming = True
+		while self.connection.consuming and self.connection.is_open:
+			self.connection.process_data_events(time_limit=1)
+
+	def stop_consuming(self):
+		self.connection.consuming = False
+
+	def close(self):
+		"""
+		Cancels the consumers of the channel and puts the messages it didn't ack back in their queues
+		"""
+		if not self.is_open:
+			return
+		self.is_open = False
+		with self.bus.lock:
+			for tag in list(self.consumers):
+				self.basic_cancel(tag)
+			for queue in [self.reply_queue, *self.exclusive]:
+				self.bus.delete(queue)
+			unacked = sorted(self.unacked.items())
+			self.unacked = {}
+			for _, (queue, body, properties) in unacked:
+				self.bus.requeue(queue, [(body, properties, True)])
+
+
+class Timeout:
+	def __init__(self, callback: Callable):
+		self.callback = callback
+		self.cancelled = False
+
+	def run(self):
+		if not self.cancelled:
+			self.callback()
+
+
+class BlockingConnection:
+	"""
+	A connection to the bus. Everything it runs (deliveries, call_later timers, add_callback_threadsafe callbacks)
+	goes through one queue, serviced by process_data_events on a single thread, as with pika
+	"""
+	def __init__(self, parameters: ConnectionParameters = None, bus: Bus = None):
+		self.bus = bus
+		self.events: Queue = Queue()
+		self.channels: List[Channel] = []
+		self.channel_numbers = count(1)
+		self.is_open = True
+		self.consuming = False
+
+	def channel(self) -> Channel:
+		channel = Channel(self, next(self.channel_numbers))
+		self.channels.append(channel)
+		return channel
+
+	def add_callback_threadsafe(self, callback: Callable):
+		self.events.put(callback)
+
+	def call_later(self, delay: float, callback: Callable) -> Timeout:
+		timeout = Timeout(callback)
+		timer = threading.Timer(delay, self.add_callback_threadsafe, [timeout.run])
+		timer.daemon = True
+		timer.start()
+		return timeout
+
+	def remove_timeout(self, timeout: Timeout):
+		timeout.cancelled = True
+
+	def process_data_events(self, time_limit: float = 0):
+		"""
+		Runs the events of the connection as they come, for `time_limit` seconds
+		"""
+		deadline = monotonic() + (time_limit or 0)
+		while self.is_open:
+			try:
+				callback = self.events.get(timeout=max(0, deadline - monotonic()))
+			except Empty:
+				return
+			callback()
+
+	def sleep(self, duration: float):
+		self.process_data_events(time_limit=duration)
+
+	def close(self):
+		if not self.is_open:
+			return
+		for channel in self.channels:
+			channel.close()
+		self.is_open = False
+
+
+class SelectConnection:
+	def __init__(self, *args, **kwargs):
+		raise NotImplementedError("SelectConnection isn't available in embedded mode, preset the publisher instead")
+
+
+class BusPublisher:
+	"""
+	Publisher of the services, publishing straight to the bus: a publish has reached its queue once it returns,
+	as a confirmed publish has. Stands in for the pooled confirm-mode publishers, which run on a SelectConnection
+	"""
+	def __init__(self, bus: Bus):
+		self.channel = BlockingConnection(bus=bus).channel()
+		self.counts = {"published": 0, "confirmed": 0, "nacked": 0, "failed": 0}
+		self.lock = threading.Lock()
+
+	def publish(self, queue: str, body: str, properties: BasicProperties = None, timeout: float = None):
+		try:
+			self.channel.basic_publish(exchange="", routing_key=queue, body=body, properties=properties)
+		except Exception:
+			with self.lock:
+				self.counts["failed"] += 1
+			raise
+		with self.lock:
+			self.counts["published"] += 1
+			self.counts["confirmed"] += 1
+
+	def stats(self) -> dict:
+		with self.lock:
+			return {**self.counts, "outstanding": 0, "channels": 1, "avg_latency_ms": 0, "max_latency_ms": 0}
+
+
+def pika_module(bus: Bus) -> Dict[str, ModuleType]:
+	"""
+	Returns the `pika` module and the submodules the services use, with connections to `bus`
+	"""
+	pika = ModuleType("pika")
+	pika.BasicProperties = BasicProperties
+	pika.ConnectionParameters = ConnectionParameters
+	pika.BlockingConnection = lambda parameters=None: BlockingConnection(parameters, bus)
+	pika.SelectConnection = SelectConnection
+
+	exceptions = ModuleType("pika.exceptions")
+	exceptions.AMQPConnectionError = AMQPConnectionError
+	exceptions.ChannelClosed = ChannelClosed
+	spec = ModuleType("pika.spec")
+	spec.Basic = SimpleNamespace(Ack=Ack, Nack=Nack)
+	spec.BasicProperties = BasicProperties
+	pika.exceptions = exceptions
+	pika.spec = spec
+	return {"pika": pika, "pika.exceptions": exceptions, "pika.spec": spec}
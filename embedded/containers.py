@@ -0,0 +1,88 @@
+"""
+	RideShare (Cloud Computing Project)
+	containers.py: the `docker` module the orchestrator imports in embedded mode
+
+	The worker containers are the workers of the embedded stack, running on threads of the process:
+	they can be listed, but not spawned or killed
+"""
+
+import threading
+from types import ModuleType
+from typing import Callable, Dict, List
+
+
+class NotFound(Exception):
+	pass
+
+
+class APIError(Exception):
+	pass
+
+
+class Container:
+	"""
+	An embedded worker, its PID is the id of the thread consuming its queue
+	"""
+	def __init__(self, name: str, pid: int):
+		self.id = name
+		self.name = name
+		self.status = "running"
+		self.attrs = {"State": {"Pid": pid, "Status": "running"}}
+
+	def reload(self):
+		pass
+
+	def kill(self, *args, **kwargs):
+		raise APIError(f"{self.name} can't be killed in embedded mode")
+
+
+class Containers:
+	def __init__(self, workers: Callable[[], Dict[str, int]]):
+		self.workers = workers
+
+	def list(self, *args, **kwargs) -> List[Container]:
+		return [Container(name, pid) for name, pid in self.workers().items()]
+
+	def get(self, container_id: str) -> Container:
+		pid = self.workers().get(container_id)
+		if pid is None:
+			raise NotFound(f"No such container {container_id}")
+		return Container(container_id, pid)
+
+	def run(self, *args, **kwargs):
+		raise APIError("Containers can't be spawned in embedded mode")
+
+
+class DockerClient:
+	def __init__(self, workers: Callable[[], Dict[str, int]]):
+		self.containers = Containers(workers)
+
+	def events(self, *args, **kwargs):
+		# The workers never change, so no event ever comes
+		threading.Event().wait()
+		yield from ()
+
+
+def docker_module(workers: Callable[[], Dict[str, int]]) -> Dict[str, ModuleType]:
+	"""
+	Returns the `docker` module and the submodules the orchestrator uses, listing `workers()` ({name: PID}) as its containers
+	"""
+	docker = ModuleType("docker")
+	docker.DockerClient = DockerClient
+	docker.from_env = lambda *args, **kwargs: DockerClient(workers)
+
+	errors = ModuleType("docker.errors")
+	errors.NotFound = NotFound
+	errors.APIError = APIError
+	models = ModuleType("docker.models")
+	containers = ModuleType("docker.models.containers")
+	containers.Container = Container
+	models.containers = containers
+	docker.errors = errors
+	docker.models = models
+	return {
+		"docker": docker,
+		"docker.errors": errors,
+		"docker.models": models,
+		"docker.models.containers": containers,
+	}
@@ -0,0 +1,121 @@
+"""
+	RideShare (Cloud Computing Project)
+	kv.py: in-memory key-value server standing in for Redis, and the `redis` module the services import in embedded mode
+"""
+
+import threading
+from types import ModuleType
+from typing import Dict, Optional, Set, Union
+
+
+def encode(value: Union[str, bytes, int, float]) -> bytes:
+	"""
+	Returns `value` as Redis stores it
+	"""
+	if isinstance(value, bytes):
+		return value
+	return str(value).encode("utf-8")
+
+
+class Server:
+	"""
+	The keys of one Redis server: strings and sets
+	"""
+	def __init__(self):
+		self.data: Dict[bytes, Union[bytes, Set[bytes]]] = {}
+		self.lock = threading.Lock()
+
+
+class Pipeline:
+	"""
+	Buffers commands and runs them together on execute, like a pipeline without a transaction
+	"""
+	def __init__(self, client: "Redis"):
+		self.client = client
+		self.commands = []
+
+	def __getattr__(self, name: str):
+		command = getattr(self.client, name)
+
+		def buffer(*args, **kwargs) -> "Pipeline":
+			self.commands.append((command, args, kwargs))
+			return self
+		return buffer
+
+	def execute(self) -> list:
+		commands, self.commands = self.commands, []
+		return [command(*args, **kwargs) for command, args, kwargs in commands]
+
+
+class Redis:
+	def __init__(self, server: Server):
+		self.server = server
+
+	def get(self, key) -> Optional[bytes]:
+		with self.server.lock:
+			return self.server.data.get(encode(key))
+
+	def set(self, key, value, **kwargs) -> bool:
+		with self.server.lock:
+			self.server.data[encode(key)] = encode(value)
+		return True
+
+	def incrby(self, key, amount: int = 1) -> int:
+		with self.server.lock:
+			value = int(self.server.data.get(encode(key), b"0")) + amount
+			self.server.data[encode(key)] = encode(value)
+			return value
+
+	def incr(self, key, amount: int = 1) -> int:
+		return self.incrby(key, amount)
+
+	def delete(self, *keys) -> int:
+		with self.server.lock:
+			return sum(self.server.data.pop(encode(key), None) is not None for key in keys)
+
+	def sadd(self, key, *values) -> int:
+		with self.server.lock:
+			members = self.server.data.setdefault(encode(key), set())
+			added = {encode(v) for v in values} - members
+			members |= added
+			return len(added)
+
+	def srem(self, key, *values) -> int:
+		with self.server.lock:
+			members = self.server.data.get(encode(key), set())
+			removed = {encode(v) for v in values} & members
+			members -= removed
+			return len(removed)
+
+	def smembers(self, key) -> Set[bytes]:
+		with self.server.lock:
+			return set(self.server.data.get(encode(key), set()))
+
+	def sismember(self, key, value) -> bool:
+		with self.server.lock:
+			return encode(value) in self.server.data.get(encode(key), set())
+
+	def scard(self, key) -> int:
+		with self.server.lock:
+			return len(self.server.data.get(encode(key), set()))
+
+	def pipeline(self, transaction: bool = True) -> Pipeline:
+		return Pipeline(self)
+
+
+def redis_module() -> Dict[str, ModuleType]:
+	"""
+	Returns a `redis` module whose clients of the same host share their keys, and only them
+	"""
+	servers: Dict[str, Server] = {}
+	lock = threading.Lock()
+
+	def connect(host: str = "localhost", *args, **kwargs) -> Redis:
+		with lock:
+			return Redis(servers.setdefault(host, Server()))
+
+	redis = ModuleType("redis")
+	redis.Redis = connect
+	redis.StrictRedis = connect
+	redis.servers = servers
+	return {"redis": redis}
@@ -0,0 +1,261 @@
+"""
+	RideShare (Cloud Computing Project)
+	stack.py: the orchestrator, worker master, slaves, rides and users in one process, over the in-memory bus, store and Redis
+
+	Each service is imported from its own folder, unchanged, with `pika`, `pymongo`, `redis`, `docker` and `requests`
+	replaced by the embedded ones while it loads. The services call each other through their WSGI apps, by hostname:
+	orchestrator, rides, users, and rabbitmq for the RMQ management API of the bus. Not simulated:
+	the Mongo ReplSet (master and slaves share one store, so reads see writes as soon as they are flushed),
+	syncQ, spawning and killing slaves (the autoscaler is off), and the pooled publishers (publishes go straight to the bus)
+"""
+
+import importlib
+import importlib.util
+import logging
+import sys
+import threading
+from json import dumps
+from os import chdir, getcwd, listdir, makedirs, path
+from tempfile import mkdtemp
+from types import ModuleType, SimpleNamespace
+from typing import Callable, Dict, List, Optional
+
+from prometheus_client import REGISTRY
+
+from .bus import Bus, BusPublisher, pika_module
+from .containers import docker_module
+from .kv import redis_module
+from .store import MemoryStore, pymongo_module
+from .web import InProcessHTTP, Response, management_app, requests_module
+
+root = path.dirname(path.dirname(path.abspath(__file__)))
+# Folder of each service, from the root of the repository
+services = {
+	"orchestrator": path.join("dbaas", "orchestrator"),
+	"worker-master": path.join("dbaas", "worker-master"),
+	"worker-slave": path.join("dbaas", "worker-slave"),
+	"rides": "rides",
+	"users": "users",
+}
+# Modules shared by the services, see common/counter.py
+common = path.join(root, "common")
+gunicorn_config = "gunicorn.config.py"
+# seconds to wait for the workers to consume their queues
+ready_timeout = 10
+
+
+def load_service(directory: str, fakes: Dict[str, ModuleType], overrides: Dict[str, object]) -> Dict[str, ModuleType]:
+	"""
+	Imports the main module of the service in `directory`, and its gunicorn config if it has one, with `fakes`
+	in place of the modules they're named after and `overrides` set on its config, and returns its modules by name.
+	The service imports the modules in common/ as its own. The modules of the service are taken out of sys.modules afterwards, so that the next service can load its own
+	config, utils, main..., and so are its Prometheus metrics, which would clash with those of the next service
+	"""
+	local = {
+		name[:-3] for folder in (directory, common) for name in listdir(folder)
+		if name.endswith(".py") and "." not in name[:-3]
+	}
+	shadowed = local | set(fakes)
+	saved = {name: sys.modules.pop(name) for name in shadowed if name in sys.modules}
+	collectors = set(REGISTRY._collector_to_names)
+	cwd = getcwd()
+	sys.modules.update(fakes)
+	sys.path[:0] = [directory, common]
+	# Some modules read files relative to the folder they run from
+	chdir(directory)
+	try:
+		config = importlib.import_module("config")
+		for name, value in overrides.items():
+			setattr(config, name, value)
+		importlib.import_module("main")
+		modules = {name: sys.modules[name] for name in local if name in sys.modules}
+		if path.exists(gunicorn_config):
+			spec = importlib.util.spec_from_file_location("gunicorn_config", gunicorn_config)
+			modules["gunicorn_config"] = importlib.util.module_from_spec(spec)
+			spec.loader.exec_module(modules["gunicorn_config"])
+		return modules
+	finally:
+		chdir(cwd)
+		sys.path.remove(directory)
+		sys.path.remove(common)
+		for name in shadowed:
+			sys.modules.pop(name, None)
+		sys.modules.update(saved)
+		for collector in set(REGISTRY._collector_to_names) - collectors:
+			REGISTRY.unregister(collector)
+
+
+def with_pre_request(app: Callable, hook: Callable) -> Callable:
+	"""
+	Returns the WSGI app calling the gunicorn `pre_request` hook before `app`, as gunicorn does
+	"""
+	def wrapped(environ: dict, start_response: Callable):
+		req = SimpleNamespace(
+			path=environ.get("PATH_INFO", ""),
+			method=environ.get("REQUEST_METHOD", "GET"),
+			headers=[(k[5:].replace("_", "-"), v) for k, v in environ.items() if k.startswith("HTTP_")],
+		)
+		hook(None, req)
+		return app(environ, start_response)
+	return wrapped
+
+
+class Stack:
+	"""
+	The services of RideShare in one process, with `slaves` slaves consuming readQ.
+	Logs and spans are written to `workdir`, a new temporary folder by default
+	"""
+	def __init__(self, slaves: int = 2, workdir: str = None):
+		self.slaves = slaves
+		self.workdir = path.abspath(workdir or mkdtemp(prefix="rideshare-"))
+		makedirs(self.workdir, exist_ok=True)
+		self.bus = Bus()
+		self.store = MemoryStore()
+		self.apps: Dict[str, Callable] = {"rabbitmq": management_app(self.bus)}
+		self.http = InProcessHTTP(self.apps)
+		self.modules: Dict[str, Dict[str, ModuleType]] = {}
+		# name -> PID of the embedded worker containers, the id of the thread consuming their queue
+		self.pids: Dict[str, int] = {}
+		self.ready: Dict[str, threading.Event] = {}
+		self.connections = []
+		self.lock = threading.Lock()
+
+	def fakes(self) -> Dict[str, ModuleType]:
+		"""
+		Returns the embedded modules a service is loaded with, each service has its own Redis
+		"""
+		return {
+			**pika_module(self.bus),
+			**pymongo_module(self.store),
+			**redis_module(),
+			**docker_module(self.workers),
+			**requests_module(self.http),
+		}
+
+	def workers(self) -> Dict[str, int]:
+		with self.lock:
+			return dict(self.pids)
+
+	def load(self, service: str, **overrides) -> Dict[str, ModuleType]:
+		"""
+		Loads `service`, recording its spans in a file of its own in the workdir, and its logs in the workdir
+		"""
+		overrides["spans_file"] = path.join(self.workdir, f"spans-{service}.jsonl")
+		overrides["log_file"] = path.join(self.workdir, "embedded.log")
+		self.modules[service] = load_service(path.join(root, services[service]), self.fakes(), overrides)
+		return self.modules[service]
+
+	def start(self) -> "Stack":
+		"""
+		Loads the services, and starts the master and the slaves consuming their queues
+		"""
+		orchestrator = self.load("orchestrator")
+		master = self.load("worker-master")
+		slave = self.load("worker-slave")
+		rides = self.load("rides", dbaas_ip="orchestrator", elb_ip="users")
+		users = self.load("users", dbaas_ip="orchestrator")
+		self.setup_logging()
+
+		# No containers to scale, and the publisher's SelectConnection has no embedded counterpart
+		orchestrator["main"].scale_after = lambda interval: None
+		orchestrator["utils"]._publisher = BusPublisher(self.bus)
+		for service, modules in (("orchestrator", orchestrator), ("rides", rides), ("users", users)):
+			app = modules["main"].app
+			if "gunicorn_config" in modules:
+				app = with_pre_request(app, modules["gunicorn_config"].pre_request)
+				# Starts the threads of the service, as gunicorn does in each worker
+				modules["gunicorn_config"].post_fork(None, None)
+			self.apps[service] = app
+
+		master["main"].ensure_indexes()
+		self.run_worker("worker-master", self.consume_writes, master)
+		for n in range(1, self.slaves + 1):
+			self.run_worker(f"worker-slave-{n}", self.consume_reads, slave, n)
+		for name, ready in self.ready.items():
+			if not ready.wait(ready_timeout):
+				raise RuntimeError(f"{name} not consuming after {ready_timeout}s")
+		return self
+
+	def setup_logging(self):
+		"""
+		Keeps one of the log handlers the services added, as they all log through the root logger of the process.
+		The others are closed, stopping the threads of those already writing
+		"""
+		logger = logging.getLogger()
+		handlers = [h for h in logger.handlers if type(h).__name__ == "QueuedFileHandler"]
+		for handler in handlers[1:]:
+			logger.removeHandler(handler)
+			handler.close()
+
+	def run_worker(self, name: str, consume: Callable, *args):
+		self.ready[name] = threading.Event()
+		threading.Thread(target=consume, args=(name, *args), name=name, daemon=True).start()
+
+	def consuming(self, name: str, channel):
+		"""
+		Records the worker `name` as running, once it consumes its queues
+		"""
+		with self.lock:
+			self.pids[name] = threading.get_native_id()
+			self.connections.append((channel.connection, channel))
+		self.ready[name].set()
+
+	def consume_writes(self, name: str, master: Dict[str, ModuleType]):
+		"""
+		Runs the write loop of the worker master, as its main does
+		"""
+		with master["utils"].rabbit_channel() as channel:
+			batcher = master["main"].WriteBatcher(channel.connection, channel)
+			channel.basic_qos(prefetch_count=master["config"].write_batch_size)
+			channel.basic_consume(queue="writeQ", on_message_callback=batcher.callback)
+			self.consuming(name, channel)
+			channel.start_consuming()
+
+	def consume_reads(self, name: str, slave: Dict[str, ModuleType], n: int):
+		"""
+		Runs the read loop of slave `n`, as its main does, active from the start
+		"""
+		with slave["utils"].rabbit_channel() as channel:
+			workers = slave["main"].ReadWorkers(channel.connection, channel)
+			switch = slave["main"].ReadSwitch(channel, workers, mode_file=path.join(self.workdir, f"mode-{name}"))
+			channel.basic_qos(prefetch_count=slave["config"].read_prefetch)
+			control_queue = f"control-{name}"
+			channel.queue_declare(queue=control_queue, durable=True)
+			channel.basic_consume(queue=control_queue, on_message_callback=switch.callback)
+			switch.activate()
+			self.consuming(name, channel)
+			channel.start_consuming()
+
+	def stop(self):
+		"""
+		Stops the workers consuming, their connections close once the messages they hold are handled
+		"""
+		with self.lock:
+			connections, self.connections = self.connections, []
+		for connection, channel in connections:
+			connection.add_callback_threadsafe(channel.stop_consuming)
+
+	def request(self, service: str, method: str, url_path: str, body: Optional[dict] = None) -> Response:
+		"""
+		Sends a request to `service` (orchestrator, rides or users) in the calling thread, e.g.
+			stack.request("rides", "GET", "/api/v1/rides?source=1&destination=2")
+		"""
+		data = dumps(body) if body is not None else None
+		return self.http.request(
+			method, f"http://{service}{url_path}", data=data, headers={"Content-Type": "application/json"}
+		)
+
+	def db_stats(self) -> Dict[str, object]:
+		"""
+		Returns the queue stats of the bus and the document counts of the store
+		"""
+		queues: List[str] = sorted(self.bus.queues)
+		return {
+			"queues": {queue: self.bus.stats(queue) for queue in queues},
+			"bus": dict(self.bus.counts),
+			"documents": {
+				name: collection.count_documents({})
+				for db in self.store.databases.values()
+				for name, collection in db.collections.items()
+			},
+		}
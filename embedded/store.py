@@ -0,0 +1,559 @@
+"""
+	RideShare (Cloud Computing Project)
+	store.py: in-memory document store standing in for MongoDB, and the `pymongo` module the workers import in embedded mode
+
+	Covers the operations the worker master and slaves run: find (projection, sort, skip, limit), count_documents,
+	distinct, aggregate, list_indexes, create_index (enforcing unique ones), bulk_write, insert_one, update_many
+	and delete_many, with the query and update operators the services send
+"""
+
+import threading
+from copy import deepcopy
+from itertools import count
+from types import ModuleType
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+
+_missing = object()
+
+
+class OperationFailure(Exception):
+	pass
+
+
+class DuplicateKeyError(OperationFailure):
+	code = 11000
+
+
+class BulkWriteError(OperationFailure):
+	"""
+	Raised by bulk_write, with the index, code and message of each failed operation in details["writeErrors"]
+	"""
+	def __init__(self, details: dict):
+		super().__init__("batch op errors occurred")
+		self.details = details
+
+
+def get_path(document: Any, path: str) -> Any:
+	"""
+	Returns the value at dotted `path` of `document`, `_missing` if it has none
+	"""
+	value = document
+	for key in path.split("."):
+		if isinstance(value, dict) and key in value:
+			value = value[key]
+		elif isinstance(value, list) and key.isdigit() and int(key) < len(value):
+			value = value[int(key)]
+		else:
+			return _missing
+	return value
+
+
+def set_path(document: dict, path: str, value: Any):
+	*parents, last = path.split(".")
+	for key in parents:
+		document = document.setdefault(key, {})
+	document[last] = value
+
+
+def unset_path(document: dict, path: str):
+	*parents, last = path.split(".")
+	for key in parents:
+		document = document.get(key)
+		if not isinstance(document, dict):
+			return
+	document.pop(last, None)
+
+
+def sort_key(value: Any) -> Tuple[int, Any]:
+	"""
+	Orders values of different types like MongoDB does: missing/null, numbers, strings, documents, arrays, booleans
+	"""
+	if value is _missing or value is None:
+		return (0, 0)
+	if isinstance(value, bool):
+		return (5, value)
+	if isinstance(value, (int, float)):
+		return (1, value)
+	if isinstance(value, str):
+		return (2, value)
+	if isinstance(value, dict):
+		return (3, str(value))
+	return (4, str(value))
+
+
+def compare(op: Callable[[Any, Any], bool], value: Any, operand: Any) -> bool:
+	"""
+	Applies a comparison operator to `value`, or to any of its elements if it's an array
+	"""
+	values = value if isinstance(value, list) else [value]
+	for v in values:
+		if v is _missing:
+			continue
+		try:
+			if op(v, operand):
+				return True
+		except TypeError:
+			continue
+	return False
+
+
+def equals(value: Any, operand: Any) -> bool:
+	"""
+	Equality of a query: a field equals `operand`, or is an array containing it
+	"""
+	if value is _missing:
+		return operand is None
+	if value == operand:
+		return True
+	return isinstance(value, list) and operand in value
+
+
+operators: Dict[str, Callable[[Any, Any], bool]] = {
+	"$eq": equals,
+	"$ne": lambda value, operand: not equals(value, operand),
+	"$gt": lambda value, operand: compare(lambda a, b: a > b, value, operand),
+	"$gte": lambda value, operand: compare(lambda a, b: a >= b, value, operand),
+	"$lt": lambda value, operand: compare(lambda a, b: a < b, value, operand),
+	"$lte": lambda value, operand: compare(lambda a, b: a <= b, value, operand),
+	"$in": lambda value, operand: any(equals(value, o) for o in operand),
+	"$nin": lambda value, operand: not any(equals(value, o) for o in operand),
+	"$exists": lambda value, operand: (value is not _missing) == bool(operand),
+	"$size": lambda value, operand: isinstance(value, list) and len(value) == operand,
+}
+
+
+def matches(document: dict, query: Optional[dict]) -> bool:
+	"""
+	Returns if `document` matches `query`
+	"""
+	for key, condition in (query or {}).items():
+		if key == "$and":
+			if not all(matches(document, q) for q in condition):
+				return False
+		elif key == "$or":
+			if not any(matches(document, q) for q in condition):
+				return False
+		elif key == "$nor":
+			if any(matches(document, q) for q in condition):
+				return False
+		else:
+			value = get_path(document, key)
+			if isinstance(condition, dict) and condition and all(k.startswith("$") for k in condition):
+				for op, operand in condition.items():
+					if op not in operators:
+						raise OperationFailure(f"Unknown query operator {op}")
+					if not operators[op](value, operand):
+						return False
+			elif not equals(value, condition):
+				return False
+	return True
+
+
+def project(document: dict, projection: Optional[dict]) -> dict:
+	"""
+	Returns the fields of `document` in `projection`: the included ones, or all but the excluded ones
+	"""
+	if not projection:
+		return document
+	included = {k for k, v in projection.items() if v and k != "_id"}
+	if included:
+		result = {}
+		if projection.get("_id", 1) and "_id" in document:
+			result["_id"] = document["_id"]
+		for path in included:
+			value = get_path(document, path)
+			if value is not _missing:
+				set_path(result, path, value)
+		return result
+	# Documents are private copies by now, they can lose fields in place
+	result = document
+	for path, keep in projection.items():
+		if not keep:
+			unset_path(result, path)
+	return result
+
+
+def apply_update(document: dict, update: dict):
+	"""
+	Applies the update operators of `update` to `document`, in place
+	"""
+	for op, fields in update.items():
+		for path, operand in fields.items():
+			value = get_path(document, path)
+			if op == "$set":
+				set_path(document, path, deepcopy(operand))
+			elif op == "$unset":
+				unset_path(document, path)
+			elif op == "$inc":
+				set_path(document, path, (0 if value is _missing else value) + operand)
+			elif op == "$push":
+				items = operand["$each"] if isinstance(operand, dict) and "$each" in operand else [operand]
+				set_path(document, path, (value if isinstance(value, list) else []) + deepcopy(items))
+			elif op == "$addToSet":
+				items = operand["$each"] if isinstance(operand, dict) and "$each" in operand else [operand]
+				current = value if isinstance(value, list) else []
+				set_path(document, path, current + [i for i in deepcopy(items) if i not in current])
+			elif op == "$pull":
+				if isinstance(value, list):
+					if isinstance(operand, dict):
+						kept = [v for v in value if not matches({"v": v}, {"v": operand})]
+					else:
+						kept = [v for v in value if v != operand]
+					set_path(document, path, kept)
+			else:
+				raise OperationFailure(f"Unknown update operator {op}")
+
+
+class Cursor:
+	"""
+	Iterates over the documents of a find, computed when iteration starts
+	"""
+	def __init__(self, collection: "Collection", query: dict, projection: dict, sort, limit: int, skip: int):
+		self.collection = collection
+		self.query = query
+		self.projection = projection
+		self.sort = sort
+		self.limit = limit
+		self.skip = skip
+
+	def batch_size(self, size: int) -> "Cursor":
+		return self
+
+	def __iter__(self) -> Iterator[dict]:
+		documents = self.collection.matching(self.query)
+		for key, direction in reversed(self.sort or []):
+			documents.sort(key=lambda d: sort_key(get_path(d, key)), reverse=direction < 0)
+		documents = documents[self.skip or 0:]
+		if self.limit:
+			documents = documents[:self.limit]
+		return (project(d, self.projection) for d in documents)
+
+
+class Collection:
+	"""
+	A collection of the store. Documents are copied in and out, as they would be serialized to and from mongod
+	"""
+	def __init__(self, database: "Database", name: str):
+		self.database = database
+		self.name = name
+		self.documents: List[dict] = []
+		self.indexes: Dict[str, dict] = {"_id_": {"v": 2, "key": {"_id": 1}, "name": "_id_"}}
+		# name of each unique index -> keys of the documents in it
+		self.unique: Dict[str, set] = {}
+		self.lock = threading.RLock()
+
+	def matching(self, query: Optional[dict]) -> List[dict]:
+		with self.lock:
+			return [deepcopy(d) for d in self.documents if matches(d, query)]
+
+	def find(self, filter: dict = None, projection: dict = None, sort=None, limit: int = 0, skip: int = 0, **kwargs) -> Cursor:
+		return Cursor(self, filter, projection, sort, limit, skip)
+
+	def count_documents(self, filter: dict, **kwargs) -> int:
+		with self.lock:
+			return sum(1 for d in self.documents if matches(d, filter))
+
+	def distinct(self, key: str, filter: dict = None) -> list:
+		values = []
+		for document in self.matching(filter):
+			value = get_path(document, key)
+			for v in value if isinstance(value, list) else [value]:
+				if v is not _missing and v not in values:
+					values.append(v)
+		return values
+
+	def aggregate(self, pipeline: List[dict], **kwargs) -> Iterator[dict]:
+		documents = self.matching(None)
+		for stage in pipeline:
+			(name, spec), = stage.items()
+			documents = aggregate_stage(name, spec, documents)
+		return iter(documents)
+
+	def list_indexes(self) -> Iterator[dict]:
+		with self.lock:
+			return iter([{**index, "ns": f"{self.database.name}.{self.name}"} for index in self.indexes.values()])
+
+	def create_index(self, keys: List[Tuple[str, int]], unique: bool = False, name: str = None, **kwargs) -> str:
+		name = name or "_".join(f"{key}_{direction}" for key, direction in keys)
+		with self.lock:
+			if name not in self.indexes:
+				index = {"v": 2, "key": dict(keys), "name": name}
+				if unique:
+					index["unique"] = True
+					self.unique[name] = self.index_keys(self.documents, index)
+				self.indexes[name] = index
+		return name
+
+	@staticmethod
+	def index_key(document: dict, index: dict) -> tuple:
+		return tuple(repr(get_path(document, field)) for field in index["key"])
+
+	def index_keys(self, documents: List[dict], index: dict) -> set:
+		"""
+		Returns the keys of `documents` in the unique `index`, raises DuplicateKeyError if two of them have the same
+		"""
+		keys = set()
+		for document in documents:
+			key = self.index_key(document, index)
+			if key in keys:
+				raise DuplicateKeyError(f"E11000 duplicate key error collection: {self.name} index: {index['name']}")
+			keys.add(key)
+		return keys
+
+	def reindex(self):
+		for name in self.unique:
+			self.unique[name] = self.index_keys(self.documents, self.indexes[name])
+
+	def insert(self, document: dict):
+		document = deepcopy(document)
+		document.setdefault("_id", self.database.client.next_id())
+		keys = {name: self.index_key(document, self.indexes[name]) for name in self.unique}
+		for name, key in keys.items():
+			if key in self.unique[name]:
+				raise DuplicateKeyError(f"E11000 duplicate key error collection: {self.name} index: {name}")
+		for name, key in keys.items():
+			self.unique[name].add(key)
+		self.documents.append(document)
+
+	def update(self, filter: dict, update: dict) -> int:
+		updated = 0
+		for document in self.documents:
+			if matches(document, filter):
+				apply_update(document, update)
+				updated += 1
+		# Keys of unique indexes only change when an update sets one of their fields
+		paths = {path.split(".")[0] for fields in update.values() for path in fields}
+		if updated and any(paths & set(self.indexes[name]["key"]) for name in self.unique):
+			self.reindex()
+		return updated
+
+	def delete(self, filter: dict) -> int:
+		kept = [d for d in self.documents if not matches(d, filter)]
+		deleted = len(self.documents) - len(kept)
+		self.documents = kept
+		if deleted:
+			self.reindex()
+		return deleted
+
+	def insert_one(self, document: dict):
+		with self.lock:
+			self.insert(document)
+
+	def update_many(self, filter: dict, update: dict) -> int:
+		with self.lock:
+			return self.update(filter, update)
+
+	def delete_many(self, filter: dict) -> int:
+		with self.lock:
+			return self.delete(filter)
+
+	def bulk_write(self, requests: list, ordered: bool = True):
+		"""
+		Runs InsertOne, UpdateMany and DeleteMany operations in order.
+		Ordered writes stop at the first error, unordered ones run them all, either raises a BulkWriteError
+		"""
+		write_errors = []
+		with self.lock:
+			for index, request in enumerate(requests):
+				try:
+					request.run(self)
+				except OperationFailure as e:
+					write_errors.append({"index": index, "code": getattr(e, "code", 2), "errmsg": str(e)})
+					if ordered:
+						break
+		if write_errors:
+			raise BulkWriteError({"writeErrors": write_errors})
+
+
+def aggregate_stage(name: str, spec: Any, documents: List[dict]) -> List[dict]:
+	"""
+	Returns the output of the aggregation stage `name` on `documents`
+	"""
+	if name == "$match":
+		return [d for d in documents if matches(d, spec)]
+	if name == "$project":
+		return [project(d, spec) for d in documents]
+	if name == "$addFields":
+		for d in documents:
+			for path, value in spec.items():
+				set_path(d, path, expression(d, value))
+		return documents
+	if name == "$unwind":
+		path = (spec["path"] if isinstance(spec, dict) else spec).lstrip("$")
+		unwound = []
+		for d in documents:
+			for item in get_path(d, path) if isinstance(get_path(d, path), list) else []:
+				copy = deepcopy(d)
+				set_path(copy, path, item)
+				unwound.append(copy)
+		return unwound
+	if name == "$sort":
+		for key, direction in reversed(list(spec.items())):
+			documents.sort(key=lambda d: sort_key(get_path(d, key)), reverse=direction < 0)
+		return documents
+	if name == "$skip":
+		return documents[spec:]
+	if name == "$limit":
+		return documents[:spec]
+	if name == "$count":
+		return [{spec: len(documents)}]
+	if name == "$sortByCount":
+		grouped = aggregate_stage("$group", {"_id": spec, "count": {"$sum": 1}}, documents)
+		return aggregate_stage("$sort", {"count": -1}, grouped)
+	if name == "$group":
+		return group(spec, documents)
+	raise OperationFailure(f"Aggregation stage {name} isn't supported in embedded mode")
+
+
+def expression(document: dict, value: Any) -> Any:
+	"""
+	Evaluates an aggregation expression: a "$field" path or a literal
+	"""
+	if isinstance(value, str) and value.startswith("$"):
+		found = get_path(document, value[1:])
+		return None if found is _missing else found
+	if isinstance(value, dict):
+		return {k: expression(document, v) for k, v in value.items()}
+	return value
+
+
+accumulators: Dict[str, Callable[[List[Any]], Any]] = {
+	"$sum": lambda values: sum(v for v in values if isinstance(v, (int, float))),
+	"$avg": lambda values: (lambda n: sum(n) / len(n) if n else None)([v for v in values if isinstance(v, (int, float))]),
+	"$min": lambda values: min((v for v in values if v is not None), key=sort_key, default=None),
+	"$max": lambda values: max((v for v in values if v is not None), key=sort_key, default=None),
+	"$push": list,
+	"$addToSet": lambda values: [v for i, v in enumerate(values) if v not in values[:i]],
+	"$first": lambda values: values[0] if values else None,
+	"$last": lambda values: values[-1] if values else None,
+}
+
+
+def group(spec: dict, documents: List[dict]) -> List[dict]:
+	groups: Dict[str, Tuple[Any, List[dict]]] = {}
+	for d in documents:
+		key = expression(d, spec["_id"])
+		groups.setdefault(repr(key), (key, []))[1].append(d)
+	output = []
+	for key, members in groups.values():
+		result = {"_id": key}
+		for field, accumulator in spec.items():
+			if field == "_id":
+				continue
+			(op, operand), = accumulator.items()
+			if op not in accumulators:
+				raise OperationFailure(f"Accumulator {op} isn't supported in embedded mode")
+			result[field] = accumulators[op]([expression(d, operand) for d in members])
+		output.append(result)
+	return output
+
+
+class InsertOne:
+	def __init__(self, document: dict):
+		self.document = document
+
+	def run(self, collection: Collection):
+		collection.insert(self.document)
+
+
+class UpdateMany:
+	def __init__(self, filter: dict, update: dict, **kwargs):
+		self.filter = filter
+		self.update = update
+
+	def run(self, collection: Collection):
+		collection.update(self.filter, self.update)
+
+
+class DeleteMany:
+	def __init__(self, filter: dict, **kwargs):
+		self.filter = filter
+
+	def run(self, collection: Collection):
+		collection.delete(self.filter)
+
+
+class Database:
+	def __init__(self, client: "MemoryStore", name: str):
+		self.client = client
+		self.name = name
+		self.collections: Dict[str, Collection] = {}
+		self.lock = threading.Lock()
+
+	def __getitem__(self, name: str) -> Collection:
+		with self.lock:
+			if name not in self.collections:
+				self.collections[name] = Collection(self, name)
+			return self.collections[name]
+
+	__getattr__ = __getitem__
+
+
+class Admin:
+	"""
+	The admin database: the ReplSet commands succeed, as the store is a single node every worker shares
+	"""
+	def command(self, command, *args, **kwargs) -> dict:
+		return {"ok": 1.0}
+
+
+class MemoryStore:
+	"""
+	The databases of the store, shared by the master and the slaves, so a write is visible to the next read
+	"""
+	def __init__(self):
+		self.databases: Dict[str, Database] = {}
+		self.lock = threading.Lock()
+		self.ids = count(1)
+		self.admin = Admin()
+
+	def next_id(self) -> int:
+		with self.lock:
+			return next(self.ids)
+
+	def __getitem__(self, name: str) -> Database:
+		with self.lock:
+			if name not in self.databases:
+				self.databases[name] = Database(self, name)
+			return self.databases[name]
+
+
+class CommandListener:
+	pass
+
+
+class ConnectionPoolListener:
+	pass
+
+
+def pymongo_module(store: MemoryStore) -> Dict[str, ModuleType]:
+	"""
+	Returns the `pymongo` module and the submodules the workers import, with clients of `store`
+	"""
+	pymongo = ModuleType("pymongo")
+	pymongo.MongoClient = lambda *args, **kwargs: store
+	pymongo.InsertOne = InsertOne
+	pymongo.UpdateMany = UpdateMany
+	pymongo.DeleteMany = DeleteMany
+
+	modules = {"pymongo": pymongo}
+	for name, attrs in {
+		"collection": {"Collection": Collection},
+		"cursor": {"Cursor": Cursor},
+		"database": {"Database": Database},
+		"errors": {
+			"OperationFailure": OperationFailure,
+			"DuplicateKeyError": DuplicateKeyError,
+			"BulkWriteError": BulkWriteError,
+		},
+		"monitoring": {
+			"CommandListener": CommandListener,
+			"ConnectionPoolListener": ConnectionPoolListener,
+			"register": lambda listener: None,
+		},
+	}.items():
+		module = ModuleType(f"pymongo.{name}")
+		module.__dict__.update(attrs)
+		setattr(pymongo, name, module)
+		modules[f"pymongo.{name}"] = module
+	return modules
@@ -0,0 +1,125 @@
+"""
+	RideShare (Cloud Computing Project)
+	web.py: the `requests` module the services import in embedded mode, calling the WSGI apps of the process by hostname,
+	and the RMQ management API of the bus
+"""
+
+from json import dumps, loads
+from types import ModuleType
+from typing import Any, Callable, Dict, Optional
+from urllib.parse import unquote, urlencode, urlsplit
+
+from werkzeug.test import Client
+from werkzeug.wrappers import Response as WSGIResponse
+
+from .bus import Bus
+
+
+class RequestException(IOError):
+	pass
+
+
+class ConnectionError(RequestException):
+	pass
+
+
+class HTTPError(RequestException):
+	pass
+
+
+class Response:
+	def __init__(self, url: str, status_code: int, content: bytes, headers: Dict[str, str]):
+		self.url = url
+		self.status_code = status_code
+		self.content = content
+		self.headers = headers
+
+	@property
+	def ok(self) -> bool:
+		return self.status_code < 400
+
+	@property
+	def text(self) -> str:
+		return self.content.decode("utf-8")
+
+	def json(self) -> Any:
+		return loads(self.content)
+
+	def raise_for_status(self):
+		if not self.ok:
+			raise HTTPError(f"{self.status_code} for url {self.url}")
+
+
+class InProcessHTTP:
+	"""
+	Sends requests to the WSGI app serving their hostname, in the calling thread, without a socket
+	"""
+	def __init__(self, apps: Dict[str, Callable]):
+		self.apps = apps
+
+	def request(
+		self, method: str, url: str, params: dict = None, data: Any = None, json: Any = None,
+		headers: Dict[str, str] = None, **kwargs,
+	) -> Response:
+		parts = urlsplit(url)
+		app = self.apps.get(parts.hostname)
+		if app is None:
+			raise ConnectionError(f"No embedded service at {parts.hostname}")
+		headers = dict(headers or {})
+		if json is not None:
+			data = dumps(json)
+			headers.setdefault("Content-Type", "application/json")
+		query = "&".join(q for q in (parts.query, urlencode(params or {})) if q)
+		resp = Client(app, WSGIResponse).open(
+			parts.path, method=method.upper(), query_string=query, data=data, headers=headers
+		)
+		return Response(url, resp.status_code, resp.get_data(), dict(resp.headers))
+
+	def get(self, url: str, **kwargs) -> Response:
+		return self.request("GET", url, **kwargs)
+
+	def post(self, url: str, data: Any = None, **kwargs) -> Response:
+		return self.request("POST", url, data=data, **kwargs)
+
+	def put(self, url: str, data: Any = None, **kwargs) -> Response:
+		return self.request("PUT", url, data=data, **kwargs)
+
+	def delete(self, url: str, **kwargs) -> Response:
+		return self.request("DELETE", url, **kwargs)
+
+
+def management_app(bus: Bus) -> Callable:
+	"""
+	Returns a WSGI app serving the queue stats of `bus` on /api/queues/<vhost>/<queue>, as the RMQ management API does
+	"""
+	def app(environ: dict, start_response: Callable):
+		path = unquote(environ.get("RAW_URI") or environ.get("PATH_INFO", ""))
+		parts = path.split("?")[0].strip("/").split("/")
+		stats: Optional[dict] = None
+		if len(parts) == 4 and parts[:2] == ["api", "queues"]:
+			stats = bus.stats(parts[3])
+		status = "200 OK" if stats is not None else "404 Not Found"
+		body = dumps(stats if stats is not None else {"error": "Object Not Found"}).encode("utf-8")
+		start_response(status, [("Content-Type", "application/json"), ("Content-Length", str(len(body)))])
+		return [body]
+	return app
+
+
+def requests_module(http: InProcessHTTP) -> Dict[str, ModuleType]:
+	"""
+	Returns the `requests` module sending its requests through `http`
+	"""
+	requests = ModuleType("requests")
+	for method in ("request", "get", "post", "put", "delete"):
+		setattr(requests, method, getattr(http, method))
+	requests.Response = Response
+
+	exceptions = ModuleType("requests.exceptions")
+	exceptions.RequestException = RequestException
+	exceptions.ConnectionError = ConnectionError
+	exceptions.HTTPError = HTTPError
+	requests.exceptions = exceptions
+	requests.RequestException = RequestException
+	requests.ConnectionError = ConnectionError
+	requests.HTTPError = HTTPError
+	return {"requests": requests, "requests.exceptions": exceptions}
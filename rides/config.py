@@ -6,3 +6,14 @@ rides_ip = "54.87.164.156"
 
 redis_host = "redis"
 redis_key = "count"
+count_flush_interval = 0.5  # seconds request counts are buffered in process before being added in Redis
+
+service_name = "rides"  # service spans are recorded under
+spans_file = "spans.jsonl"  # local collector file spans are appended to, one JSON object per line
+span_queue_size = 10000  # finished spans waiting to be written before new ones are dropped
+
+log_file = "rideshare.log"  # file the logs of the service are written to, as JSON lines
+log_max_chars = 1000  # longest logged value, longer ones are truncated
+log_queue_size = 10000  # log records waiting to be written before new ones are dropped
+# fraction of the records below WARNING written per logger, others are written in full
+log_sample_rates = {"requests": 0.1, "db": 0.1}
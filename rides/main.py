@@ -13,8 +13,13 @@ import requests
 from flask import Flask, request
 from flask_restful import Api, Resource, reqparse
 
-from config import dbaas_ip, elb_ip, flask_port, redis_host, redis_key, rides_ip
+from config import (dbaas_ip, elb_ip, flask_port, log_file, redis_host,
+                    redis_key, rides_ip)
+from counter import request_counter
 from locations import locations
+from logs import setup_logging
+from metrics import instrument, timed
+from tracing import trace_headers, trace_requests, traced
 
 # Paths for API endpoints
 url_prefix = "/api/v1"
@@ -27,16 +32,16 @@ url_db_read = f"{base_url_db}/read"
 headers = {"Content-Type": "application/json"}
 
 # Logger
-logging.basicConfig(
-	level=logging.INFO,
-	format="%(asctime)s %(levelname)-8s %(message)s",
-	filename="rideshare.log",
-)
+setup_logging(log_file)
 logger = logging.getLogger()
+# Logs the DB calls and their results, sampled (see log_sample_rates)
+db_logger = logging.getLogger("db")
 
 # Flask RESTful Setup
 app = Flask(__name__)
 api = Api(app)
+instrument(app)
+trace_requests(app)
 
 # Defining arguments used by REST endpoints in JSON body
 parser = reqparse.RequestParser()
@@ -50,62 +55,88 @@ parser.add_argument("destination", type=int)
 r = redis.Redis(host=redis_host)
 
 
+@timed("db_write")
+@traced("db_write")
 def insert_ride(ride: dict) -> bool:
 	"""
 	Helper function to send request to DB to insert `ride`
 	Returns if request succeeded or failed
 	"""
 	payload = {"collection": "rides", "action": 0, "document": ride}
-	res = requests.post(url_db_write, data=dumps(payload), headers=headers).ok
-	logger.info(f"DB insert_ride {ride}-> {res}")
+	res = requests.post(url_db_write, data=dumps(payload), headers=trace_headers(headers)).ok
+	db_logger.info("DB insert_ride %s-> %s", ride, res)
 	return res
 
 
-def find_rides(filte: dict) -> List[dict]:
+@timed("db_read")
+@traced("db_read")
+def find_rides(filte: dict, **options) -> List[dict]:
 	"""
 	Helper function to send request to DB to find ride(s) on query `filte`
+	`options` (projection, sort, limit, skip) are applied by the DB
 	Returns list of ride documents from DB
 	"""
-	payload = {"collection": "rides", "filte": filte}
-	res = requests.post(url_db_read, data=dumps(payload), headers=headers).json()
-	logger.info(f"DB find_rides {filte}-> {res}")
+	payload = {"collection": "rides", "filte": filte, **options}
+	res = requests.post(url_db_read, data=dumps(payload), headers=trace_headers(headers)).json()
+	db_logger.info("DB find_rides %s-> %s", filte, res)
 	return res
 
 
+@timed("db_read")
+@traced("db_read")
+def count_rides(filte: dict) -> int:
+	"""
+	Helper function to send request to DB to count ride(s) on query `filte`
+	Returns the number of matching rides, counted by the DB
+	"""
+	payload = {"collection": "rides", "filte": filte, "op": "count"}
+	res = requests.post(url_db_read, data=dumps(payload), headers=trace_headers(headers)).json()
+	db_logger.info("DB count_rides %s-> %s", filte, res)
+	return res
+
+
+@timed("db_write")
+@traced("db_write")
 def update_rides(filte: dict, update: dict):
 	"""
 	Helper function to send request to DB to set `update` to ride(s) on query `filte`
 	Returns if request succeeded or failed
 	"""
 	payload = {"collection": "rides", "action": 1, "filte": filte, "update": update}
-	res = requests.post(url_db_write, data=dumps(payload), headers=headers).ok
-	logger.info(f"DB update_rides {filte}-> {res}")
+	res = requests.post(url_db_write, data=dumps(payload), headers=trace_headers(headers)).ok
+	db_logger.info("DB update_rides %s-> %s", filte, res)
 	return res
 
 
+@timed("db_write")
+@traced("db_write")
 def delete_rides(filte: dict):
 	"""
 	Helper function to send request to DB to delete ride(s) on query `filte`
 	Returns if request succeeded or failed
 	"""
 	payload = {"collection": "rides", "action": 2, "filte": filte}
-	res = requests.post(url_db_write, data=dumps(payload), headers=headers).ok
-	logger.info(f"DB delete_rides {filte}-> {res}")
+	res = requests.post(url_db_write, data=dumps(payload), headers=trace_headers(headers)).ok
+	db_logger.info("DB delete_rides %s-> %s", filte, res)
 	return res
 
 
+@timed("users")
+@traced("users")
 def find_users() -> List[str]:
 	"""
 	Helper function to send request to DB to find all users
 	Returns a list of the usernames of all registered users
 	"""
 	headers_ = dict(list(headers.items()) + [("Origin", rides_ip)])
-	a = requests.get(url_users, headers=headers_)
+	a = requests.get(url_users, headers=trace_headers(headers_))
 	res = a.json() if a.status_code != 204 else []
-	logger.info(f"DB* find_users -> {res}")
+	db_logger.info("DB* find_users -> %s", res)
 	return res
 
 
+@timed("redis")
+@traced("redis")
 def next_id():
 	"""
 	Increments rideId key in redis
@@ -133,7 +164,7 @@ class RequestsDB(Resource):
 				items:
 					type: integer
 		"""
-		return [int(r.get(redis_key) or 0)], 200
+		return [request_counter.get(redis_key)], 200
 
 	def delete(self):
 		"""
@@ -143,7 +174,7 @@ class RequestsDB(Resource):
 		responses:
 			200: OK
 		"""
-		r.delete(redis_key)
+		request_counter.reset(redis_key)
 		return {}, 200
 
 
@@ -181,7 +212,7 @@ class Rides(Resource):
 			201: Ride Created
 			400: Bad Request. User does not exist or invalid timestamp or invalid location id(s)
 		"""
-		logger.debug(request.get_json())
+		logger.debug("Body %s", request.get_json())
 		# Fetch request body into a dict-like object
 		args = parser.parse_args()
 		created_by = args["created_by"]
@@ -303,7 +334,7 @@ class RideCount(Resource):
 				items:
 					type: integer
 		"""
-		return [len(find_rides({}))], 200
+		return [count_rides({})], 200
 
 
 class Ride(Resource):
@@ -343,7 +374,7 @@ class Ride(Resource):
 		"""
 		# find if rideId exists
 		query = {"rideId": rideId}
-		r = find_rides(query)
+		r = find_rides(query, limit=1)
 
 		# Bad Request if rideId does not exist
 		if not r:
@@ -361,7 +392,7 @@ class Ride(Resource):
 
 		return r[0], 200
 
-	def post(self, rideid):
+	def post(self, rideId):
 		"""
 		summary: endpoint for `username` joining ride with `rideId`
 		path: /api/v1/rides/
@@ -401,14 +432,14 @@ class Ride(Resource):
 			400:
 				description: Username or Ride ID does not exist
 		"""
-		logger.debug(request.get_json())
+		logger.debug("Body %s", request.get_json())
 		# Fetch request body into a dict-like object
 		args = parser.parse_args()
 		username = args["username"]
 
 		# find if rideId exists
-		query = {"rideId": rideid}
-		r = find_rides(query)
+		query = {"rideId": rideId}
+		r = find_rides(query, projection={"created_by": 1, "users": 1}, limit=1)
 
 		# Bad Request if user does not exist, or ride id does not exist,
 		# or user joining ride created by them or user has already joined
@@ -419,11 +450,11 @@ class Ride(Resource):
 			return {}, 400
 
 		# add user to joined users
-		update_rides({"rideId": rideid}, {"$push": {"users": username}})
+		update_rides({"rideId": rideId}, {"$push": {"users": username}})
 
 		return {}, 200
 
-	def delete(self, rideid):
+	def delete(self, rideId):
 		"""
 		summary: endpoint for deleting ride with `rideId`
 		path: /api/v1/rides/
@@ -440,10 +471,10 @@ class Ride(Resource):
 				description: Ride ID does not exist
 		"""
 		# find if rideId exists
-		query = {"rideId": rideid}
+		query = {"rideId": rideId}
 
 		# Bad request if rideId does not exist
-		if not find_rides(query):
+		if not find_rides(query, projection={"rideId": 1}, limit=1):
 			return {}, 400
 
 		# delete if it does
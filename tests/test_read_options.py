@@ -0,0 +1,62 @@
+"""
+	RideShare (Cloud Computing Project)
+	test_read_options.py: find options of /api/v1/db/read, through the orchestrator of the embedded stack
+"""
+
+from time import sleep
+
+import pytest
+
+from embedded import Stack
+
+documents = [{"a": 1, "b": 1}, {"a": 2, "b": 1}, {"a": 1, "b": 2}, {"a": 2, "b": 2}]
+
+
+@pytest.fixture(scope="module")
+def stack():
+	stack = Stack(slaves=1).start()
+	resp = stack.request(
+		"orchestrator", "POST", "/api/v1/db/write/batch",
+		{"writes": [{"collection": "sorted", "action": 0, "document": d} for d in documents]},
+	)
+	assert resp.status_code < 300
+	yield stack
+	stack.stop()
+
+
+def read(stack: Stack, **args):
+	return stack.request("orchestrator", "POST", "/api/v1/db/read", {"collection": "sorted", "filte": {}, **args})
+
+
+def wait_for_documents(stack: Stack):
+	# Writes are flushed by the master in the background
+	for _ in range(100):
+		resp = read(stack, op="count")
+		if resp.status_code == 200 and resp.json() == len(documents):
+			return
+		sleep(0.05)
+	pytest.fail("documents not written")
+
+
+def test_one_key_sort(stack):
+	wait_for_documents(stack)
+	resp = read(stack, sort=[["a", -1]], projection={"a": 1})
+	assert resp.status_code == 200
+	assert [d["a"] for d in resp.json()] == [2, 2, 1, 1]
+
+
+def test_two_key_sort(stack):
+	wait_for_documents(stack)
+	resp = read(stack, sort=[["a", 1], ["b", -1]])
+	assert resp.status_code == 200
+	assert [(d["a"], d["b"]) for d in resp.json()] == [(1, 2), (1, 1), (2, 2), (2, 1)]
+
+
+def test_bad_sort(stack):
+	assert read(stack, sort=[["a", 2]]).status_code == 400
+	assert read(stack, sort="a").status_code == 400
+
+
+def test_mixed_projection(stack):
+	assert read(stack, projection={"a": 1, "b": 0}).status_code == 400
+	assert read(stack, projection={"a": 1, "_id": 0}).status_code == 200
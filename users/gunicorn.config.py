@@ -1,15 +1,14 @@
 import logging
 
-import redis
+from config import log_file, redis_key
+from counter import request_counter
+# Server hook starting the background threads of each worker
+from hooks import post_fork
+from logs import setup_logging
 
-from config import redis_host, redis_key
-
-logging.basicConfig(
-	level=logging.INFO,
-	format="%(asctime)s %(levelname)-8s %(message)s",
-	filename="rideshare.log",
-)
-logger = logging.getLogger()
+setup_logging(log_file)
+# Logs every request, sampled (see log_sample_rates)
+logger = logging.getLogger("requests")
 
 bind = "0.0.0.0:5000"
 backlog = 256
@@ -27,15 +26,12 @@ errorlog = "rideshare-error.log"
 loglevel = "info"
 spew = False
 
-r = redis.Redis(host=redis_host)
-
-
 def pre_request(worker, req):
 	if req.path != "/":
-		logger.info(f"G {req.path} {req.method} {req.headers}")
+		logger.info("G %s %s %s", req.path, req.method, req.headers)
 	if "/api/v1/users" in req.path:
-		a = r.incr(redis_key)
-		logger.info(f"Counter updated - {a}")
+		# Counted in process and flushed to Redis in the background
+		request_counter.incr(redis_key)
 
 
 # def post_request(worker, req, environ, resp):
@@ -7,12 +7,15 @@ import logging
 from json import dumps
 from typing import List
 
-import redis
 import requests
 from flask import Flask, request
 from flask_restful import Api, Resource, reqparse
 
-from config import dbaas_ip, flask_port, redis_host, redis_key
+from config import dbaas_ip, flask_port, log_file, redis_key
+from counter import request_counter
+from logs import setup_logging
+from metrics import instrument, timed
+from tracing import trace_headers, trace_requests, traced
 
 # Paths for API endpoints
 url_prefix = "/api/v1"
@@ -27,24 +30,21 @@ headers = {"Content-Type": "application/json"}
 hex_set = set("0123456789abcdef")
 
 # Logger
-logging.basicConfig(
-	level=logging.INFO,
-	format="%(asctime)s %(levelname)-8s %(message)s",
-	filename="rideshare.log",
-)
+setup_logging(log_file)
 logger = logging.getLogger()
+# Logs the DB calls and their results, sampled (see log_sample_rates)
+db_logger = logging.getLogger("db")
 
 app = Flask(__name__)
 api = Api(app)
+instrument(app)
+trace_requests(app)
 
 # fetching the JSON body arguments for a request
 parser = reqparse.RequestParser()
 parser.add_argument("username", type=str)
 parser.add_argument("password", type=str)
 
-# Connecting to redis
-r = redis.Redis(host=redis_host)
-
 
 def is_valid_sha(password: str) -> bool:
 	"""
@@ -53,58 +53,69 @@ def is_valid_sha(password: str) -> bool:
 	return len(password) == 40 and not set(password.lower()) - hex_set
 
 
+@timed("db_write")
+@traced("db_write")
 def insert_user(user: dict) -> bool:
 	"""
 	Helper function to send request to DB to insert `user`
 	Returns if request succeeded or failed
 	"""
 	payload = {"collection": "users", "action": 0, "document": user}
-	res = requests.post(url_db_write, data=dumps(payload), headers=headers).ok
-	logger.info(f"DB insert_user {user} -> {res}")
+	res = requests.post(url_db_write, data=dumps(payload), headers=trace_headers(headers)).ok
+	db_logger.info("DB insert_user %s -> %s", user, res)
 	return res
 
 
-def find_users(filte: dict) -> List[dict]:
+@timed("db_read")
+@traced("db_read")
+def find_users(filte: dict, **options) -> List[dict]:
 	"""
 	Helper function to send request to DB to find user(s) on query `filte`
-	Returns list of ride documents from DB
+	`options` (projection, sort, limit, skip) are applied by the DB
+	Returns list of user documents from DB
 	"""
-	payload = {"collection": "users", "filte": filte}
-	res = requests.post(url_db_read, data=dumps(payload), headers=headers).json()
-	logger.info(f"DB find_users {filte} -> {res}")
+	payload = {"collection": "users", "filte": filte, **options}
+	res = requests.post(url_db_read, data=dumps(payload), headers=trace_headers(headers)).json()
+	db_logger.info("DB find_users %s -> %s", filte, res)
 	return res
 
 
+@timed("db_write")
+@traced("db_write")
 def update_rides(filte: dict, update: dict) -> bool:
 	"""
 	Helper function to send request to DB to update ride(s) on query `filte`
 	Returns if request succeeded or failed
 	"""
 	payload = {"collection": "rides", "action": 1, "filte": filte, "update": update}
-	res = requests.post(url_db_write, data=dumps(payload), headers=headers).ok
-	logger.info(f"DB update_rides {filte} {update} -> {res}")
+	res = requests.post(url_db_write, data=dumps(payload), headers=trace_headers(headers)).ok
+	db_logger.info("DB update_rides %s %s -> %s", filte, update, res)
 	return res
 
 
+@timed("db_write")
+@traced("db_write")
 def delete_users(filte: dict) -> bool:
 	"""
 	Helper function to send request to DB to delete user(s) on query `filte`
 	Returns if request succeeded or failed
 	"""
 	payload = {"collection": "users", "action": 2, "filte": filte}
-	res = requests.post(url_db_write, data=dumps(payload), headers=headers).ok
-	logger.info(f"DB delete_users {filte} -> {res}")
+	res = requests.post(url_db_write, data=dumps(payload), headers=trace_headers(headers)).ok
+	db_logger.info("DB delete_users %s -> %s", filte, res)
 	return res
 
 
+@timed("db_write")
+@traced("db_write")
 def delete_rides(filte: dict) -> bool:
 	"""
 	Helper function to send request to DB to find ride(s) on query `filte`
 	Returns if request succeeded or failed
 	"""
 	payload = {"collection": "rides", "action": 2, "filte": filte}
-	res = requests.post(url_db_write, data=dumps(payload), headers=headers).ok
-	logger.info(f"DB delete_rides {filte} -> {res}")
+	res = requests.post(url_db_write, data=dumps(payload), headers=trace_headers(headers)).ok
+	db_logger.info("DB delete_rides %s -> %s", filte, res)
 	return res
 
 
@@ -127,7 +138,7 @@ class RequestCount(Resource):
 				items:
 					type: integer
 		"""
-		return [int(r.get(redis_key) or 0)], 200
+		return [request_counter.get(redis_key)], 200
 
 	def delete(self):
 		"""
@@ -137,7 +148,7 @@ class RequestCount(Resource):
 		responses:
 			200: OK
 		"""
-		r.delete(redis_key)
+		request_counter.reset(redis_key)
 		return {}, 200
 
 
@@ -166,7 +177,7 @@ class Users(Resource):
 			201: User Created
 			400: Bad Request. Username exists or invalid password
 		"""
-		logger.debug(request.get_json())
+		logger.debug("Body %s", request.get_json())
 		# Fetch request body into a dict-like object
 		args = parser.parse_args()
 		username, password = args["username"], args["password"]
@@ -177,7 +188,7 @@ class Users(Resource):
 
 		# Bad request if username already exists
 		query = {"username": username}
-		if find_users(query):
+		if find_users(query, projection={"username": 1}, limit=1):
 			return {}, 400
 
 		insert_user({"username": username, "password": password})
@@ -202,7 +213,7 @@ class Users(Resource):
 			204:
 				description: No Users
 		"""
-		r = [user["username"] for user in find_users({})]
+		r = [user["username"] for user in find_users({}, projection={"username": 1})]
 
 		return r, 200 if r else 204
 
@@ -224,7 +235,7 @@ class User(Resource):
 		"""
 		# Bad Request if user does not exist
 		query = {"username": username}
-		if not find_users(query):
+		if not find_users(query, projection={"username": 1}, limit=1):
 			return {}, 400
 
 		delete_users(query)